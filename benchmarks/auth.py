@@ -0,0 +1,149 @@
+"""Compare the ways of authenticating the API calls and git pushes of a bump fan-out
+
+Runs `--calls` API calls, `--concurrency` at a time, against the fake GitHub of
+`benchmarks.fake_github`, with a GitHub App whose key pair is generated on the fly:
+
+- pat: GITHUB_TOKEN, one rate limit shared with everything that runs as its user
+- token per call: a JWT minted and exchanged for an installation token before every
+  call, as when each job authenticates on its own
+- app: `tasks.auth.GitHubApp`, one installation token for every call
+- app, another process: a new `GitHubApp` on the same token cache, as the next task
+
+Then it times `git credential fill` with the credential helper of `tasks.auth`, with and
+without a cached token. We report the wall time, the requests the fake GitHub got and
+the installation tokens minted.
+
+>> python -m benchmarks.auth --calls 200 --concurrency 8 --latency 0.05
+"""
+import asyncio
+import os
+import tempfile
+import time
+from pathlib import Path
+
+import click
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from gidgethub.apps import get_installation_access_token
+
+from benchmarks.fake_github import INSTALLATION_ID, FakeGitHub
+from tasks.auth import GitHubApp, credential_helper
+from tasks.github import GitHubClient
+
+APP_ID = "1234"
+URL = "/repos/photopills/api/releases"
+
+
+def key_pair():
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    private = key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    )
+    public = key.public_key().public_bytes(
+        serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo
+    )
+    return private.decode(), public.decode()
+
+
+async def run_calls(calls, concurrency, call):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            await call()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(calls)))
+    return time.perf_counter() - start
+
+
+async def credential_fill(env):
+    process = await asyncio.create_subprocess_exec(
+        *("git", "-c", f"credential.https://github.com.helper={credential_helper()}"),
+        *("credential", "fill"),
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        env=env,
+    )
+    start = time.perf_counter()
+    stdout, _ = await process.communicate(b"protocol=https\nhost=github.com\n\n")
+    elapsed = time.perf_counter() - start
+    assert b"password=ghs_" in stdout, stdout
+    return elapsed
+
+
+async def run(calls, concurrency, latency):
+    private_key, public_key = key_pair()
+    github = FakeGitHub(latency=latency, app_key=public_key)
+    base_url = await github.start()
+    root = Path(tempfile.mkdtemp(prefix="auth-bench-"))
+    results = {}
+
+    def app():
+        return GitHubApp(APP_ID, private_key, cache_path=root / "tokens.json")
+
+    async def measure(name, gh, call, minted=lambda: 0):
+        before = github.requests
+        elapsed = await run_calls(calls, concurrency, call)
+        results[name] = (elapsed, github.requests - before, minted())
+
+    try:
+        client = GitHubClient(token="benchmark", cache_path=None, base_url=base_url)
+        async with client as gh:
+            await measure("pat", gh, lambda: gh.getitem(URL))
+
+            tokens = []
+
+            async def per_call():
+                data = await get_installation_access_token(
+                    gh,
+                    installation_id=INSTALLATION_ID,
+                    app_id=APP_ID,
+                    private_key=private_key,
+                )
+                tokens.append(data["token"])
+                await gh.getitem(URL, oauth_token=data["token"])
+
+            await measure("token per call", gh, per_call, lambda: len(tokens))
+
+        for name in ("app", "app, another process"):
+            client = GitHubClient(app=app(), cache_path=None, base_url=base_url)
+            async with client as gh:
+                await measure(name, gh, lambda: gh.getitem(URL), lambda: gh.app.minted)
+
+        env = dict(
+            os.environ,
+            GITHUB_APP_ID=APP_ID,
+            GITHUB_APP_PRIVATE_KEY=private_key,
+            GITHUB_API_URL=base_url,
+            GITHUB_TOKEN_CACHE_PATH=str(root / "helper-tokens.json"),
+            GITHUB_SERVER_URL="https://github.com",
+        )
+        helper = {
+            "no cached token": await credential_fill(env),
+            "cached token": await credential_fill(env),
+        }
+    finally:
+        await github.stop()
+
+    print(f"{calls} calls, {concurrency} at a time, {latency}s of latency per request")
+    print(f"{'':<24}{'seconds':>9}{'requests':>10}{'tokens':>8}")
+    for name, (elapsed, requests, minted) in results.items():
+        print(f"{name:<24}{elapsed:>9.2f}{requests:>10}{minted:>8}")
+    print(f"{'credential helper':<24}{'seconds':>9}")
+    for name, elapsed in helper.items():
+        print(f"{name:<24}{elapsed:>9.3f}")
+
+
+@click.command()
+@click.option("--calls", default=200, help="API calls per scenario")
+@click.option("--concurrency", default=8)
+@click.option("--latency", default=0.05, help="Seconds added to every response")
+def main(calls, concurrency, latency):
+    asyncio.run(run(calls, concurrency, latency))
+
+
+if __name__ == "__main__":
+    main()
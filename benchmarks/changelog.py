@@ -0,0 +1,117 @@
+"""Compare walking every release range again with the cached release notes engine
+
+Builds a synthetic library with `--releases` tags of `--commits` conventional commits
+each (with `git fast-import`), then replays its history: for every release we build the
+notes of the release itself and of the bump pull requests of `--consumers` consumers
+`--lag` releases behind, as `create_new_release` and the bump fan-out do.
+
+- walk: `git log` of the whole range and parse every commit, every time
+- cached: `tasks.changelog.Changelog`, which only walks the new release range, with
+  and without a commit-graph
+
+We report the wall time and the commits walked in total.
+
+>> python -m benchmarks.changelog --releases 40 --commits 200 --lag 5 --consumers 4
+"""
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+import click
+
+from tasks.changelog import LOG_FORMAT, Changelog, parse_commit
+
+TYPES = ["feat", "fix(api)", "perf", "docs", "chore", "refactor(sun)", "fix!"]
+
+
+def make_library(path, releases, commits):
+    """Repository with `releases` tags, v1.0.0..., of `commits` commits each"""
+    subprocess.run(["git", "init", "-q", "--bare", str(path)], check=True)
+    stream, mark, when = [], 0, 1_600_000_000
+    for release in range(releases):
+        for index in range(commits):
+            mark += 1
+            when += 60
+            message = f"{TYPES[mark % len(TYPES)]}: change {mark}".encode()
+            stream += [
+                b"commit refs/heads/master",
+                f"mark :{mark}".encode(),
+                f"committer bench <bench@photopills.com> {when} +0000".encode(),
+                f"data {len(message)}".encode(),
+                message,
+            ]
+            if mark > 1:
+                stream.append(f"from :{mark - 1}".encode())
+            content = f"{mark}\n".encode()
+            stream += [b"M 644 inline CHANGES", f"data {len(content)}".encode(), content]
+        stream += [f"reset refs/tags/v1.{release}.0".encode(), f"from :{mark}".encode()]
+    subprocess.run(
+        ["git", "fast-import", "--quiet"],
+        input=b"\n".join(stream) + b"\n",
+        cwd=path,
+        check=True,
+    )
+
+
+def walk(path, since, until):
+    output = subprocess.run(
+        ["git", "log", f"--format={LOG_FORMAT}", f"{since}..{until}"],
+        cwd=path,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    records = [record.strip("\n") for record in output.split("\x1e") if record.strip()]
+    return [parse_commit(*record.split("\x1f")) for record in records]
+
+
+def ranges(releases, lag, consumers):
+    """(since, until) of the notes built at every release, release and bumps"""
+    for release in range(1, releases):
+        until = f"v1.{release}.0"
+        yield f"v1.{release - 1}.0", until
+        for _ in range(consumers):
+            yield f"v1.{max(release - lag, 0)}.0", until
+
+
+@click.command()
+@click.option("--releases", default=40)
+@click.option("--commits", default=200, help="Commits per release")
+@click.option("--lag", default=5, help="Releases a consumer is behind")
+@click.option("--consumers", default=4, help="Bump pull requests per release")
+def main(releases, commits, lag, consumers):
+    root = Path(tempfile.mkdtemp(prefix="changelog-bench-"))
+    make_library(root / "library.git", releases, commits)
+    print(
+        f"{releases} releases of {commits} commits, "
+        f"{consumers} consumers {lag} releases behind"
+    )
+
+    start = time.perf_counter()
+    walked = sum(
+        len(walk(root / "library.git", since, until))
+        for since, until in ranges(releases, lag, consumers)
+    )
+    results = {"walk": (time.perf_counter() - start, walked)}
+
+    for graph in (False, True):
+        path = root / f"library-{graph}.git"
+        subprocess.run(["git", "clone", "-q", "--bare", root / "library.git", path])
+        if graph:
+            subprocess.run(["git", "commit-graph", "write", "--reachable"], cwd=path)
+        start = time.perf_counter()
+        changelog = Changelog(path, "library", cache_path=root / f"cache-{graph}")
+        for since, until in ranges(releases, lag, consumers):
+            changelog.notes(since, until)
+        elapsed = time.perf_counter() - start
+        name = f"cached, {'with' if graph else 'no'} commit-graph"
+        results[name] = (elapsed, changelog.walked)
+
+    print(f"{'':<32}{'seconds':>9}{'commits walked':>16}")
+    for name, (seconds, walked) in results.items():
+        print(f"{name:<32}{seconds:>9.2f}{walked:>16}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""Compare a full clone with the minimal clone used for version bumps
+
+The minimal clone is depth-1, single-branch, blobless and only checks out the manifest
+files (see `tasks.bump.minimal_clone`). For each mode we report the wall time and the
+bytes received, measured as the size of the packfiles git wrote.
+
+Run it against a real repository or against a synthetic one built on the fly:
+>> python -m benchmarks.clone https://<token>@github.com/photopills/api
+>> python -m benchmarks.clone --files 2000 --file-size 50000 --commits 20
+"""
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+import click
+from git import Repo as _Repo
+
+from tasks.bump import MANIFEST_FILES, minimal_clone
+
+
+def full_clone(url, path, branch="master"):
+    """What every job does today: a complete clone with the branch checked out"""
+    return _Repo.clone_from(url, path, branch=branch)
+
+
+def pack_size(path):
+    """Bytes received by git, i.e. the size of the packfiles in the clone"""
+    packs = Path(path, ".git", "objects", "pack").glob("*.pack")
+    return sum(pack.stat().st_size for pack in packs)
+
+
+def make_synthetic_repo(path, files, file_size, commits):
+    """Create a bare repo with `commits` commits touching `files` random files"""
+    work = Path(path) / "work"
+    work.mkdir(parents=True)
+    local = _Repo.init(work, initial_branch="master")
+    with local.config_writer() as config:
+        config.set_value("user", "name", "benchmark")
+        config.set_value("user", "email", "benchmark@photopills.com")
+    (work / "pyproject.toml").write_text('[tool.poetry]\nname = "synthetic"\n')
+    (work / "poetry.lock").write_text("# lock\n")
+    for commit in range(commits):
+        for index in range(commit % 4, files, 4):
+            (work / f"src_{index}.bin").write_bytes(os.urandom(file_size))
+        local.git.add("--all")
+        local.git.commit("-m", f"commit {commit}")
+    bare = Path(path) / "origin.git"
+    subprocess.run(["git", "clone", "-q", "--bare", str(work), str(bare)], check=True)
+    # partial clones need the server to accept object filters
+    subprocess.run(["git", "-C", str(bare), "config", "uploadpack.allowFilter", "true"])
+    return f"file://{bare}"
+
+
+def measure(clone, url, path):
+    start = time.perf_counter()
+    clone(url, path)
+    elapsed = time.perf_counter() - start
+    checked_out = [item.name for item in Path(path).iterdir() if item.name != ".git"]
+    return elapsed, pack_size(path), len(checked_out)
+
+
+@click.command()
+@click.argument("url", required=False)
+@click.option("--files", default=500, help="Synthetic repo: number of files")
+@click.option("--file-size", default=20000, help="Synthetic repo: bytes per file")
+@click.option("--commits", default=10, help="Synthetic repo: number of commits")
+@click.option("--rounds", default=3, help="Clones per mode, the best one is reported")
+def main(url, files, file_size, commits, rounds):
+    workdir = Path(tempfile.mkdtemp(prefix="clone-bench-"))
+    try:
+        if url is None:
+            url = make_synthetic_repo(workdir / "source", files, file_size, commits)
+        print(f"Source: {url}")
+        print(f"Manifests: {', '.join(MANIFEST_FILES)}")
+        print(f"{'mode':<10}{'seconds':>10}{'bytes':>14}{'files':>8}")
+        for name, clone in (("full", full_clone), ("minimal", minimal_clone)):
+            results = []
+            for round_ in range(rounds):
+                target = workdir / f"{name}-{round_}"
+                results.append(measure(clone, url, target))
+                shutil.rmtree(target)
+            elapsed, size, checked_out = min(results)
+            print(f"{name:<10}{elapsed:>10.3f}{size:>14}{checked_out:>8}")
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,309 @@
+"""End-to-end benchmark of the release and bump pipelines, fully offline
+
+- GitHub is replaced by `benchmarks.fake_github` (GITHUB_API_URL)
+- origin of every repo is a bare repo on local disk (GITHUB_SERVER_URL=file://...)
+- consumers are synthetic repos of different sizes
+
+For every (repo size, number of consumers) scenario it runs the bump fan-out
+(`update_dependencies`), `create_new_release` and `update_version.main`, and reports the
+time spent in each stage. Results can be saved and compared between runs:
+
+>> python -m benchmarks.e2e --sizes small,large --consumers 1,8 --output before.json
+>> python -m benchmarks.e2e --sizes small,large --consumers 1,8 --compare before.json
+"""
+import asyncio
+import functools
+import inspect
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+
+import click
+
+from .fake_github import FakeGitHub
+
+LIBRARY = "astrolib.py"
+OLD_TAG, NEW_TAG = "v1.0.0", "v1.1.0"
+# files and bytes per file of the synthetic consumers
+SIZES = {"small": (20, 2_000), "medium": (500, 10_000), "large": (2_000, 50_000)}
+
+PYPROJECT = """[tool.poetry]
+name = "{name}"
+version = "0.1.0"
+description = ""
+
+[tool.poetry.dependencies]
+python = "^3.10"
+astrolib = {{git = "https://github.com/photopills/{library}.git", rev = "{tag}"}}
+"""
+
+POETRY_LOCK = f"""[[package]]
+name = "astrolib"
+version = "1.0.0"
+description = ""
+category = "main"
+optional = false
+python-versions = "^3.10"
+develop = false
+
+[package.source]
+type = "git"
+url = "https://github.com/photopills/{LIBRARY}.git"
+reference = "{OLD_TAG}"
+resolved_reference = "{"0" * 40}"
+
+[metadata]
+lock-version = "1.1"
+python-versions = "^3.10"
+content-hash = ""
+
+[metadata.files]
+astrolib = []
+"""
+
+LIBRARY_PYPROJECT = """[tool.poetry]
+name = "astrolib"
+version = "{version}"
+
+[tool.poetry.dependencies]
+python = "^3.10"
+"""
+
+
+class Stages:
+    """Collect the duration of every call to the wrapped functions"""
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+
+    def wrap(self, owner, attribute, stage):
+        """Replace `owner.attribute` with a timed version, return the raw original"""
+        raw = vars(owner)[attribute]
+        original = getattr(owner, attribute)
+        samples = self.samples[stage]
+        if inspect.iscoroutinefunction(original):
+
+            @functools.wraps(original)
+            async def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await original(*args, **kwargs)
+                finally:
+                    samples.append(time.perf_counter() - start)
+
+        else:
+
+            @functools.wraps(original)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return original(*args, **kwargs)
+                finally:
+                    samples.append(time.perf_counter() - start)
+
+        setattr(owner, attribute, wrapper)
+        return raw
+
+    @contextmanager
+    def timing(self, *targets):
+        """Wrap every (owner, attribute, stage) in `targets` while the block runs"""
+        originals = [
+            (owner, attribute, self.wrap(owner, attribute, stage))
+            for owner, attribute, stage in targets
+        ]
+        try:
+            yield self
+        finally:
+            for owner, attribute, original in originals:
+                setattr(owner, attribute, original)
+
+    def summary(self):
+        return {
+            stage: {"calls": len(samples), "total": sum(samples), "max": max(samples)}
+            for stage, samples in self.samples.items()
+            if samples
+        }
+
+
+def git(*args, cwd=None):
+    subprocess.run(["git", *args], cwd=cwd, check=True, capture_output=True)
+
+
+def make_consumer(root, name, files, file_size):
+    """Create photopills/`name` as a bare repo under `root`/remotes"""
+    work = root / "work" / name
+    work.mkdir(parents=True)
+    pyproject = PYPROJECT.format(name=name, library=LIBRARY, tag=OLD_TAG)
+    (work / "pyproject.toml").write_text(pyproject)
+    (work / "poetry.lock").write_text(POETRY_LOCK)
+    for index in range(files):
+        (work / f"module_{index}.py").write_bytes(os.urandom(file_size))
+    git("init", "-q", "-b", "master", cwd=work)
+    git("add", "--all", cwd=work)
+    git("commit", "-q", "-m", "Initial commit", cwd=work)
+    bare = root / "remotes" / "photopills" / name
+    git("clone", "-q", "--bare", str(work), str(bare))
+    git("config", "uploadpack.allowFilter", "true", cwd=bare)
+    shutil.rmtree(work)
+
+
+def make_library(root):
+    """Create photopills/LIBRARY with a few conventional commits per release"""
+    work = root / "work" / LIBRARY
+    work.mkdir(parents=True)
+    git("init", "-q", "-b", "master", cwd=work)
+    for tag in (OLD_TAG, NEW_TAG):
+        for index, subject in enumerate(["feat(sun): add {}", "fix: {} rounding"]):
+            (work / "CHANGES").write_text(f"{tag} {index}\n")
+            git("add", "--all", cwd=work)
+            git("commit", "-q", "-m", subject.format(f"change {tag}.{index}"), cwd=work)
+        git("tag", tag, cwd=work)
+    bare = root / "remotes" / "photopills" / LIBRARY
+    git("clone", "-q", "--bare", str(work), str(bare))
+    shutil.rmtree(work)
+
+
+def seed_github(github):
+    for tag in (OLD_TAG, NEW_TAG):
+        github.add_release(LIBRARY, tag)
+        library_pyproject = LIBRARY_PYPROJECT.format(version=tag[1:])
+        github.files[(LIBRARY, tag, "pyproject.toml")] = library_pyproject
+
+
+async def run_scenario(root, size, consumers, concurrency):
+    from tasks import bump, github as tasks_github, ledger, update_version
+    from git.remote import Remote
+
+    # every scenario bumps its consumers from scratch, without the jobs of the last one
+    for suffix in ("", "-wal", "-shm"):
+        Path(f"{ledger.LEDGER_PATH}{suffix}").unlink(missing_ok=True)
+
+    github = FakeGitHub(remotes=root / "remotes")
+    seed_github(github)
+    os.environ["GITHUB_API_URL"] = await github.start()
+    os.environ["GITHUB_SERVER_URL"] = f"file://{root / 'remotes'}"
+
+    files, file_size = SIZES[size]
+    names = [f"consumer-{index}" for index in range(consumers)]
+    for name in names:
+        make_consumer(root, name, files, file_size)
+    make_library(root)
+
+    stages = Stages()
+    targets = [
+        (bump, "get_last_release_tag", "release_lookup"),
+        (bump.Repo, "clone", "clone"),
+        (Remote, "fetch", "fetch"),
+        (bump, "update_astrolib_version", "manifest"),
+        (bump, "update_lock", "lock"),
+        (bump.Repo, "commit_all_changes", "commit"),
+        (bump.Repo, "push", "push"),
+        (bump, "wait_for_branch", "wait"),
+        (bump, "release_notes", "release_notes"),
+        (bump, "create_pull_request", "pull_request"),
+        (tasks_github, "create_new_release", "create_new_release"),
+        (update_version, "update_version", "update_version"),
+    ]
+    with stages.timing(*targets):
+        start = time.perf_counter()
+        results = await bump.fan_out(
+            LIBRARY, names, concurrency=concurrency, workspace=root / "workspace"
+        )
+        fan_out_time = time.perf_counter() - start
+        failed = [result for result in results if not result["ok"]]
+        if failed:
+            raise click.ClickException(f"Bump failed: {failed}")
+
+        await tasks_github.create_new_release("1.2.0", LIBRARY)
+
+        cwd = os.getcwd()
+        try:
+            for name in names:
+                os.chdir(root / "workspace" / name)
+                update_version.update_version()
+        finally:
+            os.chdir(cwd)
+
+    await github.stop()
+    return {
+        "size": size,
+        "consumers": consumers,
+        "fan_out": fan_out_time,
+        "requests": github.requests,
+        "stages": stages.summary(),
+    }
+
+
+def print_scenario(scenario, previous=None):
+    title = f"{scenario['size']} x {scenario['consumers']} consumers"
+    line = f"{title}: fan-out {scenario['fan_out']:.3f}s, {scenario['requests']} requests"
+    if previous:
+        line += f" (was {previous['fan_out']:.3f}s)"
+    print(line)
+    print(f"  {'stage':<20}{'calls':>6}{'total s':>10}{'max s':>10}{'was s':>10}")
+    for stage, timing in scenario["stages"].items():
+        was = ""
+        if previous and stage in previous["stages"]:
+            was = f"{previous['stages'][stage]['total']:.3f}"
+        print(
+            f"  {stage:<20}{timing['calls']:>6}{timing['total']:>10.3f}"
+            f"{timing['max']:>10.3f}{was:>10}"
+        )
+
+
+@click.command()
+@click.option("--sizes", default="small,medium", help=f"Among {', '.join(SIZES)}")
+@click.option("--consumers", default="1,4", help="Number of consumers per scenario")
+@click.option("--concurrency", default=4, help="Fan-out concurrency")
+@click.option("--output", type=click.Path(), help="Save the results as JSON")
+@click.option("--compare", type=click.Path(exists=True), help="Results of a previous run")
+def main(sizes, consumers, concurrency, output, compare):
+    root = Path(tempfile.mkdtemp(prefix="e2e-bench-"))
+    # everything the tasks persist goes to the temp dir, and commits need an identity
+    os.environ.update(
+        GITHUB_TOKEN="benchmark",
+        GITHUB_CACHE_PATH=str(root / "cache" / "github"),
+        RELEASE_INDEX_PATH=str(root / "cache" / "releases"),
+        CHANGELOG_CACHE_PATH=str(root / "cache" / "changelog"),
+        JOB_LEDGER_PATH=str(root / "cache" / "jobs.sqlite"),
+        GIT_AUTHOR_NAME="benchmark",
+        GIT_AUTHOR_EMAIL="benchmark@photopills.com",
+        GIT_COMMITTER_NAME="benchmark",
+        GIT_COMMITTER_EMAIL="benchmark@photopills.com",
+    )
+    previous = {}
+    if compare:
+        for scenario in json.loads(Path(compare).read_text())["scenarios"]:
+            previous[(scenario["size"], scenario["consumers"])] = scenario
+
+    scenarios = []
+    try:
+        for size in sizes.split(","):
+            for count in map(int, consumers.split(",")):
+                scenario_root = root / f"{size}-{count}"
+                scenario = asyncio.run(
+                    run_scenario(scenario_root, size, count, concurrency)
+                )
+                shutil.rmtree(scenario_root)
+                shutil.rmtree(root / "cache", ignore_errors=True)
+                print_scenario(scenario, previous.get((size, count)))
+                scenarios.append(scenario)
+    finally:
+        shutil.rmtree(root)
+
+    if output:
+        results = {
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "scenarios": scenarios,
+        }
+        Path(output).write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
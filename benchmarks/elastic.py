@@ -0,0 +1,88 @@
+"""Compare the Jaeger index lifecycle run one index at a time and concurrently
+
+Runs `tasks.elastic.lifecycle` against a local `FakeElasticsearch` seeded with `--days`
+days of daily span and service indices, twice on identical clusters:
+
+- serial: one operation at a time and one index per snapshot, as done by hand today
+- concurrent: `--concurrency` operations at a time, `--batch` indices per snapshot
+
+Every run snapshots everything older than a day and deletes what's older than
+`--delete-after` days. We report the wall time, the requests made, and check that
+every deleted index is in a successful snapshot.
+
+>> python -m benchmarks.elastic --days 30 --reject-every 25
+"""
+import asyncio
+import time
+
+import click
+
+from benchmarks.fake_elasticsearch import FakeElasticsearch, seed
+from tasks.elastic import lifecycle
+
+
+async def scenario(days, delete_after, concurrency, batch, poll, reject_every):
+    elasticsearch = FakeElasticsearch(reject_every=reject_every)
+    seed(elasticsearch, days)
+    before = set(elasticsearch.indices)
+    url = await elasticsearch.start()
+    try:
+        start = time.perf_counter()
+        steps, requests = await lifecycle(
+            url,
+            "s3",
+            concurrency=concurrency,
+            max_snapshots=elasticsearch.max_snapshots,
+            poll=poll,
+            rollover_age="1d",
+            delete_after=delete_after,
+            batch=batch,
+        )
+        elapsed = time.perf_counter() - start
+    finally:
+        await elasticsearch.stop()
+    deleted = before - set(elasticsearch.indices)
+    snapshotted = {
+        index
+        for name in elasticsearch.snapshots
+        if elasticsearch.snapshot_status(name)["state"] == "SUCCESS"
+        for index in elasticsearch.snapshots[name]["indices"]
+    }
+    unsafe = deleted - snapshotted
+    assert not unsafe, f"deleted without a snapshot: {sorted(unsafe)}"
+    return {
+        "seconds": elapsed,
+        "requests": requests,
+        "steps": len(steps),
+        "snapshots": len(elasticsearch.snapshots),
+        "deleted": len(deleted),
+    }
+
+
+@click.command()
+@click.option("--days", default=30, help="Days of daily indices")
+@click.option("--delete-after", default=14.0, help="Days to keep the indices")
+@click.option("--concurrency", default=4)
+@click.option("--batch", default=20, help="Indices per snapshot")
+@click.option("--poll", default=0.05, help="Seconds between task/status polls")
+@click.option("--reject-every", default=0, help="Every n-th request gets a 429")
+def main(days, delete_after, concurrency, batch, poll, reject_every):
+    runs = {
+        "serial": (1, 1),
+        "concurrent": (concurrency, batch),
+    }
+    print(f"{days} days of indices, deleting after {delete_after} days")
+    print(f"{'run':<12}{'seconds':>9}{'requests':>10}{'steps':>7}{'snapshots':>11}")
+    for name, (run_concurrency, run_batch) in runs.items():
+        result = asyncio.run(
+            scenario(days, delete_after, run_concurrency, run_batch, poll, reject_every)
+        )
+        print(
+            f"{name:<12}{result['seconds']:>9.2f}{result['requests']:>10}"
+            f"{result['steps']:>7}{result['snapshots']:>11}"
+            f"  ({result['deleted']} deleted)"
+        )
+
+
+if __name__ == "__main__":
+    main()
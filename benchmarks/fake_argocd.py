@@ -0,0 +1,153 @@
+"""Fake argocd and kubectl CLIs for `tasks.rollout`
+
+Stands in for the few commands `ArgoCDCLI` runs, with the apps of the scenario in
+$FAKE_ARGOCD_DIR/scenario.json:
+
+    {"latency": 0.1, "watch_close": 0,
+     "apps": {"api": {"sync_time": 1, "ready_time": 3, "fail": null}, ...}}
+
+- `argocd app sync NAME --async [--revision REV]` records the sync in the directory, or
+  fails like argocd while the operation of the last sync runs (write a NAME.sync file,
+  see `State.record_sync`, to start an automated sync)
+- `argocd app get NAME -o json` / `argocd app list -o json` print the Applications
+- `kubectl get applications.argoproj.io --watch -o json` prints every Application, then
+  each one again when it changes; it exits after `watch_close` seconds, if set, like the
+  API server closing a watch
+
+After its sync, an app runs its operation for `sync_time` seconds, then is Progressing
+until `ready_time` seconds, then Healthy. `fail` is "sync" for a failed operation or
+"degraded" for a Degraded app. Every argocd command takes `latency` seconds, for the
+start of the CLI and its gRPC handshake.
+
+>> FAKE_ARGOCD_DIR=/tmp/argocd python -m benchmarks.fake_argocd argocd app get api -o json
+"""
+import json
+import os
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+PREVIOUS = "2000-01-01T00:00:00Z"
+
+
+def timestamp(seconds):
+    return datetime.fromtimestamp(seconds, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def application(name, spec, sync, now):
+    """Application resource of `name` at `now`, `sync` is its recorded sync if any"""
+    status = {
+        "sync": {"status": "OutOfSync", "revision": "previous"},
+        "health": {"status": "Healthy"},
+        "operationState": {"phase": "Succeeded", "startedAt": PREVIOUS},
+        "resources": [],
+    }
+    if sync is not None:
+        elapsed = now - sync["at"]
+        operation = status["operationState"]
+        # sub-second start so that two syncs of the same second differ
+        operation["startedAt"] = f"{timestamp(sync['at'])}#{sync['at']}"
+        if elapsed < spec["sync_time"]:
+            operation["phase"] = "Running"
+        elif spec.get("fail") == "sync":
+            operation["phase"] = "Failed"
+            operation["message"] = "one or more objects failed to apply"
+        else:
+            status["sync"] = {"status": "Synced", "revision": sync["revision"]}
+            deployment = {"kind": "Deployment", "name": name, "health": {}}
+            if elapsed < spec["ready_time"]:
+                status["health"] = {"status": "Progressing"}
+                deployment["health"]["status"] = "Progressing"
+            elif spec.get("fail") == "degraded":
+                message = f'Deployment "{name}" exceeded its progress deadline'
+                status["health"] = {"status": "Degraded", "message": message}
+                deployment["health"] = {"status": "Degraded", "message": message}
+            else:
+                deployment["health"]["status"] = "Healthy"
+            status["resources"].append(deployment)
+    return {
+        "apiVersion": "argoproj.io/v1alpha1",
+        "kind": "Application",
+        "metadata": {"name": name, "namespace": "argocd"},
+        "status": status,
+    }
+
+
+class State:
+    def __init__(self, root):
+        self.root = Path(root)
+        self.scenario = json.loads((self.root / "scenario.json").read_text())
+
+    def sync(self, name):
+        path = self.root / f"{name}.sync"
+        return json.loads(path.read_text()) if path.exists() else None
+
+    def record_sync(self, name, revision):
+        data = json.dumps({"at": time.time(), "revision": revision or "HEAD"})
+        temporary = self.root / f".{name}.sync"
+        temporary.write_text(data)
+        os.replace(temporary, self.root / f"{name}.sync")
+
+    def applications(self):
+        now = time.time()
+        return [
+            application(name, spec, self.sync(name), now)
+            for name, spec in self.scenario["apps"].items()
+        ]
+
+
+def argocd(state, args):
+    time.sleep(state.scenario.get("latency", 0.1))
+    command, rest = args[:2], args[2:]
+    if command == ["app", "sync"]:
+        name = rest[0]
+        if name not in state.scenario["apps"]:
+            sys.exit(f"application {name} not found")
+        revision = rest[rest.index("--revision") + 1] if "--revision" in rest else None
+        running = state.sync(name)
+        sync_time = state.scenario["apps"][name]["sync_time"]
+        if running and time.time() - running["at"] < sync_time:
+            sys.exit(
+                "FATA[0000] rpc error: code = FailedPrecondition desc = "
+                "another operation is already in progress"
+            )
+        state.record_sync(name, revision)
+        print(f"Name: {name}\nOperation: Sync")
+    elif command == ["app", "get"]:
+        applications = state.applications()
+        found = [app for app in applications if app["metadata"]["name"] == rest[0]]
+        if not found:
+            sys.exit(f"application {rest[0]} not found")
+        print(json.dumps(found[0], indent=4))
+    elif command == ["app", "list"]:
+        print(json.dumps(state.applications(), indent=4))
+    else:
+        sys.exit(f"unknown command {' '.join(args)}")
+
+
+def kubectl_watch(state):
+    close = state.scenario.get("watch_close", 0)
+    start = time.time()
+    last = {}
+    while not close or time.time() - start < close:
+        for app in state.applications():
+            text = json.dumps(app, indent=4)
+            if last.get(app["metadata"]["name"]) != text:
+                last[app["metadata"]["name"]] = text
+                print(text, flush=True)
+        time.sleep(0.02)
+
+
+def main(args):
+    state = State(os.environ["FAKE_ARGOCD_DIR"])
+    if args[0] == "argocd":
+        argocd(state, args[1:])
+    elif args[0] == "kubectl" and "--watch" in args:
+        kubectl_watch(state)
+    else:
+        sys.exit(f"unknown command {' '.join(args)}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
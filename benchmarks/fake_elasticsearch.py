@@ -0,0 +1,290 @@
+"""Local stand-in for the Elasticsearch endpoints used by `tasks.elastic`
+
+Implements `_cat/indices` and `_cat/aliases`, rollover, asynchronous force merges (with
+their `_tasks`), snapshots (create, status, list) and index deletion, with simulated
+durations:
+
+- force merges queue on a single force_merge thread, like on a one node cluster, and
+  take `merge_time` seconds per GB
+- every snapshot costs `snapshot_overhead` seconds (cluster state updates, repository
+  metadata) plus `snapshot_time` seconds per GB; more than `max_snapshots` running at
+  once are refused with concurrent_snapshot_execution_exception
+- every `reject_every`-th request is rejected with a 429 es_rejected_execution_exception
+
+>> python -m benchmarks.fake_elasticsearch --port 9200 --indices 30
+"""
+import asyncio
+import fnmatch
+import itertools
+import re
+import time
+
+import click
+from aiohttp import web
+
+GB = 1024**3
+DAY = 24 * 3600
+AGE = re.compile(r"^(\d+)([smhd])$")
+SECONDS = {"s": 1, "m": 60, "h": 3600, "d": DAY}
+
+
+def error(status, type_, reason=""):
+    body = {"error": {"type": type_, "reason": reason}, "status": status}
+    return web.json_response(body, status=status)
+
+
+class FakeElasticsearch:
+    def __init__(
+        self,
+        latency=0.0,
+        merge_time=0.2,
+        snapshot_overhead=0.5,
+        snapshot_time=0.05,
+        max_snapshots=3,
+        reject_every=0,
+    ):
+        self.latency = latency
+        self.merge_time = merge_time
+        self.snapshot_overhead = snapshot_overhead
+        self.snapshot_time = snapshot_time
+        self.max_snapshots = max_snapshots
+        self.reject_every = reject_every
+        # name -> {created, size, segments, pri, rep}
+        self.indices = {}
+        self.aliases = {}
+        # name -> {indices, started, done_at}
+        self.snapshots = {}
+        # id -> {action, index, done_at}
+        self.tasks = {}
+        self.task_ids = itertools.count(1)
+        self.merge_free_at = 0.0
+        self.requests = 0
+        self._runner = None
+
+    def add_index(self, name, created, size, segments=20, pri=1, rep=0):
+        self.indices[name] = {
+            "created": created,
+            "size": size,
+            "segments": segments,
+            "pri": pri,
+            "rep": rep,
+        }
+
+    def matching(self, pattern, names):
+        patterns = pattern.split(",")
+        return [
+            name
+            for name in names
+            if any(fnmatch.fnmatch(name, item) for item in patterns)
+        ]
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.reject_every and self.requests % self.reject_every == 0:
+            return error(429, "es_rejected_execution_exception", "queue is full")
+        return await handler(request)
+
+    def complete_tasks(self):
+        now = time.time()
+        for task in self.tasks.values():
+            if not task["completed"] and task["done_at"] <= now:
+                task["completed"] = True
+                index = self.indices.get(task["index"])
+                if index is not None:
+                    index["segments"] = index["pri"] * (index["rep"] + 1)
+
+    def running_snapshots(self):
+        now = time.time()
+        return [
+            name for name, snapshot in self.snapshots.items() if snapshot["done_at"] > now
+        ]
+
+    async def cat_indices(self, request):
+        rows = []
+        for name in self.matching(request.match_info["pattern"], self.indices):
+            index = self.indices[name]
+            rows.append(
+                {
+                    "index": name,
+                    "pri": str(index["pri"]),
+                    "rep": str(index["rep"]),
+                    "docs.count": str(index["size"] // 1000),
+                    "store.size": str(index["size"]),
+                    "creation.date": str(int(index["created"] * 1000)),
+                    "segments.count": str(index["segments"]),
+                }
+            )
+        return web.json_response(rows)
+
+    async def cat_aliases(self, request):
+        aliases = self.matching(request.match_info["pattern"], self.aliases)
+        return web.json_response(
+            [
+                {"alias": alias, "index": self.aliases[alias], "is_write_index": "true"}
+                for alias in aliases
+            ]
+        )
+
+    async def rollover(self, request):
+        alias = request.match_info["alias"]
+        if alias not in self.aliases:
+            return error(404, "index_not_found_exception", alias)
+        conditions = (await request.json()).get("conditions", {})
+        old = self.aliases[alias]
+        match = AGE.match(conditions.get("max_age", "0s"))
+        max_age = int(match.group(1)) * SECONDS[match.group(2)]
+        if time.time() - self.indices[old]["created"] < max_age:
+            return web.json_response({"rolled_over": False, "old_index": old})
+        prefix, number = old.rsplit("-", 1)
+        new = f"{prefix}-{int(number) + 1:06d}"
+        self.add_index(new, time.time(), 0, segments=0)
+        self.aliases[alias] = new
+        return web.json_response(
+            {"rolled_over": True, "old_index": old, "new_index": new}
+        )
+
+    async def forcemerge(self, request):
+        name = request.match_info["index"]
+        if name not in self.indices:
+            return error(404, "index_not_found_exception", name)
+        duration = self.merge_time * self.indices[name]["size"] / GB
+        # the single force_merge thread runs them one after the other
+        done_at = max(time.time(), self.merge_free_at) + duration
+        self.merge_free_at = done_at
+        task_id = f"node-1:{next(self.task_ids)}"
+        self.tasks[task_id] = {
+            "action": "indices:admin/forcemerge",
+            "index": name,
+            "done_at": done_at,
+            "completed": False,
+        }
+        return web.json_response({"task": task_id})
+
+    async def list_tasks(self, request):
+        self.complete_tasks()
+        pattern = request.query.get("actions", "*")
+        running = {
+            task_id: {"action": task["action"]}
+            for task_id, task in self.tasks.items()
+            if not task["completed"] and fnmatch.fnmatch(task["action"], pattern)
+        }
+        return web.json_response({"nodes": {"node-1": {"tasks": running}}})
+
+    async def get_task(self, request):
+        self.complete_tasks()
+        task = self.tasks.get(request.match_info["task_id"])
+        if task is None:
+            return error(404, "resource_not_found_exception")
+        return web.json_response({"completed": task["completed"], "task": task})
+
+    async def pending_tasks(self, request):
+        return web.json_response({"tasks": []})
+
+    def snapshot_status(self, name):
+        snapshot = self.snapshots[name]
+        total = len(snapshot["indices"])
+        if snapshot["done_at"] <= time.time():
+            state, done = "SUCCESS", total
+        else:
+            state, done = "STARTED", 0
+        return {
+            "snapshot": name,
+            "state": state,
+            "indices": snapshot["indices"],
+            "shards_stats": {"done": done, "total": total},
+        }
+
+    async def running_status(self, request):
+        statuses = [self.snapshot_status(name) for name in self.running_snapshots()]
+        return web.json_response({"snapshots": statuses})
+
+    async def list_snapshots(self, request):
+        snapshots = [self.snapshot_status(name) for name in self.snapshots]
+        return web.json_response({"snapshots": snapshots})
+
+    async def create_snapshot(self, request):
+        name = request.match_info["name"]
+        if name in self.snapshots:
+            return error(400, "invalid_snapshot_name_exception", "already exists")
+        if len(self.running_snapshots()) >= self.max_snapshots:
+            return error(503, "concurrent_snapshot_execution_exception")
+        body = await request.json()
+        indices = self.matching(body["indices"], self.indices)
+        size = sum(self.indices[index]["size"] for index in indices)
+        duration = self.snapshot_overhead + self.snapshot_time * size / GB
+        self.snapshots[name] = {"indices": indices, "done_at": time.time() + duration}
+        return web.json_response({"accepted": True})
+
+    async def get_snapshot_status(self, request):
+        name = request.match_info["name"]
+        if name not in self.snapshots:
+            return error(404, "snapshot_missing_exception", name)
+        return web.json_response({"snapshots": [self.snapshot_status(name)]})
+
+    async def delete_indices(self, request):
+        names = request.match_info["indices"].split(",")
+        missing = [name for name in names if name not in self.indices]
+        if missing:
+            return error(404, "index_not_found_exception", ",".join(missing))
+        for name in names:
+            del self.indices[name]
+        return web.json_response({"acknowledged": True})
+
+    def app(self):
+        app = web.Application(middlewares=[self.middleware])
+        router = app.router
+        router.add_get("/_cat/indices/{pattern}", self.cat_indices)
+        router.add_get("/_cat/aliases/{pattern}", self.cat_aliases)
+        router.add_get("/_tasks", self.list_tasks)
+        router.add_get("/_tasks/{task_id}", self.get_task)
+        router.add_get("/_cluster/pending_tasks", self.pending_tasks)
+        router.add_get("/_snapshot/_status", self.running_status)
+        router.add_get("/_snapshot/{repo}/_all", self.list_snapshots)
+        router.add_get("/_snapshot/{repo}/{name}/_status", self.get_snapshot_status)
+        router.add_put("/_snapshot/{repo}/{name}", self.create_snapshot)
+        router.add_post("/{alias}/_rollover", self.rollover)
+        router.add_post("/{index}/_forcemerge", self.forcemerge)
+        router.add_delete("/{indices}", self.delete_indices)
+        return app
+
+    async def start(self, host="127.0.0.1", port=0):
+        self._runner = web.AppRunner(self.app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+
+def seed(elasticsearch, days=30, size=2 * GB):
+    """Daily span and service indices of the last `days` days, the newest with a
+    rollover alias too"""
+    now = time.time()
+    for day in range(days):
+        created = now - (days - day) * DAY + 60
+        date = time.strftime("%Y-%m-%d", time.gmtime(created))
+        elasticsearch.add_index(f"jaeger-span-{date}", created, size)
+        elasticsearch.add_index(f"jaeger-service-{date}", created, size // 100)
+    elasticsearch.add_index("jaeger-dependencies-000001", now - 2 * DAY, GB // 10)
+    elasticsearch.aliases["jaeger-dependencies-write"] = "jaeger-dependencies-000001"
+
+
+@click.command()
+@click.option("--host", default="127.0.0.1")
+@click.option("--port", default=9200)
+@click.option("--indices", default=30, help="Days of daily indices to create")
+@click.option("--reject-every", default=0, help="Every n-th request gets a 429")
+def main(host, port, indices, reject_every):
+    elasticsearch = FakeElasticsearch(reject_every=reject_every)
+    seed(elasticsearch, indices)
+    web.run_app(elasticsearch.app(), host=host, port=port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,385 @@
+"""Local stand-in for the GitHub REST endpoints used by `tasks`
+
+Implements releases (list, latest, create), pull requests (with labels and reviewers),
+branches, the contents and commits endpoints read by the lock patcher and the GraphQL
+queries and mutations of `tasks.graphql`, with configurable latency,
+rate limits (primary window and secondary limit responses) and rate-limit headers.
+Point the tasks to it with GITHUB_API_URL.
+
+Every credential has a rate limit of its own. With the public key of a GitHub App
+(`app_key`), the app endpoints of `tasks.auth` check its JWTs and issue installation
+tokens, valid for `token_ttl` seconds, that have a rate limit of `app_rate_limit`.
+
+Branches are looked up in the bare repos under `remotes` (<remotes>/<owner>/<repo>),
+the directory GITHUB_SERVER_URL points to; without it every branch exists.
+
+>> python -m benchmarks.fake_github --port 8080 --latency 0.05
+"""
+import asyncio
+import base64
+import hashlib
+import re
+import time
+import uuid
+from collections import defaultdict
+from pathlib import Path
+
+import click
+import jwt
+from aiohttp import web
+
+PER_PAGE = 30
+LABELS = ["dependencies", "automated"]
+INSTALLATION_ID = 1
+# top level `alias: field(arguments)` of the GraphQL documents sent by tasks.graphql
+GRAPHQL_FIELD = re.compile(r"^(\w+): (\w+)\((.*?)\)", re.MULTILINE)
+GRAPHQL_ARGUMENT = re.compile(r"(\w+): \$(\w+)")
+
+
+class FakeGitHub:
+    def __init__(
+        self,
+        latency=0.0,
+        rate_limit=5000,
+        remotes=None,
+        window=3600,
+        secondary_every=0,
+        app_key=None,
+        app_rate_limit=12500,
+        token_ttl=3600,
+    ):
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.window = window
+        # credential -> [remaining, reset]
+        self.buckets = {}
+        # answer every n-th request with a secondary rate limit error, 0 never
+        self.secondary_every = secondary_every
+        self.releases = defaultdict(list)
+        self.pulls = defaultdict(list)
+        # (repo, ref, path) -> file content
+        self.files = {}
+        self.remotes = remotes
+        self.requests = 0
+        self.app_key = app_key
+        self.app_rate_limit = app_rate_limit
+        self.token_ttl = token_ttl
+        # installation token -> expiry
+        self.installation_tokens = {}
+        self.base_url = None
+        self._runner = None
+
+    def add_release(self, repo, tag, prerelease=False, draft=False):
+        releases = self.releases[repo]
+        published_at = time.strftime(
+            "%Y-%m-%dT%H:%M:%SZ", time.gmtime(1600000000 + len(releases) * 60)
+        )
+        release = {
+            "id": len(releases) + 1,
+            "tag_name": tag,
+            "name": f"{tag} release",
+            "draft": draft,
+            "prerelease": prerelease,
+            # drafts aren't published
+            "published_at": None if draft else published_at,
+        }
+        # GitHub lists the newest release first
+        releases.insert(0, release)
+        return release
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        credential = request.headers.get("Authorization", "")
+        limit = self.rate_limit
+        if credential.startswith("token ghs_"):
+            expires = self.installation_tokens.get(credential[len("token ") :], 0)
+            if expires <= time.time():
+                return web.json_response({"message": "Bad credentials"}, status=401)
+            limit = self.app_rate_limit
+        reset = int(time.time()) + self.window
+        bucket = self.buckets.setdefault(credential, [limit, reset])
+        if time.time() >= bucket[1]:
+            bucket[:] = [limit, int(time.time()) + self.window]
+        if self.secondary_every and self.requests % self.secondary_every == 0:
+            return web.json_response(
+                {"message": "You have exceeded a secondary rate limit"},
+                status=403,
+                headers={"Retry-After": "1"},
+            )
+        headers = {
+            "X-RateLimit-Limit": str(limit),
+            "X-RateLimit-Remaining": str(max(bucket[0] - 1, 0)),
+            "X-RateLimit-Reset": str(int(bucket[1])),
+        }
+        if bucket[0] <= 0:
+            return web.json_response(
+                {"message": "API rate limit exceeded"}, status=403, headers=headers
+            )
+        bucket[0] -= 1
+        response = await handler(request)
+        response.headers.update(headers)
+        return response
+
+    def check_jwt(self, request):
+        """Claims of the app JWT of `request`, raises a 401 when it isn't valid"""
+        scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+        try:
+            if self.app_key is None or scheme.lower() != "bearer":
+                raise jwt.InvalidTokenError("no JWT")
+            claims = jwt.decode(token, self.app_key, algorithms=["RS256"])
+            if claims["exp"] - claims["iat"] > 600:
+                raise jwt.InvalidTokenError("too long")
+        except (jwt.InvalidTokenError, KeyError) as error:
+            message = f"A JSON web token could not be decoded: {error}"
+            raise web.HTTPUnauthorized(text=message)
+        return claims
+
+    async def installation(self, request):
+        self.check_jwt(request)
+        org = request.match_info["org"]
+        return web.json_response({"id": INSTALLATION_ID, "account": {"login": org}})
+
+    async def access_token(self, request):
+        self.check_jwt(request)
+        if int(request.match_info["id"]) != INSTALLATION_ID:
+            return web.json_response({"message": "Not Found"}, status=404)
+        token = f"ghs_{uuid.uuid4().hex}"
+        expires = int(time.time()) + self.token_ttl
+        self.installation_tokens[token] = expires
+        expires_at = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(expires))
+        return web.json_response({"token": token, "expires_at": expires_at}, status=201)
+
+    def repo(self, request):
+        return request.match_info["repo"]
+
+    async def list_releases(self, request):
+        releases = self.releases[self.repo(request)]
+        page = int(request.query.get("page", 1))
+        headers = {}
+        if page * PER_PAGE < len(releases):
+            next_url = request.url.with_query(page=page + 1)
+            headers["Link"] = f'<{next_url}>; rel="next"'
+        chunk = releases[(page - 1) * PER_PAGE : page * PER_PAGE]
+        return web.json_response(chunk, headers=headers)
+
+    async def latest_release(self, request):
+        for release in self.releases[self.repo(request)]:
+            if not release["prerelease"] and not release["draft"]:
+                return web.json_response(release)
+        return web.json_response({"message": "Not Found"}, status=404)
+
+    async def create_release(self, request):
+        data = await request.json()
+        release = self.add_release(self.repo(request), data["tag_name"])
+        return web.json_response(release, status=201)
+
+    async def create_pull(self, request):
+        data = await request.json()
+        pulls = self.pulls[self.repo(request)]
+        number = len(pulls) + 1
+        pull = dict(data, number=number, html_url=f"{self.base_url}/pull/{number}")
+        pull.update(labels=[], reviewers=[])
+        pulls.append(pull)
+        return web.json_response(pull, status=201)
+
+    def pull(self, request):
+        return self.pulls[self.repo(request)][int(request.match_info["number"]) - 1]
+
+    def pull_json(self, pull):
+        """REST representation of a pull request, whichever API created it"""
+        return {
+            "number": pull["number"],
+            "html_url": pull.get("html_url") or pull["url"],
+            "title": pull["title"],
+            "body": pull["body"],
+            "state": "open",
+            "head": {"ref": pull["head"]},
+            "base": {"ref": pull["base"]},
+        }
+
+    async def list_pulls(self, request):
+        # every pull request stays open, the fake doesn't merge them
+        pulls = self.pulls[self.repo(request)]
+        return web.json_response([self.pull_json(pull) for pull in pulls])
+
+    async def update_pull(self, request):
+        pull = self.pull(request)
+        data = await request.json()
+        pull.update({key: data[key] for key in ("title", "body") if key in data})
+        return web.json_response(self.pull_json(pull))
+
+    async def add_labels(self, request):
+        pull = self.pull(request)
+        pull["labels"].extend((await request.json())["labels"])
+        return web.json_response([{"name": name} for name in pull["labels"]])
+
+    async def request_reviewers(self, request):
+        pull = self.pull(request)
+        pull["reviewers"].extend((await request.json())["reviewers"])
+        return web.json_response(pull, status=201)
+
+    def resolve(self, field, arguments):
+        """Answer one top level GraphQL field"""
+        if field == "repository":
+            name = arguments["name"]
+            releases = [
+                {
+                    "tagName": release["tag_name"],
+                    "publishedAt": release["published_at"],
+                    "isPrerelease": release["prerelease"],
+                    "isDraft": release["draft"],
+                }
+                for release in self.releases[name]
+            ]
+            stable = [
+                release
+                for release in releases
+                if not release["isPrerelease"] and not release["isDraft"]
+            ]
+            labels = [{"id": f"L_{name}_{label}", "name": label} for label in LABELS]
+            return {
+                "id": f"R_{name}",
+                "releases": {"nodes": releases[:10]},
+                "latestRelease": stable[0] if stable else None,
+                "labels": {"nodes": labels},
+            }
+        if field == "user":
+            return {"id": f"U_{arguments['login']}"}
+
+        data = arguments["input"]
+        if field == "createPullRequest":
+            repo = data["repositoryId"][len("R_") :]
+            pulls = self.pulls[repo]
+            number = len(pulls) + 1
+            pull = {
+                "id": f"PR_{repo}_{number}",
+                "number": number,
+                "url": f"{self.base_url}/pull/{number}",
+                "head": data["headRefName"],
+                "base": data["baseRefName"],
+                "title": data["title"],
+                "body": data["body"],
+                "labels": [],
+                "reviewers": [],
+            }
+            pulls.append(pull)
+            return {"pullRequest": pull}
+        node_id = data.get("labelableId") or data.get("pullRequestId")
+        _, repo, number = node_id.rsplit("_", 2)
+        pull = self.pulls[repo][int(number) - 1]
+        if field == "addLabelsToLabelable":
+            pull["labels"].extend(label.rsplit("_", 1)[1] for label in data["labelIds"])
+        elif field == "requestReviews":
+            pull["reviewers"].extend(user[len("U_") :] for user in data["userIds"])
+        else:
+            raise LookupError(f"Unknown field {field}")
+        return {"clientMutationId": None}
+
+    async def graphql(self, request):
+        payload = await request.json()
+        variables = payload.get("variables", {})
+        data, errors = {}, []
+        for alias, field, arguments in GRAPHQL_FIELD.findall(payload["query"]):
+            arguments = {
+                name: variables[variable]
+                for name, variable in GRAPHQL_ARGUMENT.findall(arguments)
+            }
+            try:
+                data[alias] = self.resolve(field, arguments)
+            except LookupError as exc:
+                data[alias] = None
+                errors.append({"path": [alias], "message": str(exc)})
+        response = {"data": data}
+        if errors:
+            response["errors"] = errors
+        return web.json_response(response)
+
+    async def branch(self, request):
+        branch = request.match_info["branch"]
+        if self.remotes is not None:
+            owner, repo = request.match_info["owner"], self.repo(request)
+            process = await asyncio.create_subprocess_exec(
+                "git",
+                "rev-parse",
+                "--verify",
+                "--quiet",
+                f"refs/heads/{branch}",
+                cwd=Path(self.remotes) / owner / repo,
+                stdout=asyncio.subprocess.DEVNULL,
+            )
+            if await process.wait() != 0:
+                return web.json_response({"message": "Branch not found"}, status=404)
+        return web.json_response({"name": branch})
+
+    async def contents(self, request):
+        key = (self.repo(request), request.query.get("ref"), request.match_info["path"])
+        if key not in self.files:
+            return web.json_response({"message": "Not Found"}, status=404)
+        content = base64.b64encode(self.files[key].encode()).decode()
+        return web.json_response({"encoding": "base64", "content": content})
+
+    async def commit(self, request):
+        sha = hashlib.sha1(request.match_info["ref"].encode()).hexdigest()
+        return web.json_response({"sha": sha})
+
+    def app(self):
+        app = web.Application(middlewares=[self.middleware])
+        prefix = "/repos/{owner}/{repo}"
+        app.router.add_get(f"{prefix}/releases", self.list_releases)
+        app.router.add_get(f"{prefix}/releases/latest", self.latest_release)
+        app.router.add_post(f"{prefix}/releases", self.create_release)
+        app.router.add_get(f"{prefix}/pulls", self.list_pulls)
+        app.router.add_post(f"{prefix}/pulls", self.create_pull)
+        app.router.add_patch(f"{prefix}/pulls/{{number}}", self.update_pull)
+        app.router.add_post(f"{prefix}/issues/{{number}}/labels", self.add_labels)
+        app.router.add_post(
+            f"{prefix}/pulls/{{number}}/requested_reviewers", self.request_reviewers
+        )
+        app.router.add_post("/graphql", self.graphql)
+        app.router.add_get(f"{prefix}/branches/{{branch:.+}}", self.branch)
+        app.router.add_get(f"{prefix}/contents/{{path:.+}}", self.contents)
+        app.router.add_get(f"{prefix}/commits/{{ref}}", self.commit)
+        app.router.add_get("/orgs/{org}/installation", self.installation)
+        app.router.add_post("/app/installations/{id}/access_tokens", self.access_token)
+        return app
+
+    async def start(self, host="127.0.0.1", port=0):
+        self._runner = web.AppRunner(self.app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://{host}:{port}"
+        return self.base_url
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+
+@click.command()
+@click.option("--host", default="127.0.0.1")
+@click.option("--port", default=8080)
+@click.option("--latency", default=0.0, help="Seconds added to every response")
+@click.option("--rate-limit", default=5000, help="Requests allowed before 403s")
+@click.option("--window", default=3600, help="Seconds until the rate limit is reset")
+@click.option("--secondary-every", default=0, help="Every n-th request is limited")
+@click.option("--remotes", type=click.Path(exists=True), help="Directory of bare repos")
+@click.option("--app-key", type=click.File(), help="Public key of the GitHub App")
+def main(host, port, latency, rate_limit, window, secondary_every, remotes, app_key):
+    github = FakeGitHub(
+        latency=latency,
+        rate_limit=rate_limit,
+        remotes=remotes,
+        window=window,
+        secondary_every=secondary_every,
+        app_key=app_key.read() if app_key else None,
+    )
+    github.base_url = f"http://{host}:{port}"
+    web.run_app(github.app(), host=host, port=port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""Compare watching a rollout with one multiplexed watch and with per-app polling
+
+Both run against the fake argocd/kubectl CLIs of `benchmarks.fake_argocd`, with `--apps`
+apps that get healthy between 1 and 3 seconds after their sync:
+
+- watch: `tasks.rollout.watch_rollout`, one `kubectl get --watch` for every app
+- poll: every app polled with `argocd app get` every `--interval` seconds, as when
+  watching each app by hand (or with `argocd app wait` per app)
+
+In the "healthy" scenario all the apps end healthy, in "degraded" the first app
+degrades early. We report the wall time until the outcome is known and the CLI
+processes started.
+
+>> python -m benchmarks.rollout --apps 8 --interval 2 --latency 0.2
+"""
+import asyncio
+import json
+import shlex
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import click
+
+from tasks.rollout import (
+    DEGRADED,
+    FAILED,
+    HEALTHY,
+    ArgoCDCLI,
+    Rollout,
+    app_status,
+    watch_rollout,
+)
+
+FAKE = f"{shlex.quote(sys.executable)} -m benchmarks.fake_argocd"
+
+
+def scenario(root, apps, latency, degraded):
+    specs = {}
+    for index in range(apps):
+        ready = 1 + 2 * index / max(apps - 1, 1)
+        specs[f"app-{index}"] = {"sync_time": ready / 3, "ready_time": ready}
+    if degraded:
+        specs["app-0"]["fail"] = "degraded"
+    data = {"latency": latency, "apps": specs}
+    (Path(root) / "scenario.json").write_text(json.dumps(data))
+    return list(specs)
+
+
+def backend(root):
+    return ArgoCDCLI(
+        f"env FAKE_ARGOCD_DIR={root} {FAKE} argocd",
+        f"env FAKE_ARGOCD_DIR={root} {FAKE} kubectl",
+    )
+
+
+async def poll_rollout(backend, apps, revision, interval):
+    """Sync every app, then poll each one until they're all healthy or one isn't"""
+    rollout = Rollout(apps, revision)
+    for app, resource in zip(apps, await asyncio.gather(*map(backend.get, apps))):
+        rollout.baseline[app] = app_status(resource)["started"]
+    await asyncio.gather(*(backend.sync(app, revision) for app in apps))
+    rollout.requested.update(apps)
+
+    async def poll(app):
+        while rollout.state(app) != HEALTHY:
+            rollout.statuses[app] = app_status(await backend.get(app))
+            if rollout.state(app) in (DEGRADED, FAILED):
+                return
+            await asyncio.sleep(interval)
+
+    tasks = [asyncio.create_task(poll(app)) for app in apps]
+    while not rollout.done():
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return rollout
+
+
+async def run(strategy, apps, latency, degraded, interval):
+    with tempfile.TemporaryDirectory(prefix="rollout-bench-") as root:
+        names = scenario(root, apps, latency, degraded)
+        client = backend(root)
+        start = time.perf_counter()
+        if strategy == "watch":
+            rollout = await watch_rollout(client, names, "abc123", timeout=60)
+        else:
+            rollout = await poll_rollout(client, names, "abc123", interval)
+        elapsed = time.perf_counter() - start
+    states = list(rollout.states().values())
+    return elapsed, client.calls, {state: states.count(state) for state in set(states)}
+
+
+@click.command()
+@click.option("--apps", default=8, help="Apps in the rollout")
+@click.option("--interval", default=2.0, help="Seconds between polls of an app")
+@click.option("--latency", default=0.2, help="Seconds each argocd command takes")
+def main(apps, interval, latency):
+    print(f"{apps} apps, argocd commands take {latency}s, polled every {interval}s")
+    print(f"{'scenario':<10}{'strategy':<10}{'seconds':>9}{'processes':>11}  states")
+    for degraded in (False, True):
+        for strategy in ("watch", "poll"):
+            elapsed, calls, states = asyncio.run(
+                run(strategy, apps, latency, degraded, interval)
+            )
+            name = "degraded" if degraded else "healthy"
+            print(f"{name:<10}{strategy:<10}{elapsed:>9.2f}{calls:>11}  {states}")
+
+
+if __name__ == "__main__":
+    main()
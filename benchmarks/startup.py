@@ -0,0 +1,116 @@
+"""Measure invoke startup and the import cost of every task
+
+Every task imports its heavy dependencies lazily, in its own body. For each task we time
+those imports in a fresh interpreter, once cold (nothing compiled yet, what a container
+with PYTHONDONTWRITEBYTECODE=1 pays on every run when the code isn't precompiled) and once
+warm. `invoke --list` is timed the same way.
+
+Only the cold runs redirect the bytecode (PYTHONPYCACHEPREFIX, to an empty directory).
+The warm runs read the `__pycache__` directories where they are, so in the python image
+they measure the bytecode it ships (`compileall` of /tasks and site-packages), and
+outside of it the bytecode a first run writes.
+
+>> python -m benchmarks.startup
+>> python -m benchmarks.startup --tasks-dir /tasks --budget 300
+
+With `--budget` (milliseconds) the command fails when a warm `invoke --list` is slower,
+so it can guard CI against someone moving a heavy import back to module level.
+"""
+import ast
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import click
+
+TASKS_DIR = Path(__file__).resolve().parent.parent / "tasks"
+
+TIMER = """
+import time
+import tasks
+start = time.perf_counter()
+{imports}
+print(time.perf_counter() - start)
+"""
+
+
+def task_imports(tasks_dir):
+    """Map every task name to the import statements at the top of its body"""
+    tree = ast.parse((Path(tasks_dir) / "__init__.py").read_text())
+    imports = {}
+    for node in tree.body:
+        if not isinstance(node, ast.FunctionDef):
+            continue
+        decorators = [
+            getattr(decorator, "id", None)
+            or getattr(getattr(decorator, "func", None), "id", None)
+            for decorator in node.decorator_list
+        ]
+        if "task" not in decorators:
+            continue
+        statements = []
+        for statement in node.body:
+            if isinstance(statement, ast.ImportFrom) and statement.level:
+                # relative to the tasks package
+                statement = ast.ImportFrom(
+                    module=f"tasks.{statement.module}" if statement.module else "tasks",
+                    names=statement.names,
+                    level=0,
+                )
+            if isinstance(statement, (ast.Import, ast.ImportFrom)):
+                statements.append(ast.unparse(statement))
+        imports[node.name.replace("_", "-")] = statements
+    return imports
+
+
+def run(args, cwd, pycache=None):
+    """Run python with `args`, using `pycache` as the only bytecode location if given"""
+    env = dict(os.environ)
+    env.pop("PYTHONPYCACHEPREFIX", None)
+    if pycache is not None:
+        env["PYTHONPYCACHEPREFIX"] = str(pycache)
+        env.pop("PYTHONDONTWRITEBYTECODE", None)
+    start = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, *args], cwd=cwd, env=env, check=True, capture_output=True
+    ).stdout
+    return time.perf_counter() - start, output
+
+
+def measure(args, cwd):
+    """(cold, warm) seconds of running `args`; cold uses an empty bytecode cache"""
+    with tempfile.TemporaryDirectory() as cold_cache:
+        cold = run(args, cwd, cold_cache)
+    # writes the bytecode, unless PYTHONDONTWRITEBYTECODE leaves only the shipped one
+    run(args, cwd)
+    warm = run(args, cwd)
+    return cold, warm
+
+
+@click.command()
+@click.option("--tasks-dir", default=str(TASKS_DIR), help="Path of the tasks package")
+@click.option("--budget", type=float, help="Max warm `invoke --list` time in ms")
+def main(tasks_dir, budget):
+    cwd = Path(tasks_dir).resolve().parent
+    print(f"{'':<28}{'cold ms':>10}{'warm ms':>10}")
+    (cold, _), (warm, _) = measure(["-m", "invoke", "--list"], cwd)
+    print(f"{'invoke --list':<28}{cold * 1000:>10.1f}{warm * 1000:>10.1f}")
+    list_time = warm
+
+    for name, imports in task_imports(tasks_dir).items():
+        code = TIMER.format(imports="\n".join(imports) or "pass")
+        (_, cold), (_, warm) = measure(["-c", code], cwd)
+        cold, warm = float(cold), float(warm)
+        print(f"{name:<28}{cold * 1000:>10.1f}{warm * 1000:>10.1f}")
+
+    if budget is not None and list_time * 1000 > budget:
+        raise click.ClickException(
+            f"invoke --list took {list_time * 1000:.1f}ms, over the {budget}ms budget"
+        )
+
+
+if __name__ == "__main__":
+    main()
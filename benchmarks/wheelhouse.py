@@ -0,0 +1,171 @@
+"""Compare installing a consumer's locked packages from an index and from the wheelhouse
+
+Runs offline against a local stand-in of the package index: a PEP 503 directory served
+over file:// with one sdist per package. The sdists build with an in-tree backend that
+sleeps `--compile-time` seconds, standing in for the compilation of C extensions, so no
+build dependency has to be downloaded either. A poetry.lock with their hashes plays the
+consumer.
+
+For each step we report the wall time:
+- index: `pip install` of every locked package in a fresh virtualenv (today's jobs)
+- wheelhouse cold / warm: `build_wheelhouse` the first time and with nothing new
+- install_locked: the fresh virtualenv installs from the wheelhouse, with an index URL
+  that doesn't resolve, so any download would fail
+
+>> python -m benchmarks.wheelhouse --packages 20 --compile-time 0.5
+"""
+import asyncio
+import hashlib
+import io
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+from pathlib import Path
+
+import click
+
+from tasks.wheelhouse import build_wheelhouse, install_locked
+
+BACKEND = '''
+import base64, hashlib, time, zipfile
+
+NAME, MODULE, VERSION = {name!r}, {module!r}, {version!r}
+
+
+def build_wheel(wheel_directory, config_settings=None, metadata_directory=None):
+    time.sleep({compile_time})
+    dist_info = f"{{MODULE}}-{{VERSION}}.dist-info"
+    files = {{
+        f"{{MODULE}}/__init__.py": f"VERSION = {{VERSION!r}}\\n".encode(),
+        f"{{dist_info}}/METADATA": (
+            f"Metadata-Version: 2.1\\nName: {{NAME}}\\nVersion: {{VERSION}}\\n"
+        ).encode(),
+        f"{{dist_info}}/WHEEL": (
+            b"Wheel-Version: 1.0\\nGenerator: benchmark\\nRoot-Is-Purelib: true\\n"
+            b"Tag: py3-none-any\\n"
+        ),
+    }}
+    record = []
+    for path, data in files.items():
+        digest = base64.urlsafe_b64encode(hashlib.sha256(data).digest()).rstrip(b"=")
+        record.append(f"{{path}},sha256={{digest.decode()}},{{len(data)}}")
+    record.append(f"{{dist_info}}/RECORD,,")
+    files[f"{{dist_info}}/RECORD"] = "\\n".join(record).encode()
+    filename = f"{{MODULE}}-{{VERSION}}-py3-none-any.whl"
+    with zipfile.ZipFile(f"{{wheel_directory}}/{{filename}}", "w") as wheel:
+        for path, data in files.items():
+            wheel.writestr(path, data)
+    return filename
+'''
+
+PYPROJECT = """[build-system]
+requires = []
+build-backend = "backend"
+backend-path = ["."]
+"""
+
+LOCK_PACKAGE = """[[package]]
+name = "{name}"
+version = "{version}"
+description = ""
+category = "main"
+optional = false
+python-versions = "*"
+"""
+
+
+def make_sdist(directory, name, version, compile_time):
+    module = name.replace("-", "_")
+    base = f"{module}-{version}"
+    members = {
+        "pyproject.toml": PYPROJECT,
+        "backend.py": BACKEND.format(
+            name=name, module=module, version=version, compile_time=compile_time
+        ),
+        "PKG-INFO": f"Metadata-Version: 2.1\nName: {name}\nVersion: {version}\n",
+    }
+    path = Path(directory) / f"{base}.tar.gz"
+    with tarfile.open(path, "w:gz") as sdist:
+        for member, text in members.items():
+            data = text.encode()
+            info = tarfile.TarInfo(f"{base}/{member}")
+            info.size = len(data)
+            sdist.addfile(info, io.BytesIO(data))
+    return path
+
+
+def make_index(root, packages, compile_time):
+    """Stand-in index with one sdist per package, returns its URL and a poetry.lock"""
+    simple = Path(root) / "simple"
+    blocks, files = [], []
+    for index in range(packages):
+        name, version = f"bench-package-{index}", "1.0.0"
+        project = simple / name
+        project.mkdir(parents=True)
+        sdist = make_sdist(project, name, version, compile_time)
+        digest = hashlib.sha256(sdist.read_bytes()).hexdigest()
+        # pip reads the index.html of file:// project pages
+        link = f'<a href="{sdist.name}#sha256={digest}">{sdist.name}</a>'
+        (project / "index.html").write_text(f"<html><body>{link}</body></html>\n")
+        blocks.append(LOCK_PACKAGE.format(name=name, version=version))
+        entry = f'{{file = "{sdist.name}", hash = "sha256:{digest}"}}'
+        files.append(f"{name} = [\n    {entry},\n]")
+    lock = "\n".join(blocks)
+    lock += '\n[metadata]\nlock-version = "1.1"\npython-versions = "^3.10"\n'
+    lock += 'content-hash = "benchmark"\n\n[metadata.files]\n' + "\n".join(files) + "\n"
+    return simple.as_uri(), lock
+
+
+def make_venv(path):
+    subprocess.run([sys.executable, "-m", "venv", str(path)], check=True)
+    return str(Path(path) / "bin" / "python")
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    function(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+@click.command()
+@click.option("--packages", default=20, help="Locked packages of the consumer")
+@click.option("--compile-time", default=0.5, help="Seconds to build each sdist")
+@click.option("--jobs", default=4, help="Parallel wheel builds")
+def main(packages, compile_time, jobs):
+    root = Path(tempfile.mkdtemp(prefix="wheelhouse-bench-"))
+    index_url, lock = make_index(root / "index", packages, compile_time)
+    consumer = root / "consumer"
+    consumer.mkdir()
+    (consumer / "poetry.lock").write_text(lock)
+    requirements = [f"bench-package-{index}==1.0.0" for index in range(packages)]
+
+    python = make_venv(root / "index-venv")
+    pip = [python, "-m", "pip", "install", "--quiet", "--no-deps", "--no-cache-dir"]
+    command = [*pip, "--index-url", index_url, *requirements]
+    results = {"index": timed(subprocess.run, command, check=True)}
+
+    wheelhouse = root / "wheelhouse"
+
+    def build():
+        locks = [consumer / "poetry.lock"]
+        build = build_wheelhouse(locks, root=wheelhouse, jobs=jobs, index_url=index_url)
+        asyncio.run(build)
+
+    results["wheelhouse cold"] = timed(build)
+    results["wheelhouse warm"] = timed(build)
+
+    python = make_venv(root / "wheelhouse-venv")
+    offline = "http://index.invalid/simple"
+    results["install_locked"] = timed(
+        install_locked, consumer, python, root=wheelhouse, index_url=offline
+    )
+
+    print(f"{packages} packages, {compile_time}s to build each sdist, {jobs} jobs")
+    for step, seconds in results.items():
+        print(f"  {step:<18}{seconds:>8.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,13 @@
-import json
 import os
+from contextlib import contextmanager
 from types import new_class
-import warnings
-import asyncio
-import time
 from pathlib import Path
 
-import tomlkit
-from invoke import task
-from git import Repo as _Repo
-from .github import create_new_release as gh_create_new_release
-from .github import create_pull_request, get_last_release_tag
+from invoke import Exit, task
+
+# Heavy dependencies (asyncio, GitPython, aiohttp, gidgethub, tomlkit, pendulum) are
+# imported inside the tasks that need them, so `invoke --list` and every other task don't
+# pay for them at startup.
 
 
 def get_current_repo():
@@ -28,22 +25,37 @@ def get_current_repo():
 
 def get_current_version():
     """Returns library version"""
+    from .manifest import get_value
+
     pyproject_file = Path(".").parent / "pyproject.toml"
     package_file = Path(".").parent / "package.json"
     if pyproject_file.exists():
         version_file = pyproject_file.resolve()
         with open(version_file) as f:
-            pyproject = tomlkit.parse(f.read())
-            return pyproject["tool"]["poetry"]["version"]
+            return get_value(f.read(), "tool.poetry.version")
     elif package_file.exists():
         version_file = package_file.resolve()
         with open(version_file) as f:
-            package = json.loads(f.read())
-            return package["version"]
+            return get_value(f.read(), "version", kind="json")
+
+
+@contextmanager
+def github_credentials():
+    """Let the git commands run meanwhile, and their children, authenticate to GitHub
+
+    Through the credential helper of tasks.auth, with the token of the GitHub App when
+    there's one, otherwise GITHUB_TOKEN; no git config file is changed.
+    """
+    from .auth import git_credentials
+
+    with git_credentials():
+        yield
 
 
 @task
 def update_astrolib_wrapper(ctx, major=False):
+    from .manifest import rewrite
+
     def get_new_version(current_version):
         """Create a new version number by adding on value to the current minor number"""
         upgrade_version = current_version.split(".")
@@ -52,24 +64,14 @@ def update_astrolib_wrapper(ctx, major=False):
 
     def update_pyproject(version_file):
         """Updates Astrolib.py version"""
-        with open(version_file) as f:
-            pyproject = tomlkit.parse(f.read())
-            with open(version_file, "w+") as f:
-                current_version = pyproject["tool"]["poetry"]["version"]
-                new_version = get_new_version(current_version)
-                pyproject["tool"]["poetry"]["version"] = new_version
-                f.write(tomlkit.dumps(pyproject))
+        current_version = rewrite(version_file, "tool.poetry.version", get_new_version)
+        new_version = get_new_version(current_version)
         return {"old_version": current_version, "new_version": new_version}
 
     def update_package(version_file):
         """Updates Astrolib3.js version"""
-        with open(version_file) as f:
-            package = json.loads(f.read())
-            with open(version_file, "w+") as f:
-                current_version = package["version"]
-                new_version = get_new_version(current_version)
-                package["version"] = new_version
-                json.dump(package, f, indent=2)
+        current_version = rewrite(version_file, "version", get_new_version)
+        new_version = get_new_version(current_version)
         return {"old_version": current_version, "new_version": new_version}
 
     def update_version():
@@ -88,11 +90,71 @@ def update_astrolib_wrapper(ctx, major=False):
 def create_new_release(ctx):
     """Create a new library release
 
-    Currently can do the release for astrolib.py and astrolib3.js
+    Currently can do the release for astrolib.py and astrolib3.js. Its body has the
+    release notes since the previous release tag, which needs a checkout with the tags.
     """
+    import asyncio
+
+    from .changelog import Changelog, previous_tag
+    from .github import create_new_release as gh_create_new_release
+
     repo = get_current_repo()
     version = get_current_version()
-    asyncio.run(gh_create_new_release(version, repo))
+    since = previous_tag(".", version)
+    notes = None
+    if since:
+        url = f"https://github.com/photopills/{repo}"
+        notes = Changelog(".", repo).notes(since, "HEAD", url)
+    asyncio.run(gh_create_new_release(version, repo, body=notes))
+
+
+@task
+def release_notes(ctx, since=None, until="HEAD", path="."):
+    """Print the release notes of the repo at `path` between two revisions
+
+    `--since` defaults to the release tag before the version of the current directory.
+    """
+    from .changelog import Changelog, previous_tag
+
+    since = since or previous_tag(path, get_current_version())
+    if since is None:
+        raise Exit("There isn't any previous release, pass --since", code=1)
+    print(Changelog(path).notes(since, until))
+
+
+@task
+def release_version(ctx, path=".", branch="master", remote="origin"):
+    """Bump the library version and push the commit and its tag in one atomic push
+
+    The commit is written straight into the object database on top of `remote/branch`,
+    nothing is checked out, so `path` can also be a bare mirror.
+    """
+    from git import Repo as _Repo
+
+    from .manifest import set_value
+    from .plumbing import push_atomic, read_blob, write_commit
+    from .update_version import get_new_version
+
+    local = _Repo(path)
+    local.git.fetch(remote, f"+refs/heads/{branch}:refs/remotes/{remote}/{branch}")
+    parent = f"{remote}/{branch}"
+    files = {item.name for item in local.commit(parent).tree.blobs}
+    if "pyproject.toml" in files:
+        version_file, key, kind = "pyproject.toml", "tool.poetry.version", "toml"
+    else:
+        version_file, key, kind = "package.json", "version", "json"
+    text = read_blob(local, parent, version_file).decode()
+    content, old_version = set_value(text, key, get_new_version, kind)
+    new_version = get_new_version(old_version)
+
+    commit = write_commit(
+        local,
+        parent,
+        {version_file: content.encode()},
+        f"Bumps version from {old_version} to {new_version}",
+    )
+    push_atomic(local, commit, branch, tag=f"v{new_version}", remote=remote)
+    print(new_version)
 
 
 @task
@@ -105,136 +167,222 @@ def update_project_version(ctx):
 
 @task
 def update_dependency(ctx, library):
-    def update_astrolib_version(new_version):
-        "Update pyproject file version"
-        pyproject_file = (Path(".").parent / "pyproject.toml").resolve()
-        with open(pyproject_file) as f:
-            pyproject = tomlkit.parse(f.read())
-        with open(pyproject_file, "w+") as f:
-            old_version = pyproject["tool"]["poetry"]["dependencies"]["astrolib"]["rev"]
-            pyproject["tool"]["poetry"]["dependencies"]["astrolib"]["rev"] = new_version
-            f.write(tomlkit.dumps(pyproject))
-        return {"old_version": old_version, "new_version": new_version}
-
-    class Repo:
-        def __init__(self) -> None:
-            self.local = _Repo(".")
-            self.starting_branch = self.local.head.ref
-            self.master = self.checkout_to_master()
-            self.origin = self.authenticated_origin()
-
-        @property
-        def name(self):
-            """Assumes that local repo name is the same that remote repo"""
-            return self.local.working_dir.rsplit("/", 1)[-1]
-
-        @property
-        def local_branches(self):
-            """Returns all repo branches"""
-            return self.local.heads
-
-        @property
-        def remote_branches(self):
-            """Returns all repo branches"""
-            return self.origin.refs
-
-        def checkout_to_master(self):
-            # TODO: Check if repo is_dirty, but it should be cleaned
-            # checkout to master if need
-            active_branch = self.local.active_branch
-            if active_branch.name != "master":
-                print("Checkout to master")
-                master = self.local_branches.master
-                master.checkout()
-            else:
-                master = active_branch
-            self.master = master
-            print(f"Starting from branch: {self.local.active_branch}")
-            return self.master
-
-        def authenticated_origin(self):
-            # ensures that we are authenticated
-            origin = self.local.remotes[0]
-            GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
-            origin.set_url(f"https://{GITHUB_TOKEN}@github.com/photopills/{self.name}")
-            self.origin = origin
-            return self.origin
-
-        def create_branch(self, new_version):
-            branch_name = f"auto/bumps_to_version_{new_version}"
-            return self.local.create_head(branch_name)
-
-        def commit_all_changes(self, message):
-            changed_files = self.local.index.diff(None)
-            for file in changed_files:
-                self.local.index.add(file.b_path)
-            self.local.index.commit(message)
-
-        def clean_local_repo(self, branch: str):
-            """Clean update version branch
-
-            Is automatically called if the push to remote succeeded
-            """
-            print("Starting cleaning repo after push")
-            self.checkout_to_master()
-            print(f"Current branch: {self.local.active_branch}")
-
-            # delete version update branch
-            self.local.delete_head(branch, force=True)
-
-        def checkout_to_branch(self, branch_name, remote=True):
-            if remote:
-                branches = self.remote_branches
-            for branch in branches:
-                if branch_name in branch.name:
-                    return branch.checkout("--track")
-            raise AttributeError(f"There isn't any branch with name {branch_name}")
-
-        def push(self, branch, force=True):
-            """Push branch with updated version to remote repository"""
-            info = self.origin.push(branch, force=force)
-            summary = info[0].summary
-            # TODO: Create regex to match summary SHA format: b18565a..34b8681
-            if ".." in summary:
-                ## everything went well, we can checkout to master and delete the
-                # local branch
-                self.clean_local_repo(branch)
-            else:
-                warnings.warn(
-                    "There wasn't possible push the changes",
-                    f"Push info: {summary}",
-                )
-            return self
-
-    ## main
-    repo = Repo()
-    assert repo.name == library, "Local repository and library name should be the same"
-    # get new release tag from github
-    new_version = asyncio.run(get_last_release_tag(repo.name))
-    # update repo
-    repo.origin.fetch()
-    # create new branch to apply the version update
-    branch = repo.create_branch(new_version)
-
-    versions = update_astrolib_version(new_version)
-    commit_message = (
-        f"Bumps {library} from {versions['old_version']} to {versions['new_version']}"
-    )
-    ## end code specific to this repo
-    repo.commit_all_changes(message=commit_message)
-    # update lock file
-    # fmt: off
-    GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
-    ctx.run(f"git config --global url.'https://{GITHUB_TOKEN}@github.com/'.insteadOf 'https://github.com/'")  # noqa
-    ctx.run("poetry update astrolib")
-    ctx.run(f"git config --global --unset url.'https://{GITHUB_TOKEN}@github.com/'.insteadOf") # noqa
-    # fmt: on
-    repo.clean_local_repo(branch)
-    repo.push(branch, force=True)
-    # create_pull request
-    time.sleep(1)
+    """Bump `library` in the consumer repo of the current directory
+
+    Runs the same stage graph as `update-dependencies`, in a single event loop.
+    """
+    import asyncio
+
+    from .bump import bump_consumer
+
+    assert (
+        Path(".").resolve().name == library
+    ), "Local repository and library name should be the same"
+    # only `poetry update`, when the lock can't be patched, reads the credentials
+    with github_credentials():
+        pull = asyncio.run(bump_consumer(".", library))
+    print(pull.get("html_url"))
+
+
+@task(iterable=["repo"])
+def update_dependencies(ctx, library, repo, concurrency=4, workspace=None):
+    """Bump `library` in many consumer repos at once
+
+    Each `--repo` is the path of a local consumer clone, e.g.:
+    >> invoke update-dependencies astrolib --repo ../api --repo ../web
+
+    With `--workspace`, each `--repo` is a repository name that is cloned there with a
+    shallow, blobless, sparse clone instead:
+    >> invoke update-dependencies astrolib --workspace /tmp/bumps --repo api --repo web
+    """
+    import asyncio
+
+    from .bump import fan_out, print_summary
+
+    with github_credentials():
+        results = asyncio.run(
+            fan_out(library, repo, concurrency=int(concurrency), workspace=workspace)
+        )
+    print_summary(results)
+    if not all(result["ok"] for result in results):
+        raise Exit(code=1)
+
+
+@task
+def trace_summary(ctx, path=None, top=10):
+    """Show the slowest stages recorded in a TRACE_FILE"""
+    from .tracing import summarize
+
+    path = path or os.getenv("TRACE_FILE")
+    if not path:
+        raise Exit("Pass --path or set TRACE_FILE", code=1)
+    summarize(path, top=int(top))
+
+
+@task(iterable=["library", "consumer"])
+def serve(
+    ctx,
+    library,
+    consumer,
+    workspace="/tmp/bumps",
+    host="0.0.0.0",
+    port=8080,
+    workers=2,
+    debounce=None,
+):
+    """Run the bump service that listens to release webhooks
+
+    Every release of a `--library` is bumped in every `--consumer`, `--debounce` seconds
+    (BUMP_DEBOUNCE by default) after the last release of a burst, e.g.:
+    >> WEBHOOK_SECRET=... invoke serve --library astrolib.py --consumer api --consumer web
+    """
+    from .daemon import serve as serve_daemon
+
+    debounce = None if debounce is None else float(debounce)
+    with github_credentials():
+        serve_daemon(
+            library, consumer, workspace, host, int(port), int(workers), debounce
+        )
+
+
+@task(iterable=["image"])
+def build_images(ctx, image, push=False, force=False, dry_run=False, jobs=4, stub=None):
+    """Build the runner images whose inputs changed, in dependency order
+
+    `--image` (repeatable) limits the build to those images and their bases; `--dry-run`
+    only prints the plan and `--stub state.json` runs it without docker.
+    """
+    from .images import build_images as build
+
+    build(image, push=push, force=force, dry_run=dry_run, jobs=int(jobs), stub=stub)
+
+
+@task(iterable=["lock", "repo"])
+def build_wheelhouse(ctx, lock, repo, jobs=4):
+    """Build the wheels of the packages locked by some consumers into WHEELHOUSE_PATH
+
+    `--lock` takes poetry.lock files and `--repo` the consumers whose lock is read from
+    GitHub, both repeatable.
+    """
+    import asyncio
+
+    from .wheelhouse import build_wheelhouse as build
+
+    # git dependencies (astrolib) are cloned by `pip wheel`
+    with github_credentials():
+        asyncio.run(build(lock, repo, jobs=int(jobs)))
+
+
+@task
+def install_locked(ctx, path=".", python="python", dev=True):
+    """Install the packages of poetry.lock from the wheelhouse before `poetry install`
+
+    `--no-dev` leaves the dev dependencies out, as `poetry install --no-dev`.
+    """
+    from .wheelhouse import install_locked as install
+
+    install(path, python, dev=dev)
+
+
+@task
+def jaeger_lifecycle(
+    ctx,
+    url=None,
+    repository=None,
+    dry_run=False,
+    rollover_age=None,
+    merge_after=1,
+    snapshot_after=1,
+    delete_after=None,
+    max_size=None,
+    batch=20,
+    concurrency=4,
+):
+    """Rollover, force merge, snapshot and delete the Jaeger indices of Elasticsearch
+
+    Indices are deleted after `--delete-after` days, and the oldest ones while the total
+    exceeds `--max-size` (e.g. 500gb). `--repository ""` disables the snapshots.
+    """
+    import asyncio
+
+    from .elastic import ELASTICSEARCH_URL, SNAPSHOT_REPOSITORY, lifecycle, parse_size
+
     asyncio.run(
-        create_pull_request(
-            branch.name, repo.name, versions["old_version"], versions["new_version"]
+        lifecycle(
+            url or ELASTICSEARCH_URL,
+            SNAPSHOT_REPOSITORY if repository is None else repository,
+            dry_run=dry_run,
+            concurrency=int(concurrency),
+            rollover_age=rollover_age,
+            merge_after=float(merge_after),
+            snapshot_after=float(snapshot_after),
+            delete_after=None if delete_after is None else float(delete_after),
+            max_size=parse_size(max_size),
+            batch=int(batch),
         )
     )
+
+
+@task(iterable=["app"])
+def watch_rollout(ctx, app, selector=None, revision=None, timeout=None):
+    """Sync the ArgoCD apps of a release and watch them until they're all healthy
+
+    Takes the `--app` names (repeatable) and/or a label `--selector`; fails on the first
+    degraded app or failed sync, and after `--timeout` seconds (ROLLOUT_TIMEOUT).
+    """
+    import asyncio
+
+    from .rollout import ROLLOUT_TIMEOUT, roll_out
+
+    timeout = ROLLOUT_TIMEOUT if timeout is None else float(timeout)
+    if not asyncio.run(roll_out(app, selector, revision, timeout)):
+        raise Exit(code=1)
+
+
+@task(iterable=["repo"])
+def mirror_update(ctx, repo):
+    """Create or refresh the mirrors of the `--repo` repositories in MIRROR_CACHE_PATH"""
+    from .bump import remote_url
+    from .mirrors import MirrorCache
+
+    cache = MirrorCache()
+    with github_credentials():
+        for name in repo:
+            print(cache.update(name, remote_url(name)))
+
+
+@task
+def mirror_workspace(ctx, repo, path, branch="master"):
+    """Clone a workspace of `repo` into `path` from the mirror cache"""
+    from .bump import remote_url
+    from .mirrors import MirrorCache
+
+    with github_credentials():
+        print(MirrorCache().workspace(repo, remote_url(repo), path, branch))
+
+
+@task
+def mirror_evict(ctx, max_size=None, grace=3600):
+    """Delete the least recently used mirrors until the cache fits `max_size` bytes"""
+    from .mirrors import MirrorCache
+
+    max_size = int(max_size) if max_size is not None else None
+    for name in MirrorCache().evict(max_size, grace=int(grace)):
+        print(f"Evicted {name}")
+
+
+@task
+def jobs(ctx, status=None):
+    """List the bump jobs of the ledger, e.g. `--status failed` or `--status running`"""
+    import datetime
+
+    from .ledger import Ledger
+
+    for job in Ledger().jobs(status):
+        updated_at = datetime.datetime.fromtimestamp(job["updated_at"])
+        print(
+            f"{job['status']:<8} {job['repo']:<24} {job['version']:<12} "
+            f"{job['last_stage'] or '-':<14} {updated_at:%Y-%m-%d %H:%M:%S}"
+        )
+        if job["error"]:
+            print(f"         {job['error']}")
@@ -0,0 +1,283 @@
+"""Authenticate as the photopills GitHub App, with cached installation tokens
+
+A personal access token (GITHUB_TOKEN) shares its rate limit with everything else that
+runs as its user. With GITHUB_APP_ID and the private key of the app (the PEM in
+GITHUB_APP_PRIVATE_KEY, or its path in GITHUB_APP_PRIVATE_KEY_PATH) the tasks
+authenticate as the installation of the app on the organization instead, which has a
+rate limit of its own:
+
+- a JWT signed with the private key (RS256) is minted locally and reused for 9 minutes
+- it's exchanged for an installation token, valid for one hour, on
+  /app/installations/{id}/access_tokens; the installation comes from
+  GITHUB_APP_INSTALLATION_ID or is looked up once on /orgs/photopills/installation
+- the token is kept in memory and in GITHUB_TOKEN_CACHE_PATH (mode 0600), shared by
+  every process, and only refreshed when less than GITHUB_TOKEN_REFRESH_MARGIN seconds
+  are left; concurrent requests of a process wait for a single refresh
+
+`GitHubClient` sends it with every API call, and git gets it, or GITHUB_TOKEN without
+an app, from the credential helper of this module (`python -m tasks.auth helper` prints
+it), so the remote URLs don't carry a token. The tasks install the helper with
+`git_credentials`, in the environment of their git commands rather than in a git config
+file.
+"""
+import asyncio
+import calendar
+import json
+import os
+import shlex
+import sys
+import tempfile
+import time
+import weakref
+from contextlib import contextmanager
+from pathlib import Path
+
+from .tracing import span
+
+ORGANIZATION = "photopills"
+TOKEN_CACHE_PATH = Path.home() / ".cache" / "photopills" / "tokens.json"
+# seconds before its expiry that an installation token is refreshed
+REFRESH_MARGIN = 300
+# GitHub rejects JWTs valid for more than 10 minutes
+JWT_LIFETIME = 600
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def parse_time(value):
+    """Epoch of a GitHub timestamp, 2016-07-11T22:14:10Z"""
+    return calendar.timegm(time.strptime(value, "%Y-%m-%dT%H:%M:%SZ"))
+
+
+class GitHubApp:
+    """Installation tokens of the GitHub App `app_id` on `organization`"""
+
+    def __init__(
+        self,
+        app_id,
+        private_key,
+        installation_id=None,
+        organization=ORGANIZATION,
+        cache_path=TOKEN_CACHE_PATH,
+        margin=REFRESH_MARGIN,
+    ):
+        self.app_id = str(app_id)
+        self.private_key = private_key
+        self.installation_id = installation_id
+        self.organization = organization
+        self.cache_path = Path(cache_path)
+        self.margin = margin
+        self._jwt = None
+        self._jwt_expires = 0
+        self._token = None
+        # one lock per event loop, the tasks run several of them with asyncio.run
+        self._locks = weakref.WeakKeyDictionary()
+        # installation tokens requested by this process, for the benchmarks
+        self.minted = 0
+
+    @classmethod
+    def from_env(cls):
+        """App configured in the environment, None without GITHUB_APP_ID"""
+        app_id = os.getenv("GITHUB_APP_ID")
+        if not app_id:
+            return None
+        private_key = os.getenv("GITHUB_APP_PRIVATE_KEY")
+        if not private_key:
+            private_key = Path(os.environ["GITHUB_APP_PRIVATE_KEY_PATH"]).read_text()
+        return cls(
+            app_id,
+            private_key,
+            installation_id=os.getenv("GITHUB_APP_INSTALLATION_ID"),
+            cache_path=os.getenv("GITHUB_TOKEN_CACHE_PATH", TOKEN_CACHE_PATH),
+            margin=int(os.getenv("GITHUB_TOKEN_REFRESH_MARGIN", REFRESH_MARGIN)),
+        )
+
+    @property
+    def key(self):
+        return f"{self.app_id}/{self.organization}"
+
+    def jwt(self):
+        """JWT of the app, minted again a minute before it expires"""
+        now = time.time()
+        if self._jwt is None or now > self._jwt_expires - 60:
+            import jwt
+
+            # issued a minute ago, in case GitHub's clock is behind ours
+            issued = int(now) - 60
+            payload = {"iat": issued, "exp": issued + JWT_LIFETIME, "iss": self.app_id}
+            self._jwt = jwt.encode(payload, self.private_key, algorithm="RS256")
+            self._jwt_expires = issued + JWT_LIFETIME
+        return self._jwt
+
+    def valid(self, entry):
+        return entry is not None and entry["expires_at"] - self.margin > time.time()
+
+    def read_cache(self):
+        try:
+            return json.loads(self.cache_path.read_text())
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def write_cache(self, entry):
+        data = self.read_cache()
+        if entry is None:
+            data.pop(self.key, None)
+        else:
+            data[self.key] = entry
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        # created with mode 0600, and replaced at once for the other processes
+        with tempfile.NamedTemporaryFile(
+            "w", dir=self.cache_path.parent, delete=False
+        ) as f:
+            json.dump(data, f)
+        os.replace(f.name, self.cache_path)
+
+    def cached(self):
+        """Installation token of the memory or the disk cache, None if about to expire"""
+        if self.valid(self._token):
+            return self._token["token"]
+        entry = self.read_cache().get(self.key)
+        if self.valid(entry):
+            self._token = entry
+            return entry["token"]
+        return None
+
+    def forget(self, token=None):
+        """Drop the cached installation token, only if it's `token` when given"""
+        entry = self._token or self.read_cache().get(self.key)
+        if entry is None or (token and entry["token"] != token):
+            return
+        self._token = None
+        self.write_cache(None)
+
+    async def installation(self, gh):
+        if self.installation_id is None:
+            entry = self.read_cache().get(self.key) or {}
+            self.installation_id = entry.get("installation_id")
+        if self.installation_id is None:
+            url = f"/orgs/{self.organization}/installation"
+            self.installation_id = (await gh.getitem(url, jwt=self.jwt()))["id"]
+        return self.installation_id
+
+    async def token(self, gh):
+        """Installation token, requested through the client `gh` when it's missing or
+        about to expire"""
+        token = self.cached()
+        if token:
+            return token
+        lock = self._locks.setdefault(asyncio.get_running_loop(), asyncio.Lock())
+        async with lock:
+            # another request of this process or another process may have refreshed it
+            token = self.cached()
+            if token:
+                return token
+            with span("github.installation_token", app=self.app_id) as current:
+                installation = await self.installation(gh)
+                url = f"/app/installations/{installation}/access_tokens"
+                data = await gh.post(url, data=b"", jwt=self.jwt())
+                self._token = {
+                    "installation_id": installation,
+                    "token": data["token"],
+                    "expires_at": parse_time(data["expires_at"]),
+                }
+                self.write_cache(self._token)
+                self.minted += 1
+                current.set(installation=installation, expires_at=data["expires_at"])
+                return self._token["token"]
+
+    def token_sync(self):
+        """`token` outside of an event loop, with a client of its own"""
+        token = self.cached()
+        if token:
+            return token
+
+        async def refresh():
+            import aiohttp
+            from gidgethub.aiohttp import GitHubAPI
+
+            base_url = os.getenv("GITHUB_API_URL", "https://api.github.com")
+            async with aiohttp.ClientSession() as session:
+                gh = GitHubAPI(session, ORGANIZATION, base_url=base_url)
+                return await self.token(gh)
+
+        return asyncio.run(refresh())
+
+
+_apps = {}
+
+
+def github_app():
+    """The `GitHubApp` of the environment, one per process, None if not configured"""
+    names = ("GITHUB_APP_ID", "GITHUB_APP_INSTALLATION_ID", "GITHUB_TOKEN_CACHE_PATH")
+    key = tuple(os.getenv(name) for name in names)
+    if not key[0]:
+        return None
+    if key not in _apps:
+        _apps[key] = GitHubApp.from_env()
+    return _apps[key]
+
+
+def credential_helper():
+    """Value of `credential.<url>.helper` running this module"""
+    python = f"PYTHONPATH={shlex.quote(str(ROOT))} {shlex.quote(sys.executable)}"
+    return f"!{python} -m tasks.auth"
+
+
+def sq_quote(value):
+    """`value` single-quoted the way git quotes GIT_CONFIG_PARAMETERS"""
+    return "'" + value.replace("'", "'\\''") + "'"
+
+
+def git_config_parameters(server=None, previous=None):
+    """GIT_CONFIG_PARAMETERS, after `previous`, with the credential helper for `server`
+
+    It's the variable of `git -c`, read by every git command and passed to its children;
+    unlike GIT_CONFIG_COUNT (git 2.31) the `'key=value'` form is read by any git.
+    """
+    server = server or os.getenv("GITHUB_SERVER_URL", "https://github.com")
+    key = f"credential.{server}.helper"
+    # the empty value resets the helpers configured before ours
+    entries = [f"{key}=", f"{key}={credential_helper()}"]
+    return " ".join(([previous] if previous else []) + [sq_quote(e) for e in entries])
+
+
+@contextmanager
+def git_credentials(server=None):
+    """Let the git commands run meanwhile, and their children, authenticate to GitHub
+    with the credential helper, leaving the git config files untouched"""
+    previous = os.environ.get("GIT_CONFIG_PARAMETERS")
+    os.environ["GIT_CONFIG_PARAMETERS"] = git_config_parameters(server, previous)
+    try:
+        yield
+    finally:
+        if previous is None:
+            os.environ.pop("GIT_CONFIG_PARAMETERS", None)
+        else:
+            os.environ["GIT_CONFIG_PARAMETERS"] = previous
+
+
+def credential(action, lines, server=None):
+    """Answer of the git credential helper to `action` with the `key=value` `lines`
+
+    An installation token of the app, or GITHUB_TOKEN when there's no app.
+    https://git-scm.com/docs/gitcredentials#_custom_helpers
+    """
+    server = server or os.getenv("GITHUB_SERVER_URL", "https://github.com")
+    request = dict(line.split("=", 1) for line in lines if "=" in line)
+    if f"{request.get('protocol')}://{request.get('host')}" != server:
+        return ""
+    app = github_app()
+    if action == "get":
+        token = os.getenv("GITHUB_TOKEN") if app is None else app.token_sync()
+        return f"username=x-access-token\npassword={token}\n" if token else ""
+    if action == "erase" and app is not None:
+        # git rejected it, the next `get` requests another one
+        app.forget(request.get("password"))
+    return ""
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["helper"]:
+        print(credential_helper())
+    else:
+        # `store` is a no-op, the tokens are cached already
+        sys.stdout.write(credential(sys.argv[-1], sys.stdin.read().splitlines()))
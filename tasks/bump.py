@@ -0,0 +1,462 @@
+"""Bump the astrolib dependency in consumer repositories
+
+The same pipeline is used by `update_dependency` (one repo, the current directory) and
+by `update_dependencies` (fan-out over many local clones at once).
+"""
+import asyncio
+import inspect
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from git import Repo as _Repo
+
+from .changelog import release_notes
+from .github import (
+    BUMP_BRANCH_PREFIX,
+    create_pull_request,
+    find_bump_pull_request,
+    get_last_release_tag,
+    github_session,
+    update_pull_request,
+    wait_for_branch,
+)
+from .ledger import Ledger
+from .lockfile import patch_lock
+from .manifest import rewrite
+from .mirrors import MIRROR_PATH, MirrorCache
+from .pipeline import Pipeline
+from .tracing import SpanProgress, span
+
+# name of the bumped package in pyproject.toml and poetry.lock
+PACKAGE = "astrolib"
+# the only files a version bump reads or writes
+MANIFEST_FILES = ("pyproject.toml", "package.json", "poetry.lock")
+# seconds the pull request waits for the release notes, opened without them after
+NOTES_TIMEOUT = float(os.getenv("BUMP_NOTES_TIMEOUT", 30))
+
+
+def remote_url(name):
+    """URL of photopills/`name`
+
+    GITHUB_SERVER_URL (same variable GitHub Actions sets) points it to another server, or
+    to a local directory of bare repos with a file:// URL. The URL carries no token, git
+    gets one from the credential helper of tasks.auth (see `git_credentials`).
+    """
+    server = os.getenv("GITHUB_SERVER_URL", "https://github.com")
+    return f"{server}/photopills/{name}"
+
+
+def minimal_clone(url, path, branch="master"):
+    """Clone only what a version bump needs
+
+    Depth-1, single-branch, blobless (`--filter=blob:none`) partial clone with a sparse
+    checkout limited to MANIFEST_FILES, so the blobs of every other file are never
+    downloaded.
+    """
+    local = _Repo.clone_from(
+        url,
+        path,
+        depth=1,
+        single_branch=True,
+        branch=branch,
+        filter="blob:none",
+        no_checkout=True,
+        progress=SpanProgress(),
+    )
+    return sparse_checkout(local, branch)
+
+
+def sparse_checkout(local, branch="master"):
+    """Check out only MANIFEST_FILES of `branch`
+
+    The sparse-checkout file is written by hand because `git sparse-checkout set
+    --no-cone` is not available in the git shipped with our python image.
+    """
+    local.git.config("core.sparseCheckout", "true")
+    sparse_file = Path(local.git_dir) / "info" / "sparse-checkout"
+    sparse_file.parent.mkdir(exist_ok=True)
+    sparse_file.write_text("".join(f"/{name}\n" for name in MANIFEST_FILES))
+    local.git.checkout(branch)
+    return local
+
+
+def update_astrolib_version(new_version, path="."):
+    "Update pyproject file version"
+    pyproject_file = (Path(path) / "pyproject.toml").resolve()
+    key = f"tool.poetry.dependencies.{PACKAGE}.rev"
+    old_version = rewrite(pyproject_file, key, new_version)
+    return {"old_version": old_version, "new_version": new_version}
+
+
+class Repo:
+    def __init__(self, path=".") -> None:
+        self.local = _Repo(path)
+        self.starting_branch = self.local.head.ref
+        self.master = self.checkout_to_master()
+        self.origin = self.authenticated_origin()
+
+    @classmethod
+    def clone(cls, name, path, branch="master"):
+        """Create a minimal clone of photopills/`name` in `path`
+
+        With MIRROR_CACHE_PATH set, it's cloned from the local mirror cache instead of
+        GitHub (see `MirrorCache.workspace`).
+        """
+        if MIRROR_PATH:
+            cache = MirrorCache()
+            cache.workspace(name, remote_url(name), path, branch, checkout=False)
+            sparse_checkout(_Repo(path), branch)
+        else:
+            minimal_clone(remote_url(name), path, branch)
+        return cls(path)
+
+    @property
+    def name(self):
+        """Assumes that local repo name is the same that remote repo"""
+        return self.local.working_dir.rsplit("/", 1)[-1]
+
+    @property
+    def local_branches(self):
+        """Returns all repo branches"""
+        return self.local.heads
+
+    @property
+    def remote_branches(self):
+        """Returns all repo branches"""
+        return self.origin.refs
+
+    def checkout_to_master(self):
+        # TODO: Check if repo is_dirty, but it should be cleaned
+        # checkout to master if need
+        active_branch = self.local.active_branch
+        if active_branch.name != "master":
+            print("Checkout to master")
+            master = self.local_branches.master
+            master.checkout()
+        else:
+            master = active_branch
+        self.master = master
+        print(f"Starting from branch: {self.local.active_branch}")
+        return self.master
+
+    def authenticated_origin(self):
+        # ensures that we are authenticated
+        origin = self.local.remotes[0]
+        origin.set_url(remote_url(self.name))
+        self.origin = origin
+        return self.origin
+
+    def reset_master(self):
+        """Move local master to the last fetched origin/master"""
+        self.local.git.reset("--hard", f"{self.origin.name}/master")
+
+    def discard_changes(self, paths=MANIFEST_FILES):
+        """Check the tracked `paths` out of HEAD again, without their local changes"""
+        tracked = self.local.git.ls_files("--", *paths).split()
+        if tracked:
+            self.local.git.checkout("HEAD", "--", *tracked)
+
+    def create_branch(self, new_version):
+        branch_name = f"{BUMP_BRANCH_PREFIX}{new_version}"
+        return self.local.create_head(branch_name)
+
+    def commit_all_changes(self, message):
+        # GitPython can't read the v3 index written by sparse checkouts, the git CLI can
+        self.local.git.add("--update")
+        self.local.git.commit("-m", message)
+
+    def clean_local_repo(self, branch: str):
+        """Clean update version branch
+
+        Is automatically called if the push to remote succeeded
+        """
+        print("Starting cleaning repo after push")
+        self.checkout_to_master()
+        print(f"Current branch: {self.local.active_branch}")
+
+        # delete version update branch
+        self.local.delete_head(branch, force=True)
+
+    def checkout_to_branch(self, branch_name, remote=True):
+        if remote:
+            branches = self.remote_branches
+        for branch in branches:
+            if branch_name in branch.name:
+                return branch.checkout("--track")
+        raise AttributeError(f"There isn't any branch with name {branch_name}")
+
+    def push(self, branch, force=True, target=None):
+        """Push branch with updated version to remote repository
+
+        With `target`, the branch is pushed to that remote branch instead of the one
+        with its name. Raises RuntimeError when the push is rejected or fails.
+        """
+        refspec = f"{branch}:refs/heads/{target}" if target else branch
+        info = self.origin.push(refspec, force=force, progress=SpanProgress())[0]
+        # a new branch reports "[new branch]" instead of the b18565a..34b8681 range
+        if info.flags & (info.ERROR | info.REJECTED | info.REMOTE_REJECTED):
+            raise RuntimeError(
+                f"There wasn't possible push the changes. Push info: {info.summary}"
+            )
+        ## everything went well, we can checkout to master and delete the
+        # local branch
+        self.clean_local_repo(branch)
+        return self
+
+
+async def poetry_update(path, package=PACKAGE):
+    """Run `poetry update <package>` inside `path` without blocking the event loop"""
+    process = await asyncio.create_subprocess_exec("poetry", "update", package, cwd=path)
+    if await process.wait() != 0:
+        raise RuntimeError(f"poetry update {package} failed in {path}")
+
+
+async def update_lock(path, versions, gh=None):
+    """Patch poetry.lock in place, running the full resolver only when it's needed"""
+    old_version, new_version = versions["old_version"], versions["new_version"]
+    with span("lock.update", repo=path, version=new_version) as current:
+        patched = await patch_lock(path, PACKAGE, old_version, new_version, gh=gh)
+        current.set(resolver="patch" if patched else "poetry")
+        if not patched:
+            await poetry_update(path)
+
+
+async def bump_consumer(
+    path, library, new_version=None, gh=None, executor=None, name=None, ledger=None
+):
+    """Run the whole bump pipeline for the consumer clone at `path`
+
+    The stages run as a dependency graph (see `Pipeline`): the release lookup overlaps
+    with opening and fetching the repo, then branch -> manifest -> lock -> commit ->
+    push -> visible (GitHub sees the branch) -> pull_request, with the release notes of
+    the library between both versions (see `tasks.changelog`) built meanwhile.
+
+    When the consumer already has an open bump pull request (to an older version that
+    hasn't been merged), its branch is force-pushed with the new bump and the pull
+    request is retitled, instead of opening one more.
+
+    `new_version` can be the tag, an awaitable that resolves to it (one lookup shared by
+    many consumers) or None to look it up here. With `name`, photopills/`name` is cloned
+    into `path` first (see `minimal_clone`), unless a previous bump already did, and its
+    master is reset to origin before branching. GitPython calls run in `executor`.
+
+    Every stage that changes something is recorded in the `ledger` job of (repo,
+    version), and skipped when the same bump runs again. The local branch of a job that
+    wasn't pushed is reused when it's still there, with the manifest and lock edits
+    applied again unless they were committed, otherwise the bump starts over. A
+    cancelled bump (superseded by a newer release) is marked as such in its job.
+    """
+    attributes = {"repo": name or path}
+    if isinstance(new_version, str):
+        attributes["version"] = new_version
+    pipeline = Pipeline(executor, **attributes)
+    ledger = ledger or Ledger()
+
+    @pipeline.stage()
+    async def release():
+        if new_version is None:
+            return await get_last_release_tag(library, gh=gh)
+        if inspect.isawaitable(new_version):
+            return await new_version
+        return new_version
+
+    @pipeline.stage(blocking=True)
+    def repo():
+        if name is not None and not Path(path).exists():
+            return Repo.clone(name, path)
+        return Repo(path)
+
+    @pipeline.stage()
+    async def job(repo, release):
+        return ledger.job(repo.name, release)
+
+    @pipeline.stage()
+    async def existing(repo, job):
+        if job.get("pull_request"):
+            return None
+        return await find_bump_pull_request(repo.name, gh=gh)
+
+    @pipeline.stage(blocking=True)
+    def fetch(repo):
+        repo.origin.fetch(progress=SpanProgress())
+
+    @pipeline.stage(blocking=True, after=["fetch"])
+    def branch(repo, release, job):
+        if job.get("push"):
+            return None
+        recorded = job.get("branch")
+        if recorded and recorded in repo.local_branches:
+            # resumed as it was left, master isn't reset under it
+            head = repo.local_branches[recorded]
+            head.checkout()
+            if not job.get("commit"):
+                # the manifest and lock edits were never committed and may be lost or
+                # half done, apply them again from the branch
+                job.forget("manifest", "lock")
+                repo.discard_changes()
+            return head
+        if name is not None:
+            # the clone is ours and may be reused between bumps, start from origin
+            repo.reset_master()
+        # nothing done locally survived, start over
+        job.forget("manifest", "lock", "commit")
+        head = repo.create_branch(release)
+        job.record("branch", head.name)
+        head.checkout()
+        return head
+
+    @pipeline.stage(after=["branch"])
+    async def manifest(repo, release, job):
+        if job.get("manifest"):
+            return job.get("manifest")
+        versions = update_astrolib_version(release, repo.local.working_dir)
+        job.record("manifest", versions)
+        return versions
+
+    @pipeline.stage()
+    async def notes(manifest, job):
+        if job.get("pull_request"):
+            return None
+        old_version, new_version = manifest["old_version"], manifest["new_version"]
+        notes = asyncio.to_thread(
+            release_notes, library, remote_url(library), old_version, new_version
+        )
+        try:
+            # past the timeout the thread goes on filling the mirror for the next bumps
+            return await asyncio.wait_for(notes, NOTES_TIMEOUT)
+        except Exception as exc:
+            # the pull request is still worth opening without them
+            print(f"No release notes of {library} {old_version}..{new_version}: {exc!r}")
+            return None
+
+    @pipeline.stage()
+    async def lock(repo, manifest, job):
+        if job.get("lock") or job.get("commit"):
+            return
+        await update_lock(repo.local.working_dir, manifest, gh=gh)
+        job.record("lock")
+
+    @pipeline.stage(blocking=True, after=["lock"])
+    def commit(repo, manifest, job):
+        if job.get("commit"):
+            return
+        old_version, new_version = manifest["old_version"], manifest["new_version"]
+        repo.commit_all_changes(f"Bumps {library} from {old_version} to {new_version}")
+        job.record("commit", repo.local.head.commit.hexsha)
+
+    @pipeline.stage(blocking=True, after=["commit"])
+    def push(repo, branch, job, existing):
+        if not job.get("push"):
+            target = existing["head"]["ref"] if existing else job.get("branch")
+            repo.push(branch, True, target=target)
+            job.record("target", target)
+            job.record("push", job.get("commit"))
+        return job.get("target") or job.get("branch")
+
+    @pipeline.stage()
+    async def visible(repo, push):
+        # GitHub needs a moment to register the new branch before a PR can use it
+        await wait_for_branch(repo.name, push, gh=gh)
+
+    @pipeline.stage(after=["visible"])
+    async def pull_request(repo, push, manifest, job, existing, notes):
+        if job.get("pull_request"):
+            return job.get("pull_request")
+        if existing:
+            pull = await update_pull_request(
+                existing["number"],
+                repo.name,
+                new_version=manifest["new_version"],
+                old_version=manifest["old_version"],
+                gh=gh,
+                notes=notes,
+            )
+            job.record("pull_request", {key: pull[key] for key in ("number", "html_url")})
+            return pull
+        pull = await create_pull_request(
+            push,
+            repo.name,
+            new_version=manifest["new_version"],
+            old_version=manifest["old_version"],
+            gh=gh,
+            notes=notes,
+        )
+        job.record("pull_request", {key: pull[key] for key in ("number", "html_url")})
+        return pull
+
+    # one client for every stage, unless the caller shares its own
+    async with github_session(gh) as gh:
+        with span("bump", **attributes):
+            try:
+                results = await pipeline.run()
+            except asyncio.CancelledError:
+                if "job" in pipeline.results:
+                    pipeline.results["job"].cancel("superseded")
+                raise
+            except Exception as exc:
+                if "job" in pipeline.results:
+                    pipeline.results["job"].fail(repr(exc))
+                raise
+    results["job"].finish()
+    return results["pull_request"]
+
+
+async def fan_out(library, paths, concurrency=4, workspace=None):
+    """Bump `library` in every consumer clone listed in `paths` concurrently
+
+    At most `concurrency` pipelines run at the same time and all of them share one
+    GitHub session, one thread pool and a single release lookup. Returns one result dict
+    per consumer, failures included, so a single broken repo doesn't abort the rest of
+    the batch. Running it again for the same release resumes the failed bumps (see
+    `Ledger`).
+
+    With a `workspace` directory, `paths` are repository names instead and each consumer
+    starts from a fresh minimal clone (see `minimal_clone`) inside it.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    ledger = Ledger()
+
+    with span("update_dependencies", library=library, consumers=len(paths)):
+        async with github_session() as gh:
+            # with the graphql backend, send the pull requests as soon as every running
+            # pipeline has asked for one
+            gh.pull_batch.size = max(min(concurrency, len(paths)), 1)
+            release = asyncio.ensure_future(get_last_release_tag(library, gh=gh))
+
+            async def run(executor, path):
+                name = None
+                if workspace is not None:
+                    name, path = path, str(Path(workspace) / path)
+                async with semaphore:
+                    try:
+                        pull = await bump_consumer(
+                            path,
+                            library,
+                            release,
+                            gh=gh,
+                            executor=executor,
+                            name=name,
+                            ledger=ledger,
+                        )
+                    except Exception as exc:
+                        return {"repo": name or path, "ok": False, "error": repr(exc)}
+                return {"repo": name or path, "ok": True, "pull": pull.get("html_url")}
+
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                try:
+                    return await asyncio.gather(*(run(executor, path) for path in paths))
+                finally:
+                    if not release.done():
+                        release.cancel()
+
+
+def print_summary(results):
+    """Print one line per consumer with the outcome of its bump"""
+    for result in results:
+        if result["ok"]:
+            print(f"[ok]     {result['repo']}: {result['pull']}")
+        else:
+            print(f"[failed] {result['repo']}: {result['error']}")
+    failed = sum(1 for result in results if not result["ok"])
+    print(f"{len(results) - failed} succeeded, {failed} failed")
@@ -0,0 +1,269 @@
+"""Release notes of a library, from its conventional commits
+
+The notes of a release are the commits between the previous tag and the new one,
+grouped by their conventional commit type (`feat(api): ...`, `fix!: ...`). They fill the
+body of the GitHub release (`create_new_release`) and of the bump pull requests of the
+consumers, which span every release between their old and new version.
+
+Walking a range is the only part that reads the history, and a released range never
+changes, so each range walked is cached per repo in CHANGELOG_CACHE_PATH, keyed by the
+commits at its ends, along with a link from its tip to its base. A range spanning
+several releases (v1.2.0..v1.5.0) follows those links back from its tip, so after the
+first time only the range of the newest release is ever walked. When the links don't
+get there, the range is split at the release tags in between, checked with ancestry
+queries (`merge-base --is-ancestor`) that the commit-graph answers from generation
+numbers instead of parsing the commits. The commit-graph of a library mirror is written
+once with `--split` and grows with every fetch (`fetch.writeCommitGraph`); a checkout of
+the user is read with whatever commit-graph it has, nothing is written into it.
+
+The history comes from the given checkout or, for the bump pull requests, from a
+mirror of the library with its commits only (`--filter=tree:0`, the notes never read a
+tree or a blob), kept under the mirror cache (MIRROR_CACHE_PATH/history, or
+CHANGELOG_CACHE_PATH/mirrors when it isn't set) apart from the full mirrors the
+workspaces are cloned from.
+
+>> invoke release-notes --since v1.2.0 --until v1.5.0
+"""
+import json
+import os
+import re
+import subprocess
+import tempfile
+from pathlib import Path
+
+from .mirrors import MAX_AGE, MIRROR_PATH, MirrorCache, git
+from .releases import parse_semver
+from .tracing import span
+
+CACHE_PATH = Path(
+    os.getenv("CHANGELOG_CACHE_PATH", Path.home() / ".cache" / "photopills" / "changelog")
+)
+CONVENTIONAL = re.compile(r"^(\w+)(?:\(([^)]*)\))?(!)?:\s*(.+)$")
+# release commits of `release_version`, not worth a line in the notes
+IGNORED = re.compile(r"^Bumps version from ")
+BREAKING = "breaking"
+SECTIONS = {
+    BREAKING: "Breaking changes",
+    "feat": "Features",
+    "fix": "Bug fixes",
+    "perf": "Performance",
+    "refactor": "Refactors",
+    "docs": "Documentation",
+    "other": "Other changes",
+}
+# git log fields, separated by unit separators, commits by record separators
+LOG_FORMAT = "%H%x1f%s%x1f%b%x1e"
+
+
+def parse_commit(sha, subject, body=""):
+    """Section, scope and description of a commit"""
+    match = CONVENTIONAL.match(subject)
+    if match is None:
+        return {"sha": sha, "type": "other", "scope": None, "description": subject}
+    type_, scope, bang, description = match.groups()
+    type_ = type_.lower()
+    if bang or "BREAKING CHANGE:" in body or "BREAKING-CHANGE:" in body:
+        type_ = BREAKING
+    elif type_ not in SECTIONS:
+        type_ = "other"
+    return {"sha": sha, "type": type_, "scope": scope, "description": description}
+
+
+def has_commit_graph(path):
+    objects = Path(git("rev-parse", "--git-path", "objects", cwd=path).strip())
+    if not objects.is_absolute():
+        objects = Path(path) / objects
+    info = objects / "info"
+    return (info / "commit-graph").exists() or (info / "commit-graphs").exists()
+
+
+def write_commit_graph(path):
+    """Write the commit-graph of the repo at `path`, only the new commits if it has one"""
+    git("commit-graph", "write", "--reachable", "--split", cwd=path)
+
+
+class Changelog:
+    """Release notes of the git repository at `path`, `repo` names its cache"""
+
+    def __init__(self, path, repo=None, cache_path=CACHE_PATH):
+        self.path = Path(path)
+        self.repo = repo or self.path.resolve().name.removesuffix(".git")
+        # one file per range, only the ranges of a release are ever read
+        self.cache_dir = Path(cache_path) / self.repo
+        # commits walked by this instance, for the benchmarks
+        self.walked = 0
+
+    def resolve(self, *revs):
+        """Commits of `revs`, tags are also tried with and without their "v" """
+        try:
+            # all of them in one call, unless some is missing
+            commits = [f"{rev}^{{commit}}" for rev in revs]
+            return git("rev-parse", *commits, cwd=self.path).split()
+        except subprocess.CalledProcessError:
+            pass
+        resolved = []
+        for rev in revs:
+            candidates = [rev]
+            if parse_semver(rev) is not None:
+                candidates.append(rev[1:] if rev.startswith("v") else f"v{rev}")
+            for candidate in candidates:
+                try:
+                    commit = f"{candidate}^{{commit}}"
+                    resolved.append(git("rev-parse", "--verify", commit, cwd=self.path))
+                    break
+                except subprocess.CalledProcessError:
+                    continue
+            else:
+                raise LookupError(f"{rev} isn't a commit of {self.repo}")
+        return [commit.strip() for commit in resolved]
+
+    def links(self):
+        """{tip: base} of every range walked"""
+        path = self.cache_dir / "links.json"
+        return json.loads(path.read_text()) if path.exists() else {}
+
+    def link(self, links):
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.write(self.cache_dir / "links.json", {**self.links(), **links})
+
+    def write(self, path, data):
+        # concurrent bumps may write the same file
+        with tempfile.NamedTemporaryFile("w", dir=self.cache_dir, delete=False) as f:
+            json.dump(data, f)
+        os.replace(f.name, path)
+
+    def chain(self, base, tip):
+        """[base, ..., tip] through walked ranges only, None if they don't get there"""
+        links, ends = self.links(), [tip]
+        while ends[-1] != base:
+            if ends[-1] not in links or len(ends) > len(links):
+                return None
+            ends.append(links[ends[-1]])
+        return ends[::-1]
+
+    def is_ancestor(self, ancestor, descendant):
+        command = ["git", "merge-base", "--is-ancestor", ancestor, descendant]
+        return subprocess.run(command, cwd=self.path).returncode == 0
+
+    def tags_between(self, base, tip, since=None, until=None):
+        """Commits of the release tags descending from `base` and leading to `tip`, in
+        version order
+
+        When `since`/`until` are versions, only the tags between them are candidates,
+        a single release range has none.
+        """
+        output = git(
+            "for-each-ref",
+            "--format=%(refname:short) %(objectname) %(*objectname)",
+            "refs/tags",
+            cwd=self.path,
+        )
+        lower, upper = parse_semver(since or ""), parse_semver(until or "")
+        versions = []
+        for line in output.splitlines():
+            tag, commit, *peeled = line.split()
+            version = parse_semver(tag)
+            if version is None or (lower and version <= lower):
+                continue
+            if upper and version >= upper:
+                continue
+            # annotated tags point to their commit through the tag object
+            versions.append((version, peeled[0] if peeled else commit))
+        commits = []
+        for _, commit in sorted(versions):
+            if commit in (base, tip, *commits):
+                continue
+            if self.is_ancestor(base, commit) and self.is_ancestor(commit, tip):
+                commits.append(commit)
+        return commits
+
+    def walk(self, base, tip):
+        """Parsed commits in `base..tip`, newest first, from the cache when it was
+        walked"""
+        cache_file = self.cache_dir / f"{base}..{tip}.json"
+        if cache_file.exists():
+            return json.loads(cache_file.read_text())
+        output = git("log", f"--format={LOG_FORMAT}", f"{base}..{tip}", cwd=self.path)
+        commits = []
+        for record in output.split("\x1e"):
+            if not record.strip():
+                continue
+            self.walked += 1
+            sha, subject, body = record.strip("\n").split("\x1f")
+            if not IGNORED.match(subject):
+                commits.append(parse_commit(sha, subject, body))
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.write(cache_file, commits)
+        return commits
+
+    def commits(self, since, until="HEAD"):
+        """Parsed commits between the `since` and `until` revisions, newest first"""
+        with span("changelog", repo=self.repo, since=since, until=until) as current:
+            base, tip = self.resolve(since, until)
+            ends = self.chain(base, tip)
+            if ends is None:
+                middle = self.tags_between(base, tip, since, until)
+                ends = [base, *middle, tip]
+                self.link({end: start for start, end in zip(ends, ends[1:])})
+            commits = {}
+            for start, end in reversed(list(zip(ends, ends[1:]))):
+                for commit in self.walk(start, end):
+                    commits.setdefault(commit["sha"], commit)
+            current.set(commits=len(commits), walked=self.walked)
+            return list(commits.values())
+
+    def notes(self, since, until="HEAD", url=None):
+        """Markdown release notes, one section per type of commit
+
+        With `url`, the repository on GitHub, every commit links to it.
+        """
+        commits = self.commits(since, until)
+        lines = []
+        for type_, title in SECTIONS.items():
+            section = [commit for commit in commits if commit["type"] == type_]
+            if not section:
+                continue
+            lines += ["", f"### {title}", ""]
+            for commit in section:
+                scope = f"**{commit['scope']}:** " if commit["scope"] else ""
+                sha = commit["sha"][:7]
+                link = f"[{sha}]({url}/commit/{commit['sha']})" if url else sha
+                lines.append(f"- {scope}{commit['description']} ({link})")
+        return "\n".join(lines).strip()
+
+
+def previous_tag(path, version):
+    """Release tag before `version` in the history of the repo at `path`, None if none"""
+    current = parse_semver(version)
+    if current is None:
+        return None
+    tags = git("tag", "--list", "--merged", "HEAD", cwd=path).split()
+    older = [
+        (parse_semver(tag), tag)
+        for tag in tags
+        if parse_semver(tag) is not None and parse_semver(tag) < current
+    ]
+    return max(older)[1] if older else None
+
+
+def library_history(name, url):
+    """Path of an up to date mirror of the commits of photopills/`name`"""
+    root = Path(MIRROR_PATH) / "history" if MIRROR_PATH else CACHE_PATH / "mirrors"
+    cache = MirrorCache(root)
+    mirror = cache.update(name, url, max_age=MAX_AGE, filter="tree:0")
+    # the git commands of the other bumps write the same config file
+    with cache.lock(name):
+        git("config", "fetch.writeCommitGraph", "true", cwd=mirror)
+        if not has_commit_graph(mirror):
+            try:
+                write_commit_graph(mirror)
+            except subprocess.CalledProcessError as exc:
+                # only slower without it
+                print(f"[changelog] no commit-graph: {exc.stderr.strip()}")
+    return mirror
+
+
+def release_notes(name, url, since, until):
+    """Notes of photopills/`name` between the `since` and `until` tags"""
+    changelog = Changelog(library_history(name, url), name)
+    return changelog.notes(since, until, f"https://github.com/photopills/{name}")
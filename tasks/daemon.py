@@ -0,0 +1,281 @@
+"""Long-running bump service driven by GitHub release webhooks
+
+Instead of starting a container per release, `invoke serve` keeps a process running
+that:
+
+- accepts `release` webhooks on POST /webhook, verified with the X-Hub-Signature-256
+  HMAC of WEBHOOK_SECRET
+- debounces the releases of each library: a burst of releases (e.g. 2.0.0 then a quick
+  2.0.1 fix) is bumped once, to the last one, `debounce` seconds after it
+- queues one bump job per consumer of the released library
+- cancels the bumps of a library still queued or running once a newer version of it
+  is released, their consumers get the newer one instead, and the open bump pull
+  request of a consumer is updated in place (see `bump_consumer`)
+- processes the jobs with a pool of workers sharing one GitHub session, one thread pool
+  and the consumer clones in `workspace`, which are fetched instead of cloned again on
+  every bump
+- reports its health and queue depth on GET /health
+
+>> invoke serve --library astrolib.py --consumer api --consumer web --workers 2
+"""
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from aiohttp import web
+
+from .bump import bump_consumer
+from .github import GitHubClient
+from .ledger import Ledger
+from .releases import parse_semver
+from .tracing import flush, span
+
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+# seconds to wait for a newer release of the same library before bumping it
+DEBOUNCE = float(os.getenv("BUMP_DEBOUNCE", 10))
+
+
+def verify_signature(secret, body, signature):
+    """Check the X-Hub-Signature-256 header GitHub sends with every delivery"""
+    if not secret or not signature:
+        return False
+    digest = hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(f"sha256={digest}", signature)
+
+
+def is_newer(version, current):
+    """Whether `version` supersedes `current`, the later release wins without semver"""
+    if current is None:
+        return True
+    new, old = parse_semver(version), parse_semver(current)
+    if new is None or old is None:
+        return version != current
+    return new > old
+
+
+class Job:
+    def __init__(self, library, version, consumer, delivery=None):
+        self.library = library
+        self.version = version
+        self.consumer = consumer
+        self.delivery = delivery
+        self.queued_at = time.monotonic()
+
+    @property
+    def key(self):
+        return (self.library, self.version, self.consumer)
+
+
+class BumpDaemon:
+    def __init__(
+        self,
+        libraries,
+        consumers,
+        workspace,
+        workers=2,
+        secret=WEBHOOK_SECRET,
+        debounce=DEBOUNCE,
+    ):
+        self.libraries = set(libraries)
+        self.consumers = list(consumers)
+        self.workspace = Path(workspace)
+        self.workers = workers
+        self.secret = secret
+        self.debounce = debounce
+        self.queue = asyncio.Queue()
+        # jobs queued or running, to ignore redelivered webhooks
+        self.pending = set()
+        # one bump at a time per consumer clone
+        self.locks = {consumer: asyncio.Lock() for consumer in self.consumers}
+        # newest release received of every library and the debounce timers
+        self.latest = {}
+        self.timers = {}
+        # tasks of the running jobs by job key; a cancelled job of a consumer may still
+        # be winding down when the newer one starts
+        self.running = {}
+        self.busy = 0
+        self.processed = 0
+        self.failed = 0
+        self.superseded = 0
+        self.last_error = None
+        self.started_at = time.time()
+        self.gh = None
+        self.executor = None
+        self.ledger = Ledger()
+        self.tasks = []
+
+    def enqueue(self, library, version, delivery=None):
+        """Queue a bump of `library` to `version` in every consumer, return the count"""
+        queued = 0
+        for consumer in self.consumers:
+            job = Job(library, version, consumer, delivery)
+            if job.key in self.pending:
+                continue
+            self.pending.add(job.key)
+            self.queue.put_nowait(job)
+            queued += 1
+        return queued
+
+    def receive(self, library, version, delivery=None):
+        """Handle a release of `library`, return False when a newer one was received
+
+        Bumps of older versions are cancelled right away; the new one is queued once no
+        newer release arrives for `debounce` seconds.
+        """
+        latest = self.latest.get(library)
+        if version != latest and not is_newer(version, latest):
+            return False
+        self.latest[library] = version
+        for (running_library, running, consumer), task in self.running.items():
+            if running_library == library and running != version:
+                print(f"[cancel] {consumer} {running}: superseded by {version}")
+                task.cancel()
+        timer = self.timers.pop(library, None)
+        if timer is not None:
+            timer.cancel()
+        if self.debounce:
+            self.timers[library] = asyncio.get_running_loop().call_later(
+                self.debounce, self.fire, library, version, delivery
+            )
+        else:
+            self.enqueue(library, version, delivery)
+        return True
+
+    def fire(self, library, version, delivery):
+        del self.timers[library]
+        self.enqueue(library, version, delivery)
+
+    async def run_job(self, job):
+        path = str(self.workspace / job.consumer)
+        attributes = {"repo": job.consumer, "version": job.version}
+        with span("daemon.job", delivery=job.delivery or "", **attributes) as current:
+            current.set(queued_s=round(time.monotonic() - job.queued_at, 3))
+            async with self.locks[job.consumer]:
+                pull = await bump_consumer(
+                    path,
+                    job.library,
+                    job.version,
+                    gh=self.gh,
+                    executor=self.executor,
+                    name=job.consumer,
+                    ledger=self.ledger,
+                )
+        return pull
+
+    async def process(self, job):
+        # its own task, so a newer release can cancel it without stopping the worker
+        task = asyncio.create_task(self.run_job(job))
+        self.running[job.key] = task
+        self.busy += 1
+        try:
+            await asyncio.wait([task])
+        finally:
+            self.busy -= 1
+            del self.running[job.key]
+            # spans are exported per job, the process doesn't exit between them
+            flush()
+        if task.cancelled():
+            self.superseded += 1
+        elif task.exception() is not None:
+            self.failed += 1
+            self.last_error = f"{job.consumer} {job.version}: {task.exception()!r}"
+            print(f"[failed] {self.last_error}")
+        else:
+            self.processed += 1
+            print(f"[ok]     {job.consumer}: {task.result().get('html_url')}")
+
+    async def worker(self):
+        while True:
+            job = await self.queue.get()
+            try:
+                if self.latest.get(job.library, job.version) != job.version:
+                    self.superseded += 1
+                    print(f"[skip]   {job.consumer} {job.version}: superseded")
+                    continue
+                await self.process(job)
+            finally:
+                self.pending.discard(job.key)
+                self.queue.task_done()
+
+    async def webhook(self, request):
+        body = await request.read()
+        signature = request.headers.get("X-Hub-Signature-256")
+        if not verify_signature(self.secret, body, signature):
+            return web.json_response({"message": "Invalid signature"}, status=401)
+
+        event = request.headers.get("X-GitHub-Event")
+        if event == "ping":
+            return web.json_response({"message": "pong"})
+        payload = json.loads(body)
+        if event != "release" or payload.get("action") != "published":
+            return web.json_response({"message": f"Ignored {event} event"})
+
+        library = payload["repository"]["name"]
+        if library not in self.libraries:
+            return web.json_response({"message": f"{library} has no consumers"})
+        version = payload["release"]["tag_name"]
+        delivery = request.headers.get("X-GitHub-Delivery")
+        if not self.receive(library, version, delivery):
+            latest = self.latest[library]
+            return web.json_response({"message": f"{version} superseded by {latest}"})
+        return web.json_response(
+            {"version": version, "debounce": self.debounce}, status=202
+        )
+
+    async def health(self, request):
+        return web.json_response(
+            {
+                "status": "ok",
+                "queue_depth": self.queue.qsize(),
+                "busy_workers": self.busy,
+                "workers": self.workers,
+                "processed": self.processed,
+                "failed": self.failed,
+                "superseded": self.superseded,
+                "debouncing": {library: self.latest[library] for library in self.timers},
+                "last_error": self.last_error,
+                "uptime": round(time.time() - self.started_at),
+            }
+        )
+
+    async def start(self, app):
+        """Open the shared session and start the workers with the web app"""
+        self.workspace.mkdir(parents=True, exist_ok=True)
+        self.gh = await GitHubClient().__aenter__()
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        self.tasks = [asyncio.create_task(self.worker()) for _ in range(self.workers)]
+
+    async def stop(self, app):
+        for timer in self.timers.values():
+            timer.cancel()
+        running = list(self.running.values())
+        for task in [*self.tasks, *running]:
+            task.cancel()
+        await asyncio.gather(*self.tasks, *running, return_exceptions=True)
+        self.executor.shutdown()
+        await self.gh.__aexit__(None, None, None)
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post("/webhook", self.webhook)
+        app.router.add_get("/health", self.health)
+        app.on_startup.append(self.start)
+        app.on_cleanup.append(self.stop)
+        return app
+
+
+def serve(
+    libraries, consumers, workspace, host="0.0.0.0", port=8080, workers=2, debounce=None
+):
+    if not WEBHOOK_SECRET:
+        raise RuntimeError("WEBHOOK_SECRET is needed to verify the webhooks")
+    debounce = DEBOUNCE if debounce is None else debounce
+    daemon = BumpDaemon(
+        libraries, consumers, workspace, workers=workers, debounce=debounce
+    )
+    web.run_app(daemon.app(), host=host, port=port)
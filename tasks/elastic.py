@@ -0,0 +1,390 @@
+"""Lifecycle of the Jaeger indices of our Elasticsearch (see elastic/)
+
+Jaeger writes daily `jaeger-span-*`/`jaeger-service-*` indices (or rollover ones behind
+`jaeger-*-write` aliases). `plan` decides what each of them needs, from the
+`_cat/indices` stats and the snapshots of the repository:
+
+- rollover: the write aliases, when their index is older than `rollover_age`
+- forcemerge: indices older than `merge_after` days with more segments than shards
+- snapshot: indices older than `snapshot_after` days not in any snapshot yet, batched
+  in multi-index snapshots of `batch` indices
+- delete: indices older than `delete_after` days, then the oldest ones until the total
+  fits `max_size`; only once they're snapshotted when there's a repository
+
+`run` executes the plan phase by phase, running the operations of a phase
+concurrently over one aiohttp session. Force merges and snapshots are started without
+waiting for completion and their task/status is polled, so they don't hold a connection
+for minutes. Before starting one we wait until the cluster runs fewer than `max_tasks`
+force merges or `max_snapshots` snapshots (ours or not) and has no more than
+`max_pending` pending cluster tasks. 429 rejections and concurrent snapshot errors are
+retried with backoff.
+
+>> invoke jaeger-lifecycle --dry-run
+>> invoke jaeger-lifecycle --delete-after 14 --max-size 500gb --repository s3
+"""
+import asyncio
+import itertools
+import os
+import random
+import re
+import time
+
+import aiohttp
+
+from .tracing import span
+
+ELASTICSEARCH_URL = os.getenv("ELASTICSEARCH_URL", "http://localhost:9200")
+SNAPSHOT_REPOSITORY = os.getenv("ES_SNAPSHOT_REPOSITORY", "s3")
+INDEX_PATTERN = "jaeger-span-*,jaeger-service-*,jaeger-dependencies-*"
+ALIAS_PATTERN = "jaeger-*-write"
+DAY = 24 * 3600
+# indices per DELETE request, to keep the URL short
+DELETE_BATCH = 50
+# errors worth retrying: the cluster is busy, not wrong
+RETRY_ERRORS = {
+    "es_rejected_execution_exception",
+    "circuit_breaking_exception",
+    "concurrent_snapshot_execution_exception",
+    "process_cluster_event_timeout_exception",
+}
+SIZE = re.compile(r"^(\d+(?:\.\d+)?)\s*([kmgtp]?b?)$", re.IGNORECASE)
+# date of the daily indices or counter of the rollover ones
+INDEX_SUFFIX = re.compile(r"-(\d{4}-\d{2}-\d{2}|\d{6})$")
+
+ROLLOVER, FORCEMERGE, SNAPSHOT, DELETE = "rollover", "forcemerge", "snapshot", "delete"
+PHASES = [ROLLOVER, FORCEMERGE, SNAPSHOT, DELETE]
+
+
+def parse_size(value):
+    """Bytes of "500gb", "1.5tb", "1024"..."""
+    if value is None or isinstance(value, int):
+        return value
+    match = SIZE.match(value.strip())
+    if match is None:
+        raise ValueError(f"Invalid size {value}")
+    number, unit = match.groups()
+    power = " kmgtp".index((unit[:1] or " ").lower())
+    return int(float(number) * 1024**power)
+
+
+class ElasticsearchError(Exception):
+    def __init__(self, status, body):
+        self.status = status
+        self.body = body
+        error = body.get("error") if isinstance(body, dict) else None
+        self.type = error.get("type") if isinstance(error, dict) else None
+        super().__init__(f"{status} {self.type or body}")
+
+
+class Elasticsearch:
+    """Minimal asyncio client of the ES REST API, with the throttling described above"""
+
+    def __init__(
+        self,
+        url=ELASTICSEARCH_URL,
+        concurrency=4,
+        max_tasks=1,
+        max_snapshots=2,
+        max_pending=10,
+        poll=1.0,
+        retries=6,
+        base_delay=0.5,
+        max_delay=30.0,
+    ):
+        self.url = url.rstrip("/")
+        self.concurrency = concurrency
+        self.max_tasks = max_tasks
+        self.max_snapshots = max_snapshots
+        self.max_pending = max_pending
+        self.poll = poll
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.session = None
+        self.semaphore = None
+        # held from the throttle check until the operation shows up in the cluster
+        self.starting = None
+        self.requests = 0
+
+    async def __aenter__(self):
+        self.session = aiohttp.ClientSession()
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.starting = asyncio.Lock()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    async def request(self, method, path, body=None, **params):
+        params = {
+            key: str(value).lower() if isinstance(value, bool) else str(value)
+            for key, value in params.items()
+        }
+        for attempt in itertools.count():
+            self.requests += 1
+            async with self.session.request(
+                method, f"{self.url}{path}", json=body, params=params
+            ) as response:
+                data = await response.json(content_type=None)
+            if response.status < 300:
+                return data
+            error = ElasticsearchError(response.status, data)
+            retry = response.status == 429 or error.type in RETRY_ERRORS
+            if not retry or attempt >= self.retries:
+                raise error
+            delay = min(self.max_delay, self.base_delay * 2**attempt)
+            await asyncio.sleep(random.uniform(delay / 2, delay))
+
+    async def indices(self, pattern=INDEX_PATTERN):
+        columns = "index,pri,rep,docs.count,store.size,creation.date,segments.count"
+        rows = await self.request(
+            "GET", f"/_cat/indices/{pattern}", format="json", bytes="b", h=columns
+        )
+        return [
+            {
+                "index": row["index"],
+                "shards": int(row["pri"]) * (int(row["rep"]) + 1),
+                "size": int(row["store.size"] or 0),
+                "created": int(row["creation.date"]) / 1000,
+                "segments": int(row["segments.count"] or 0),
+            }
+            for row in rows
+        ]
+
+    async def write_aliases(self, pattern=ALIAS_PATTERN):
+        """{alias: write index} of the rollover aliases"""
+        rows = await self.request("GET", f"/_cat/aliases/{pattern}", format="json")
+        return {
+            row["alias"]: row["index"]
+            for row in rows
+            if row.get("is_write_index") in ("true", "-", None)
+        }
+
+    async def snapshotted(self, repository):
+        """Indices in a successful snapshot of `repository`"""
+        data = await self.request("GET", f"/_snapshot/{repository}/_all")
+        return {
+            index
+            for snapshot in data["snapshots"]
+            if snapshot["state"] == "SUCCESS"
+            for index in snapshot["indices"]
+        }
+
+    async def running(self, operation):
+        """Force merges or snapshots the cluster is running right now"""
+        if operation == SNAPSHOT:
+            # snapshots run in the cluster state, not as tasks
+            data = await self.request("GET", "/_snapshot/_status")
+            return len(data["snapshots"])
+        data = await self.request(
+            "GET", "/_tasks", actions="indices:admin/forcemerge*", detailed=False
+        )
+        return sum(len(node["tasks"]) for node in data["nodes"].values())
+
+    async def throttle(self, operation):
+        """Wait until the cluster can take one more `operation`"""
+        limit = self.max_snapshots if operation == SNAPSHOT else self.max_tasks
+        while True:
+            running, pending = await asyncio.gather(
+                self.running(operation),
+                self.request("GET", "/_cluster/pending_tasks"),
+            )
+            if running < limit and len(pending["tasks"]) <= self.max_pending:
+                return
+            await asyncio.sleep(self.poll)
+
+    async def wait_for_task(self, task_id):
+        while True:
+            data = await self.request("GET", f"/_tasks/{task_id}")
+            if data.get("completed"):
+                if "error" in data:
+                    raise ElasticsearchError(500, data)
+                return data
+            await asyncio.sleep(self.poll)
+
+    async def rollover(self, alias, max_age):
+        async with self.semaphore:
+            with span("es.rollover", alias=alias) as current:
+                conditions = {"max_age": max_age}
+                data = await self.request(
+                    "POST", f"/{alias}/_rollover", {"conditions": conditions}
+                )
+                current.set(rolled_over=data.get("rolled_over", False))
+                return data
+
+    async def forcemerge(self, index):
+        async with self.semaphore:
+            with span("es.forcemerge", index=index):
+                async with self.starting:
+                    await self.throttle(FORCEMERGE)
+                    data = await self.request(
+                        "POST",
+                        f"/{index}/_forcemerge",
+                        max_num_segments=1,
+                        wait_for_completion=False,
+                    )
+                return await self.wait_for_task(data["task"])
+
+    async def snapshot(self, repository, name, indices):
+        async with self.semaphore:
+            with span("es.snapshot", snapshot=name, indices=len(indices)) as current:
+                body = {"indices": ",".join(indices), "include_global_state": False}
+                path = f"/_snapshot/{repository}/{name}"
+                async with self.starting:
+                    await self.throttle(SNAPSHOT)
+                    await self.request("PUT", path, body, wait_for_completion=False)
+                while True:
+                    data = await self.request("GET", f"{path}/_status")
+                    status = data["snapshots"][0]
+                    shards = status["shards_stats"]
+                    current.set(shards_done=shards["done"], shards_total=shards["total"])
+                    if status["state"] == "SUCCESS":
+                        return status
+                    if status["state"] in ("FAILED", "PARTIAL"):
+                        error = {"type": status["state"], "snapshot": name}
+                        raise ElasticsearchError(500, {"error": error})
+                    await asyncio.sleep(self.poll)
+
+    async def delete(self, indices):
+        async with self.semaphore:
+            with span("es.delete", indices=len(indices)):
+                return await self.request("DELETE", f"/{','.join(indices)}")
+
+
+def plan(
+    indices,
+    aliases=None,
+    snapshotted=None,
+    now=None,
+    rollover_age=None,
+    merge_after=1,
+    snapshot_after=1,
+    delete_after=None,
+    max_size=None,
+    batch=20,
+):
+    """[(action, target)] to apply, in phase order
+
+    `snapshotted` is None without a snapshot repository: nothing is snapshotted and
+    indices are deleted without one.
+    """
+    now = time.time() if now is None else now
+    aliases = aliases or {}
+    writing = set(aliases.values())
+    by_name = {index["index"]: index for index in indices}
+    oldest_first = sorted(indices, key=lambda index: index["created"])
+
+    def age(index):
+        return (now - index["created"]) / DAY
+
+    steps = []
+    if rollover_age:
+        steps += [(ROLLOVER, alias) for alias in sorted(aliases)]
+
+    # the newest index of every kind is still being written too
+    newest = {}
+    for index in oldest_first:
+        newest[INDEX_SUFFIX.sub("", index["index"])] = index["index"]
+    active = writing | set(newest.values())
+
+    for index in oldest_first:
+        if index["index"] in active or age(index) < merge_after:
+            continue
+        if index["segments"] > index["shards"]:
+            steps.append((FORCEMERGE, index["index"]))
+
+    will_snapshot = set()
+    if snapshotted is not None:
+        missing = [
+            index["index"]
+            for index in oldest_first
+            if index["index"] not in active
+            if index["index"] not in snapshotted and age(index) >= snapshot_after
+        ]
+        will_snapshot = set(missing)
+        for start in range(0, len(missing), batch):
+            steps.append((SNAPSHOT, missing[start : start + batch]))
+
+    deleted = []
+    total = sum(index["size"] for index in indices)
+    for index in oldest_first:
+        name = index["index"]
+        old = delete_after is not None and age(index) >= delete_after
+        too_big = max_size is not None and total > max_size
+        if name in active or not (old or too_big):
+            continue
+        if snapshotted is not None and name not in snapshotted | will_snapshot:
+            print(f"[keep] {name}: not snapshotted yet")
+            continue
+        deleted.append(name)
+        total -= by_name[name]["size"]
+    for start in range(0, len(deleted), DELETE_BATCH):
+        steps.append((DELETE, deleted[start : start + DELETE_BATCH]))
+    return steps
+
+
+def print_plan(steps):
+    for action, target in steps:
+        if isinstance(target, list):
+            target = f"{len(target)} indices: {', '.join(target)}"
+        print(f"{action:<12}{target}")
+
+
+async def run(es, steps, repository=SNAPSHOT_REPOSITORY, rollover_age="1d"):
+    """Run the plan phase by phase; a failed operation stops it before the next phase,
+    so nothing is deleted unless its snapshot succeeded"""
+    prefix = f"jaeger-{time.strftime('%Y.%m.%d-%H%M%S')}"
+    snapshot_names = (f"{prefix}-{n}" for n in itertools.count())
+    operations = {
+        ROLLOVER: lambda alias: es.rollover(alias, rollover_age),
+        FORCEMERGE: es.forcemerge,
+        SNAPSHOT: lambda indices: es.snapshot(repository, next(snapshot_names), indices),
+        DELETE: es.delete,
+    }
+    for phase in PHASES:
+        targets = [target for action, target in steps if action == phase]
+        if not targets:
+            continue
+        start = time.monotonic()
+        results = await asyncio.gather(
+            *(operations[phase](target) for target in targets), return_exceptions=True
+        )
+        failed = [
+            (target, result)
+            for target, result in zip(targets, results)
+            if isinstance(result, Exception)
+        ]
+        for target, error in failed:
+            print(f"[failed] {phase} {target}: {error!r}")
+        done = f"{len(targets) - len(failed)}/{len(targets)}"
+        print(f"{phase}: {done} in {time.monotonic() - start:.1f}s")
+        if failed:
+            raise RuntimeError(f"{len(failed)} {phase} operations failed")
+
+
+async def lifecycle(
+    url=ELASTICSEARCH_URL,
+    repository=SNAPSHOT_REPOSITORY,
+    dry_run=False,
+    concurrency=4,
+    max_tasks=1,
+    max_snapshots=2,
+    poll=1.0,
+    **policy,
+):
+    """Plan the lifecycle of the Jaeger indices at `url` and run it
+
+    `policy` are the `plan` arguments. Returns the plan and the requests it took.
+    """
+    client = Elasticsearch(url, concurrency, max_tasks, max_snapshots, poll=poll)
+    async with client as es:
+        indices, aliases, snapshotted = await asyncio.gather(
+            es.indices(),
+            es.write_aliases(),
+            es.snapshotted(repository) if repository else asyncio.sleep(0),
+        )
+        steps = plan(indices, aliases, snapshotted, **policy)
+        print_plan(steps)
+        if not dry_run:
+            await run(es, steps, repository, policy.get("rollover_age") or "1d")
+        return steps, es.requests
@@ -1,55 +1,313 @@
+import asyncio
+import functools
+import json
 import os
+import sqlite3
+import time
+from collections.abc import MutableMapping
+from contextlib import aclosing, asynccontextmanager
+from pathlib import Path
+
 import aiohttp
+from gidgethub import BadRequest
 from gidgethub import aiohttp as gh_aiohttp
-import pendulum
+from gidgethub import sansio
+
+from .auth import github_app
+from .graphql import Batcher, create_pull_requests, latest_releases
+from .ratelimit import Scheduler
+from .releases import ReleaseIndex
+from .tracing import current_span, span
+
+CACHE_PATH = Path(
+    os.getenv("GITHUB_CACHE_PATH", Path.home() / ".cache" / "photopills" / "github")
+)
+# branches of the bump pull requests, followed by the version
+BUMP_BRANCH_PREFIX = "auto/bumps_to_version_"
+# "rest" or "graphql", see tasks.graphql
+BACKEND = os.getenv("GITHUB_BACKEND", "rest")
+# comma separated, added to every bump pull request
+PULL_REQUEST_LABELS = os.getenv("PULL_REQUEST_LABELS", "")
+PULL_REQUEST_REVIEWERS = os.getenv("PULL_REQUEST_REVIEWERS", "")
+
+
+class ResponseCache(MutableMapping):
+    """Responses of the GET requests by URL, with their ETag, in SQLite at `path`
+
+    The daemon, the CLI jobs and all their clients share it: WAL journaling lets them
+    read and write it at the same time. A database error is a cache miss, the request
+    is sent without its ETag.
+    """
+
+    def __init__(self, path):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(str(path), timeout=5)
+        with self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(url TEXT PRIMARY KEY, response TEXT NOT NULL)"
+            )
+
+    def execute(self, sql, parameters=()):
+        with self.connection:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def __getitem__(self, url):
+        try:
+            rows = self.execute("SELECT response FROM responses WHERE url = ?", (url,))
+        except sqlite3.Error:
+            rows = []
+        if not rows:
+            raise KeyError(url)
+        return json.loads(rows[0][0])
+
+    def __setitem__(self, url, response):
+        try:
+            self.execute(
+                "INSERT OR REPLACE INTO responses (url, response) VALUES (?, ?)",
+                (url, json.dumps(response)),
+            )
+        except sqlite3.Error as exc:
+            print(f"[github] response of {url} not cached: {exc}")
+
+    def __delitem__(self, url):
+        self.execute("DELETE FROM responses WHERE url = ?", (url,))
+
+    def __iter__(self):
+        return iter([row[0] for row in self.execute("SELECT url FROM responses")])
+
+    def __len__(self):
+        return self.execute("SELECT COUNT(*) FROM responses")[0][0]
+
+    def close(self):
+        self.connection.close()
+
+
+class GitHubClient(gh_aiohttp.GitHubAPI):
+    """Long-lived GitHub API client shared by every operation in this module
+
+    It owns a single pooled aiohttp session, so keep-alive connections are reused instead
+    of paying a new TCP/TLS handshake per call, and a persistent on-disk response cache.
+    Cached GET responses are sent back with If-None-Match/If-Modified-Since; a 304 answer
+    doesn't count against the rate limit. Every request is queued in a `Scheduler` that
+    keeps it within the rate limits.
+
+    Requests are authenticated as the GitHub App of the environment when there's one
+    (see tasks.auth), unless a `token` is given, otherwise with GITHUB_TOKEN.
+
+    With the graphql `backend`, release lookups and pull requests are batched.
+
+    async with GitHubClient() as gh:
+        await get_last_release_tag("astrolib.py", gh=gh)
+    """
+
+    def __init__(
+        self,
+        token=None,
+        requester="fullonic",
+        cache_path=CACHE_PATH,
+        base_url=None,
+        limit=10,
+        scheduler=None,
+        backend=BACKEND,
+        app=None,
+    ):
+        self.app = app or (None if token else github_app())
+        if self.app is None:
+            token = token or os.getenv("GITHUB_TOKEN")
+        super().__init__(
+            None,
+            requester,
+            oauth_token=token,
+            base_url=base_url or os.getenv("GITHUB_API_URL", sansio.DOMAIN),
+        )
+        self.cache_path = cache_path
+        self.limit = limit
+        self.scheduler = scheduler or Scheduler()
+        self.backend = backend
+        self.release_batch = Batcher(functools.partial(latest_releases, self), wait=0.05)
+        self.pull_batch = Batcher(functools.partial(create_pull_requests, self))
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.limit, keepalive_timeout=60)
+        self._session = aiohttp.ClientSession(connector=connector)
+        if self.cache_path:
+            try:
+                self._cache = ResponseCache(self.cache_path)
+            except sqlite3.Error as exc:
+                # only slower without it
+                print(f"[github] no response cache at {self.cache_path}: {exc}")
+                self._cache = None
+        return self
 
+    async def _request(self, method, url, headers, body=b""):
+        with span("github.request", method=method, url=url) as current:
+            # the app's own calls are authenticated with its JWT instead
+            if self.app and not headers.get("authorization", "").startswith("bearer"):
+                headers["authorization"] = f"token {await self.app.token(self)}"
+            send = functools.partial(super()._request, method, url, headers, body)
+            response = await self.scheduler.request(method, url, send)
+            status, response_headers, _ = response
+            current.set(
+                status=status,
+                rate_limit_remaining=response_headers.get("x-ratelimit-remaining", ""),
+            )
+            return response
 
-async def create_new_release(new_version: str, repo: str):
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        metrics = self.scheduler.metrics()
+        current = current_span()
+        if current is not None:
+            current.set(**{f"github.{key}": value for key, value in metrics.items()})
+        if metrics["throttled_requests"]:
+            print(self.scheduler.report())
+        await self._session.close()
+        if self._cache is not None:
+            self._cache.close()
+            self._cache = None
+
+
+@asynccontextmanager
+async def github_session(gh=None):
+    """Yield a GitHub client, reusing `gh` when the caller already has one open"""
+    if gh is not None:
+        yield gh
+        return
+    async with GitHubClient() as gh:
+        yield gh
+
+
+async def create_new_release(new_version: str, repo: str, gh=None, body=None):
+    """Publish the release of `new_version`, with the release notes `body` if any"""
     if not new_version.startswith("v"):
         new_version = f"v{new_version}"
 
-    token = os.getenv("GITHUB_TOKEN")
-    async with aiohttp.ClientSession() as session:
-        gh = gh_aiohttp.GitHubAPI(session, "fullonic", oauth_token=token)
-        tag = await gh.post(
-            f"https://api.github.com/repos/photopills/{repo}/releases",
-            data={"tag_name": new_version, "name": f"{new_version} release"},
-        )
+    data = {"tag_name": new_version, "name": f"{new_version} release"}
+    if body:
+        data["body"] = body
+    async with github_session(gh) as gh:
+        tag = await gh.post(f"/repos/photopills/{repo}/releases", data=data)
         return tag
 
 
-async def get_last_release_tag(repo) -> str:
-    """Return last created tag based on published_at timestamp"""
-    token = os.getenv("GITHUB_TOKEN")
-    async with aiohttp.ClientSession() as session:
-        gh = gh_aiohttp.GitHubAPI(session, "fullonic", oauth_token=token)
-        tags = await gh.getitem(
-            f"/repos/photopills/{repo}/releases",
-        )
-    release_index = 0
-    last_release = pendulum.parse(tags.pop()["published_at"])
-    for idx, tag in enumerate(tags):
-        dt = pendulum.parse(tag["published_at"])
-        if last_release < dt:
-            last_release = dt
-            release_index = idx
-    print(tags[release_index]["tag_name"])
-    return tags[release_index]["tag_name"]
-
-
-async def create_pull_request(branch_name, repo, new_version, old_version):
+async def get_last_release_tag(repo, gh=None, match=None, prerelease=True) -> str:
+    """Return last created tag based on published_at timestamp
+
+    `match` restricts the lookup to a version prefix ("2.x") and `prerelease=False` skips
+    prereleases. Releases are read from the local ReleaseIndex, which only fetches the
+    pages published since the last call.
+
+    With the graphql backend, lookups without `match` are batched with the ones of other
+    repos made at the same time.
+    """
+    async with github_session(gh) as gh:
+        if match is None and gh.backend == "graphql":
+            tag = await gh.release_batch.submit((repo, prerelease))
+            print(tag)
+            return tag
+        index = await ReleaseIndex.load(repo).refresh(gh)
+    if match is not None:
+        release = index.latest_matching(match, prerelease=prerelease)
+    else:
+        release = index.latest(prerelease=prerelease)
+    if release is None:
+        raise LookupError(f"There isn't any release of {repo} matching {match}")
+    print(release.tag)
+    return release.tag
+
+
+async def wait_for_branch(repo, branch, gh=None, timeout=30, delay=0.25, max_delay=4):
+    """Wait until GitHub sees the `branch` we just pushed
+
+    Polls the branch with exponential backoff, starting at `delay` seconds, instead of
+    sleeping a fixed amount of time: most of the times it's already there on the first
+    try. Raises TimeoutError when it isn't visible after `timeout` seconds.
+    """
+    deadline = time.monotonic() + timeout
+    async with github_session(gh) as gh:
+        while True:
+            try:
+                return await gh.getitem(f"/repos/photopills/{repo}/branches/{branch}")
+            except BadRequest as exc:
+                if exc.status_code != 404:
+                    raise
+            if time.monotonic() + delay > deadline:
+                raise TimeoutError(f"Branch {branch} of {repo} isn't visible on GitHub")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, max_delay)
+
+
+def split(value):
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+def pull_request_text(repo, new_version, old_version, notes=None):
+    """Title and body of a bump pull request, `notes` are the release notes between
+    both versions (see `tasks.changelog`)"""
+    repo_url = f"https://github.com/photopills/{repo}"
+    title = f"Bumps {repo} from {old_version} to {new_version}"
+    body = f"Bumps [{repo}]({repo_url}) from {old_version} to {new_version}"
+    if notes:
+        summary = "<details>\n<summary>Release notes</summary>"
+        body += f"\n\n{summary}\n\n{notes}\n</details>"
+    return title, body
+
+
+async def create_pull_request(
+    branch_name,
+    repo,
+    new_version,
+    old_version,
+    gh=None,
+    labels=None,
+    reviewers=None,
+    notes=None,
+):
     # https://docs.github.com/en/github-ae@latest/rest/reference/pulls#create-a-pull-request
     head = branch_name
     base = "master"
-    token = os.getenv("GITHUB_TOKEN")
-    async with aiohttp.ClientSession() as session:
-        gh = gh_aiohttp.GitHubAPI(session, "fullonic", oauth_token=token)
-        pull_url = (f"/repos/photopills/{repo}/pulls",)
-        repo_url = f"https://github.com/photopills/{repo}"
-
-        title = f"Bumps {repo} from {old_version} to {new_version}"
-        body = f"Bumps [{repo}]({repo_url}) from {old_version} to {new_version}"
+    labels = split(PULL_REQUEST_LABELS) if labels is None else labels
+    reviewers = split(PULL_REQUEST_REVIEWERS) if reviewers is None else reviewers
+    async with github_session(gh) as gh:
+        pull_url = f"/repos/photopills/{repo}/pulls"
+        title, body = pull_request_text(repo, new_version, old_version, notes)
+        if gh.backend == "graphql":
+            pull = {"repo": repo, "head": head, "base": base, "title": title}
+            pull.update(body=body, labels=labels, reviewers=reviewers)
+            return await gh.pull_batch.submit(pull)
+
         info = await gh.post(
             pull_url, data={"head": head, "base": base, "title": title, "body": body}
         )
+        requests = []
+        if labels:
+            labels_url = f"/repos/photopills/{repo}/issues/{info['number']}/labels"
+            requests.append(gh.post(labels_url, data={"labels": labels}))
+        if reviewers:
+            reviewers_url = f"{pull_url}/{info['number']}/requested_reviewers"
+            requests.append(gh.post(reviewers_url, data={"reviewers": reviewers}))
+        await asyncio.gather(*requests)
         return info
+
+
+async def find_bump_pull_request(repo, gh=None):
+    """Open bump pull request of `repo`, None when there isn't any"""
+    url = f"/repos/photopills/{repo}/pulls?state=open&base=master"
+    async with github_session(gh) as gh:
+        async with aclosing(gh.getiter(url)) as pulls:
+            async for pull in pulls:
+                if pull["head"]["ref"].startswith(BUMP_BRANCH_PREFIX):
+                    return pull
+    return None
+
+
+async def update_pull_request(
+    number, repo, new_version, old_version, gh=None, notes=None
+):
+    """Retitle the bump pull request `number` after its branch moved to `new_version`"""
+    title, body = pull_request_text(repo, new_version, old_version, notes)
+    async with github_session(gh) as gh:
+        url = f"/repos/photopills/{repo}/pulls/{number}"
+        return await gh.patch(url, data={"title": title, "body": body})
@@ -0,0 +1,300 @@
+"""GraphQL backend of `tasks.github`, enabled with GITHUB_BACKEND=graphql
+
+With REST every repo costs its own round trips: one for its releases, one to create each
+pull request and one more for each of its labels and reviewers. GraphQL lets us ask for
+many repositories, or run many mutations, in a single request using aliases:
+
+query($owner: String!, $name0: String!, $name1: String!) {
+  repo0: repository(owner: $owner, name: $name0) { releases(...) { ... } }
+  repo1: repository(owner: $owner, name: $name1) { releases(...) { ... } }
+}
+
+Calls made at about the same time (e.g. by the pipelines of a fan-out) are collected by a
+`Batcher` and sent together, so bumping N consumers takes a handful of requests instead
+of O(N). Big batches are split in chunks to stay under the query cost limits.
+"""
+import asyncio
+import functools
+
+from gidgethub import QueryError
+
+OWNER = "photopills"
+# repositories per release query, each one asks for RELEASES_PER_REPO nodes
+REPOS_PER_QUERY = 50
+RELEASES_PER_REPO = 10
+# mutations per request, GitHub asks to keep them small to avoid secondary limits
+MUTATIONS_PER_REQUEST = 20
+
+RELEASE_FIELDS = "tagName publishedAt isPrerelease isDraft"
+# the newest releases, and the latest stable one for the repos whose newest
+# RELEASES_PER_REPO are all prereleases or drafts
+RELEASES_FIELDS = f"""releases(first: {RELEASES_PER_REPO}, orderBy: {{field: CREATED_AT,
+direction: DESC}}) {{ nodes {{ {RELEASE_FIELDS} }} }}
+latestRelease {{ {RELEASE_FIELDS} }}"""
+PULL_REQUEST_FIELDS = "pullRequest { id number url }"
+
+
+def chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start : start + size]
+
+
+def graphql_endpoint(base_url):
+    """GraphQL URL of the REST API at `base_url`, GitHub Enterprise included"""
+    base_url = base_url.rstrip("/")
+    if base_url.endswith("/api/v3"):
+        return base_url[: -len("/v3")] + "/graphql"
+    return f"{base_url}/graphql"
+
+
+async def run(gh, document, variables):
+    """Run `document`, returning the data of the aliases that succeeded and the errors
+    of the rest by alias"""
+    endpoint = graphql_endpoint(gh.base_url)
+    try:
+        return await gh.graphql(document, endpoint=endpoint, **variables), {}
+    except QueryError as exc:
+        errors = {}
+        for error in exc.response.get("errors", []):
+            alias = (error.get("path") or ["*"])[0]
+            errors[alias] = error.get("message", "GraphQL error")
+        return exc.response.get("data") or {}, errors
+
+
+async def latest_releases(gh, lookups):
+    """Latest release tag of every (repo, prerelease) lookup, in as few queries as
+    possible. A lookup without releases gets a LookupError instead of a tag."""
+    results = []
+    for chunk in chunks(lookups, REPOS_PER_QUERY):
+        variables = {"owner": OWNER}
+        declarations, fields = ["$owner: String!"], []
+        for index, (repo, _) in enumerate(chunk):
+            variables[f"name{index}"] = repo
+            declarations.append(f"$name{index}: String!")
+            fields.append(
+                f"repo{index}: repository(owner: $owner, name: $name{index}) "
+                f"{{ {RELEASES_FIELDS} }}"
+            )
+        document = f"query({', '.join(declarations)}) {{\n{chr(10).join(fields)}\n}}"
+        data, errors = await run(gh, document, variables)
+        for index, (repo, prerelease) in enumerate(chunk):
+            alias = f"repo{index}"
+            if data.get(alias) is None:
+                message = errors.get(alias, errors.get("*", "Not found"))
+                results.append(LookupError(f"Releases of {repo}: {message}"))
+                continue
+            nodes = data[alias]["releases"]["nodes"] + [data[alias]["latestRelease"]]
+            releases = [
+                release
+                for release in nodes
+                if release and release["publishedAt"] and not release["isDraft"]
+                if prerelease or not release["isPrerelease"]
+            ]
+            if not releases:
+                results.append(LookupError(f"There isn't any release of {repo}"))
+                continue
+            latest = max(releases, key=lambda release: release["publishedAt"])
+            results.append(latest["tagName"])
+    return results
+
+
+async def node_ids(gh, repos, logins):
+    """Node ids of `repos` (with their labels by name) and of the users in `logins`"""
+    variables = {"owner": OWNER}
+    declarations, fields = ["$owner: String!"], []
+    for index, repo in enumerate(repos):
+        variables[f"name{index}"] = repo
+        declarations.append(f"$name{index}: String!")
+        fields.append(
+            f"repo{index}: repository(owner: $owner, name: $name{index}) "
+            "{ id labels(first: 100) { nodes { id name } } }"
+        )
+    for index, login in enumerate(logins):
+        variables[f"login{index}"] = login
+        declarations.append(f"$login{index}: String!")
+        fields.append(f"user{index}: user(login: $login{index}) {{ id }}")
+    document = f"query({', '.join(declarations)}) {{\n{chr(10).join(fields)}\n}}"
+    data, _ = await run(gh, document, variables)
+
+    repo_ids, labels = {}, {}
+    for index, repo in enumerate(repos):
+        node = data.get(f"repo{index}")
+        if node:
+            repo_ids[repo] = node["id"]
+            nodes = node["labels"]["nodes"]
+            labels[repo] = {label["name"]: label["id"] for label in nodes}
+    user_ids = {}
+    for index, login in enumerate(logins):
+        node = data.get(f"user{index}")
+        if node:
+            user_ids[login] = node["id"]
+    return repo_ids, labels, user_ids
+
+
+async def mutate(gh, name, input_type, inputs, fields):
+    """Run the `name` mutation once per input, in chunked aliased requests
+
+    Returns the result, or the error message, of every input.
+    """
+    results = []
+    for chunk in chunks(inputs, MUTATIONS_PER_REQUEST):
+        variables = {f"input{index}": value for index, value in enumerate(chunk)}
+        declarations = ", ".join(
+            f"$input{index}: {input_type}!" for index in range(len(chunk))
+        )
+        body = "\n".join(
+            f"m{index}: {name}(input: $input{index}) {{ {fields} }}"
+            for index in range(len(chunk))
+        )
+        document = f"mutation({declarations}) {{\n{body}\n}}"
+        data, errors = await run(gh, document, variables)
+        for index in range(len(chunk)):
+            alias = f"m{index}"
+            if data.get(alias) is None:
+                message = errors.get(alias, errors.get("*", f"{name} failed"))
+                results.append(RuntimeError(message))
+            else:
+                results.append(data[alias])
+    return results
+
+
+async def create_pull_requests(gh, pulls):
+    """Create every pull request of `pulls`, with its labels and reviewers
+
+    Each pull is a dict with repo, head, base, title, body, labels and reviewers. It
+    takes one query for the node ids, one mutation request to create the pull requests
+    and one more for all their labels and reviews, chunks aside.
+    """
+    repos = sorted({pull["repo"] for pull in pulls})
+    logins = sorted({login for pull in pulls for login in pull.get("reviewers", ())})
+    repo_ids, labels, user_ids = await node_ids(gh, repos, logins)
+
+    results = [None] * len(pulls)
+    created = []
+    for index, pull in enumerate(pulls):
+        if pull["repo"] not in repo_ids:
+            results[index] = LookupError(f"Repository {pull['repo']} not found")
+        else:
+            created.append(index)
+    inputs = [
+        {
+            "repositoryId": repo_ids[pulls[index]["repo"]],
+            "baseRefName": pulls[index]["base"],
+            "headRefName": pulls[index]["head"],
+            "title": pulls[index]["title"],
+            "body": pulls[index]["body"],
+        }
+        for index in created
+    ]
+    responses = await mutate(
+        gh, "createPullRequest", "CreatePullRequestInput", inputs, PULL_REQUEST_FIELDS
+    )
+
+    label_inputs, review_inputs = [], []
+    for index, response in zip(created, responses):
+        if isinstance(response, Exception):
+            results[index] = response
+            continue
+        pull_request = response["pullRequest"]
+        # same fields as the REST answer that the callers read
+        results[index] = {
+            "node_id": pull_request["id"],
+            "number": pull_request["number"],
+            "html_url": pull_request["url"],
+        }
+        repo_labels = labels[pulls[index]["repo"]]
+        label_ids = [
+            repo_labels[name]
+            for name in pulls[index].get("labels", ())
+            if name in repo_labels
+        ]
+        if label_ids:
+            label_inputs.append(
+                {"labelableId": pull_request["id"], "labelIds": label_ids}
+            )
+        reviewer_ids = [
+            user_ids[login]
+            for login in pulls[index].get("reviewers", ())
+            if login in user_ids
+        ]
+        if reviewer_ids:
+            review_inputs.append(
+                {"pullRequestId": pull_request["id"], "userIds": reviewer_ids}
+            )
+
+    await asyncio.gather(
+        mutate(
+            gh,
+            "addLabelsToLabelable",
+            "AddLabelsToLabelableInput",
+            label_inputs,
+            "clientMutationId",
+        ),
+        mutate(
+            gh, "requestReviews", "RequestReviewsInput", review_inputs, "clientMutationId"
+        ),
+    )
+    return results
+
+
+class Batcher:
+    """Collect the items submitted at about the same time and send them in one call
+
+    `send(items)` returns one result per item, an exception instance fails only the
+    submitter of that item. A batch is sent `wait` seconds after its first item or as
+    soon as it has `size` items.
+    """
+
+    def __init__(self, send, size=50, wait=0.5):
+        self.send = send
+        self.size = size
+        self.wait = wait
+        self.items = []
+        self.timer = None
+        # the loop only keeps weak references to the tasks sending the batches
+        self.tasks = set()
+
+    async def submit(self, item):
+        future = asyncio.get_running_loop().create_future()
+        self.items.append((item, future))
+        if len(self.items) >= self.size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.wait, self.flush)
+        return await future
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.items = self.items, []
+        if batch:
+            task = asyncio.ensure_future(self.send_batch(batch))
+            self.tasks.add(task)
+            task.add_done_callback(functools.partial(self.sent, batch))
+
+    async def send_batch(self, batch):
+        try:
+            results = await self.send([item for item, _ in batch])
+            if len(results) != len(batch):
+                raise RuntimeError(f"{len(results)} results for {len(batch)} items")
+        except Exception as exc:
+            results = [exc] * len(batch)
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def sent(self, batch, task):
+        """Fail the submitters the task left waiting, when it was cancelled or failed"""
+        self.tasks.discard(task)
+        for _, future in batch:
+            if future.done():
+                continue
+            if task.cancelled():
+                future.cancel()
+            else:
+                future.set_exception(task.exception() or RuntimeError("No result"))
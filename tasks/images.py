@@ -0,0 +1,314 @@
+"""Incremental builds of the runner images
+
+Every image is keyed by a hash of its inputs: its Dockerfile, the files of the build
+context it actually copies (COPY/ADD sources, e.g. `tasks/` for the python image) and
+the keys of the images it's built FROM. The wheelhouse is hashed by the names of its
+files only (see NAME_ONLY). Each build is also pushed under a
+`<tag>-<key>` content tag, so the next run can tell which images are already built:
+
+- build: the inputs changed, build it (and push it)
+- tag: an image with the same inputs exists, just point its tags to it
+
+Images are built in dependency order (debug waits for alpine), the independent ones in
+parallel, as a `Pipeline`. Base images from other registries aren't hashed: they're
+pinned by tag in the Dockerfiles, bump the tag (or use --force) to rebuild.
+
+>> invoke build-images --dry-run
+>> invoke build-images --push --image python
+"""
+import asyncio
+import hashlib
+import json
+import re
+import shlex
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
+
+from .pipeline import Pipeline
+
+ROOT = Path(__file__).resolve().parent.parent
+REPOSITORY = "photopills/runner"
+# not part of what a build sees in a clean checkout
+IGNORED = {"__pycache__", ".git", ".pytest_cache"}
+# hashed by their names only: wheels built from sdists and git aren't byte for byte
+# reproducible, but they're named after their version and the wheelhouse manifests
+# after the hash of the locked requirements they were built for (see tasks.wheelhouse)
+NAME_ONLY = {"wheelhouse"}
+
+BUILD, TAG = "build", "tag"
+
+
+class Image:
+    def __init__(self, name, dockerfile, tags=None, check=None):
+        self.name = name
+        self.dockerfile = dockerfile
+        self.tags = tags or [f"{REPOSITORY}:{name}"]
+        # command run in the new image before it's pushed, "{image}" is its tag
+        self.check = check
+
+    def content_tag(self, key):
+        return f"{self.tags[0]}-{key[:12]}"
+
+
+IMAGES = [
+    Image("alpine", "Dockerfile", tags=[f"{REPOSITORY}:alpine", f"{REPOSITORY}:latest"]),
+    Image("debug", "Dockerfile.debug"),
+    Image(
+        "python",
+        "Dockerfile.python",
+        check=(
+            "docker run --rm -v {root}/benchmarks:/benchmarks -w / {image} "
+            "python -m benchmarks.startup --tasks-dir /tasks --budget 500"
+        ),
+    ),
+    Image("argocd", "Dockerfile.argocd"),
+]
+
+
+def instructions(dockerfile):
+    """(instruction, arguments) of every line of `dockerfile`, continuations joined"""
+    lines, current = [], ""
+    for line in Path(dockerfile).read_text().splitlines():
+        stripped = line.strip()
+        # comments can sit between the continuation lines of a RUN too
+        if not stripped or stripped.startswith("#"):
+            continue
+        current += " " + stripped.rstrip("\\")
+        if not stripped.endswith("\\"):
+            lines.append(current.strip())
+            current = ""
+    if current:
+        lines.append(current.strip())
+    for line in lines:
+        instruction, _, arguments = line.partition(" ")
+        yield instruction.upper(), arguments.strip()
+
+
+def parse(dockerfile):
+    """Base images and build context sources of `dockerfile`"""
+    bases, sources = [], []
+    for instruction, arguments in instructions(dockerfile):
+        if instruction == "FROM":
+            words = [word for word in arguments.split() if not word.startswith("--")]
+            bases.append(words[0])
+        elif instruction in ("COPY", "ADD"):
+            if arguments.startswith("["):
+                words = json.loads(arguments)
+            else:
+                words = shlex.split(arguments)
+            if any(word.startswith("--from") for word in words):
+                continue
+            words = [word for word in words if not word.startswith("--")]
+            sources.extend(
+                word for word in words[:-1] if not re.match(r"^[a-z]+://", word)
+            )
+    return bases, sources
+
+
+def context_files(root, sources):
+    """Every file of the build context under `sources`, relative to `root`"""
+    files = set()
+    for source in sources:
+        for path in Path(root).glob(source.lstrip("/")):
+            candidates = path.rglob("*") if path.is_dir() else [path]
+            for candidate in candidates:
+                relative = candidate.relative_to(root)
+                if candidate.is_file() and not IGNORED & set(relative.parts):
+                    if candidate.suffix != ".pyc":
+                        files.add(relative)
+    return sorted(files)
+
+
+def dependencies(images, root=ROOT):
+    """Names of the images of `images` that each one is built FROM"""
+    by_tag = {tag: image.name for image in images for tag in image.tags}
+    return {
+        image.name: [
+            by_tag[base]
+            for base in parse(Path(root) / image.dockerfile)[0]
+            if base in by_tag
+        ]
+        for image in images
+    }
+
+
+def input_keys(images, root=ROOT):
+    """Content hash of the inputs of every image, by name"""
+    depends = dependencies(images, root)
+    by_name = {image.name: image for image in images}
+    keys = {}
+
+    def key(name):
+        if name not in keys:
+            image = by_name[name]
+            digest = hashlib.sha256()
+            dockerfile = Path(root) / image.dockerfile
+            digest.update(dockerfile.read_bytes())
+            for path in context_files(root, parse(dockerfile)[1]):
+                digest.update(f"\0{path.as_posix()}\0".encode())
+                if path.parts[0] not in NAME_ONLY:
+                    digest.update((Path(root) / path).read_bytes())
+            for base in depends[name]:
+                digest.update(f"\0{base}={key(base)}".encode())
+            keys[name] = digest.hexdigest()
+        return keys[name]
+
+    for image in images:
+        key(image.name)
+    return keys
+
+
+def plan(images=IMAGES, builder=None, names=(), force=False, root=ROOT):
+    """What has to be done with each image, in dependency order
+
+    With `names`, only those images and the ones they're built FROM are planned.
+    """
+    depends = dependencies(images, root)
+    keys = input_keys(images, root)
+    selected = set()
+
+    def select(name):
+        if name not in selected:
+            selected.add(name)
+            for base in depends[name]:
+                select(base)
+
+    for name in names or depends:
+        if name not in depends:
+            raise ValueError(f"Unknown image {name}, expected one of {list(depends)}")
+        select(name)
+
+    def depth(name):
+        return 1 + max((depth(base) for base in depends[name]), default=0)
+
+    steps = []
+    for image in sorted(images, key=lambda image: depth(image.name)):
+        if image.name not in selected:
+            continue
+        key = keys[image.name]
+        built = not force and builder.exists(image.content_tag(key))
+        steps.append(
+            {
+                "image": image,
+                "key": key,
+                "action": TAG if built else BUILD,
+                "depends": depends[image.name],
+            }
+        )
+    return steps
+
+
+def print_plan(steps):
+    print(f"{'image':<10}{'key':<15}{'action':<8}{'after':<10}tags")
+    for step in steps:
+        image = step["image"]
+        tags = [*image.tags, image.content_tag(step["key"])]
+        print(
+            f"{image.name:<10}{step['key'][:12]:<15}{step['action']:<8}"
+            f"{','.join(step['depends']) or '-':<10}{' '.join(tags)}"
+        )
+
+
+class DockerBuilder:
+    """Builds with the docker CLI, content tags are looked up in the registry when
+    pushing and in the local images otherwise"""
+
+    def __init__(self, root=ROOT, push=False):
+        self.root = Path(root)
+        self.push = push
+
+    def run(self, *args):
+        print("$", " ".join(shlex.quote(arg) for arg in args))
+        subprocess.run(args, cwd=self.root, check=True)
+
+    def exists(self, reference):
+        command = "manifest" if self.push else "image"
+        command = ["docker", command, "inspect", reference]
+        return subprocess.run(command, capture_output=True).returncode == 0
+
+    def build(self, image, key):
+        tags = [*image.tags, image.content_tag(key)]
+        options = [option for tag in tags for option in ("-t", tag)]
+        options += ["--label", f"org.photopills.inputs={key}"]
+        self.run("docker", "build", "-f", image.dockerfile, *options, ".")
+        if image.check:
+            check = image.check.format(root=self.root, image=image.tags[0])
+            self.run(*shlex.split(check))
+        if self.push:
+            for tag in tags:
+                self.run("docker", "push", tag)
+
+    def tag(self, image, key):
+        """Point the tags of `image` to the build of `key`, in the registry when pushing
+        so the image isn't pulled"""
+        source = image.content_tag(key)
+        if not self.push:
+            for tag in image.tags:
+                self.run("docker", "tag", source, tag)
+            return
+        options = [option for tag in image.tags for option in ("-t", tag)]
+        self.run("docker", "buildx", "imagetools", "create", *options, source)
+
+
+class StubBuilder:
+    """Records what would be built instead of building it, to try plans without docker
+
+    The content tags it "built" are kept in the JSON file at `path`, if any, standing
+    in for the registry between runs.
+    """
+
+    def __init__(self, path=None, existing=(), delay=0.0):
+        self.path = Path(path) if path else None
+        self.existing = set(existing)
+        if self.path and self.path.exists():
+            self.existing.update(json.loads(self.path.read_text()))
+        self.delay = delay
+        self.calls = []
+
+    def exists(self, reference):
+        return reference in self.existing
+
+    def build(self, image, key):
+        self.calls.append((BUILD, image.name, time.monotonic()))
+        time.sleep(self.delay)
+        self.existing.add(image.content_tag(key))
+
+    def tag(self, image, key):
+        self.calls.append((TAG, image.name, time.monotonic()))
+
+    def save(self):
+        if self.path:
+            self.path.write_text(json.dumps(sorted(self.existing), indent=2))
+
+
+async def build(steps, builder, jobs=4):
+    """Run the plan, each image as soon as the images it's built FROM are done"""
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        pipeline = Pipeline(executor)
+        for step in steps:
+            function = builder.build if step["action"] == BUILD else builder.tag
+            pipeline.stage(step["image"].name, blocking=True, after=step["depends"])(
+                partial(function, step["image"], step["key"])
+            )
+        return await pipeline.run()
+
+
+def build_images(names=(), push=False, force=False, dry_run=False, jobs=4, stub=None):
+    """Plan the builds of the `names` images (all by default) and run them
+
+    With `stub`, the path of a JSON file, nothing is built: see `StubBuilder`.
+    """
+    builder = StubBuilder(stub) if stub else DockerBuilder(push=push)
+    steps = plan(IMAGES, builder, names, force)
+    print_plan(steps)
+    if dry_run:
+        return steps
+    asyncio.run(build(steps, builder, jobs))
+    if stub:
+        for action, name, _ in builder.calls:
+            print(f"[stub] {action} {name}")
+        builder.save()
+    return steps
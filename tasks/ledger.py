@@ -0,0 +1,135 @@
+"""Local SQLite ledger of the bump jobs and the stages they completed
+
+Every (repo, version) bump is a job. Each stage that changes something records its
+result when it's done (branch name, manifest versions, lock updated, commit sha, pushed
+sha, pull request), so running the same bump again resumes from the first stage that
+didn't finish instead of creating the branch, updating the lock and force-pushing again.
+
+The database uses WAL journaling, so the jobs can be listed while bumps are writing:
+>> invoke jobs --status failed
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+LEDGER_PATH = Path(
+    os.getenv("JOB_LEDGER_PATH", Path.home() / ".cache" / "photopills" / "jobs.sqlite")
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    repo TEXT NOT NULL,
+    version TEXT NOT NULL,
+    status TEXT NOT NULL,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    UNIQUE (repo, version)
+);
+CREATE TABLE IF NOT EXISTS stages (
+    job_id INTEGER NOT NULL REFERENCES jobs (id),
+    stage TEXT NOT NULL,
+    result TEXT NOT NULL,
+    finished_at REAL NOT NULL,
+    PRIMARY KEY (job_id, stage)
+);
+"""
+
+RUNNING, FAILED, DONE, CANCELLED = "running", "failed", "done", "cancelled"
+
+
+class Ledger:
+    def __init__(self, path=LEDGER_PATH):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        # stages running in worker threads record their results too
+        self.connection = sqlite3.connect(str(path), check_same_thread=False, timeout=30)
+        self.connection.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.executescript(SCHEMA)
+
+    def execute(self, sql, parameters=()):
+        with self.lock, self.connection:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def job(self, repo, version):
+        """Open the job of bumping `repo` to `version`, creating it the first time"""
+        now = time.time()
+        self.execute(
+            "INSERT INTO jobs (repo, version, status, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?) ON CONFLICT (repo, version) DO UPDATE SET "
+            "status = CASE status WHEN 'done' THEN 'done' ELSE 'running' END, "
+            "error = NULL, updated_at = excluded.updated_at",
+            (repo, version, RUNNING, now, now),
+        )
+        (row,) = self.execute(
+            "SELECT id FROM jobs WHERE repo = ? AND version = ?", (repo, version)
+        )
+        return Job(self, row["id"], repo, version)
+
+    def jobs(self, status=None):
+        """Every job, with its last finished stage, most recently updated first"""
+        sql = (
+            "SELECT jobs.*, (SELECT stage FROM stages WHERE job_id = jobs.id "
+            "ORDER BY finished_at DESC LIMIT 1) AS last_stage FROM jobs"
+        )
+        parameters = ()
+        if status is not None:
+            sql += " WHERE status = ?"
+            parameters = (status,)
+        return self.execute(sql + " ORDER BY updated_at DESC", parameters)
+
+    def close(self):
+        self.connection.close()
+
+
+class Job:
+    def __init__(self, ledger, id, repo, version):
+        self.ledger = ledger
+        self.id = id
+        self.repo = repo
+        self.version = version
+
+    def get(self, stage):
+        """Result recorded by `stage`, None when it didn't finish"""
+        rows = self.ledger.execute(
+            "SELECT result FROM stages WHERE job_id = ? AND stage = ?", (self.id, stage)
+        )
+        return json.loads(rows[0]["result"]) if rows else None
+
+    def record(self, stage, result=True):
+        now = time.time()
+        self.ledger.execute(
+            "INSERT OR REPLACE INTO stages (job_id, stage, result, finished_at) "
+            "VALUES (?, ?, ?, ?)",
+            (self.id, stage, json.dumps(result), now),
+        )
+        self.ledger.execute("UPDATE jobs SET updated_at = ? WHERE id = ?", (now, self.id))
+
+    def forget(self, *stages):
+        """Drop the results of `stages`, they have to run again"""
+        for stage in stages:
+            self.ledger.execute(
+                "DELETE FROM stages WHERE job_id = ? AND stage = ?", (self.id, stage)
+            )
+
+    def set_status(self, status, error=None):
+        self.ledger.execute(
+            "UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE id = ?",
+            (status, error, time.time(), self.id),
+        )
+
+    def fail(self, error):
+        self.set_status(FAILED, error)
+
+    def cancel(self, reason=None):
+        self.set_status(CANCELLED, reason)
+
+    def finish(self):
+        self.set_status(DONE)
@@ -0,0 +1,130 @@
+"""Patch a git pinned package in poetry.lock without running the resolver
+
+Bumping the `rev` of a git dependency only changes a few fields of the lock file: the
+package version, its `reference`/`resolved_reference` and the metadata `content-hash`.
+As long as the package declares the same dependencies at both revisions, the rest of the
+resolution is still valid, so we patch those fields in place (every other byte of the
+lock is kept) instead of running `poetry update <package>`, which can take minutes.
+
+`patch_lock` returns False whenever it can't prove the patch is enough (the package
+dependencies changed, it isn't a git dependency, ...) and the caller should run the full
+resolver instead.
+"""
+import asyncio
+import base64
+import json
+import re
+from hashlib import sha256
+from pathlib import Path
+
+import tomlkit
+
+from .github import github_session
+from .manifest import atomic_write
+
+# pyproject keys poetry hashes into the lock `content-hash`, the dependency groups of
+# Poetry 1.2 only when the project has them (the hash of older projects didn't change)
+LEGACY_KEYS = ["dependencies", "dev-dependencies", "source", "extras"]
+RELEVANT_KEYS = [*LEGACY_KEYS, "group"]
+PACKAGE_HEADER = re.compile(r"^\[\[package\]\][ \t]*$", re.MULTILINE)
+BLOCK_END = re.compile(r"^\[\[package\]\]|^\[metadata\]", re.MULTILINE)
+GITHUB_URL = re.compile(r"github\.com[/:]([^/]+/[^/]+?)(?:\.git)?/?$")
+
+
+def plain(item):
+    """Convert tomlkit containers and items into plain python objects"""
+    if isinstance(item, dict):
+        return {str(key): plain(value) for key, value in item.items()}
+    if isinstance(item, list):
+        return [plain(value) for value in item]
+    if isinstance(getattr(item, "value", None), bool):
+        return item.value
+    for type_ in (bool, int, float, str):
+        if isinstance(item, type_):
+            return type_(item)
+    return item
+
+
+def content_hash(pyproject_text):
+    """Same hash poetry stores as `content-hash` in the lock metadata"""
+    config = tomlkit.parse(pyproject_text)["tool"]["poetry"]
+    relevant = {
+        key: plain(config.get(key))
+        for key in RELEVANT_KEYS
+        if key in LEGACY_KEYS or config.get(key) is not None
+    }
+    return sha256(json.dumps(relevant, sort_keys=True).encode()).hexdigest()
+
+
+def package_span(lock_text, name):
+    """Return the (start, end) span of the `[[package]]` entry called `name`"""
+    for header in PACKAGE_HEADER.finditer(lock_text):
+        end = BLOCK_END.search(lock_text, header.end())
+        end = end.start() if end else len(lock_text)
+        name_line = re.compile(rf'^name = "{re.escape(name)}"$', re.MULTILINE)
+        if name_line.search(lock_text, header.end(), end):
+            return header.start(), end
+    return None
+
+
+def replace_string(text, key, value):
+    """Replace the first `key = "..."` line of `text`"""
+    pattern = re.compile(rf'^{re.escape(key)} = "[^"\n]*"$', re.MULTILINE)
+    new_text, count = pattern.subn(f'{key} = "{value}"', text, count=1)
+    if not count:
+        raise LookupError(f"There isn't any {key} in the lock entry")
+    return new_text
+
+
+async def fetch_pyproject(gh, repo, rev):
+    """Read `pyproject.toml` of `repo` at `rev` through the contents API"""
+    data = await gh.getitem(f"/repos/{repo}/contents/pyproject.toml?ref={rev}")
+    return tomlkit.parse(base64.b64decode(data["content"]).decode())["tool"]["poetry"]
+
+
+async def resolve_commit(gh, repo, rev):
+    """Full commit sha a tag, branch or short sha points to"""
+    data = await gh.getitem(f"/repos/{repo}/commits/{rev}")
+    return data["sha"]
+
+
+async def patch_lock(path, package, old_rev, new_rev, gh=None):
+    """Move `package` from `old_rev` to `new_rev` in `path`/poetry.lock
+
+    `path`/pyproject.toml must already point to `new_rev`. Returns False, without
+    touching the lock, when the full resolver is needed.
+    """
+    lock_file = Path(path) / "poetry.lock"
+    lock_text = lock_file.read_text()
+    span = package_span(lock_text, package)
+    if span is None:
+        return False
+    block = lock_text[span[0] : span[1]]
+    source = tomlkit.parse(block)["package"][0].get("source", {})
+    match = GITHUB_URL.search(str(source.get("url", "")))
+    if source.get("type") != "git" or match is None:
+        return False
+    repo = match.group(1)
+
+    async with github_session(gh) as gh:
+        old_config, new_config, resolved = await asyncio.gather(
+            fetch_pyproject(gh, repo, old_rev),
+            fetch_pyproject(gh, repo, new_rev),
+            resolve_commit(gh, repo, new_rev),
+        )
+    for key in ("dependencies", "extras"):
+        if plain(old_config.get(key)) != plain(new_config.get(key)):
+            print(f"{package} {key} changed between {old_rev} and {new_rev}")
+            return False
+
+    block = replace_string(block, "version", str(new_config["version"]))
+    block = replace_string(block, "reference", new_rev)
+    block = replace_string(block, "resolved_reference", resolved)
+    patched = tomlkit.parse(block)["package"][0]
+    assert patched["source"]["resolved_reference"] == resolved, "Lock entry patch failed"
+
+    pyproject_text = (Path(path) / "pyproject.toml").read_text()
+    lock_text = lock_text[: span[0]] + block + lock_text[span[1] :]
+    lock_text = replace_string(lock_text, "content-hash", content_hash(pyproject_text))
+    atomic_write(lock_file, lock_text)
+    return True
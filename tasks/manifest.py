@@ -0,0 +1,203 @@
+"""Span-preserving version rewriter for pyproject.toml and package.json
+
+Round-tripping a manifest through tomlkit or json is slow on big files and, for
+package.json, reformats the whole document. A version bump only changes one string, so
+we locate the exact span of that string in the raw text and splice the new value in.
+Every other byte of the document is left as it was.
+
+The result is still fully parsed once, only to verify that the document is valid and
+that the key now holds the new value. When a value can't be located (unusual layouts like
+dotted keys or multi-line inline tables), or the span found isn't the value of the key
+after all, we fall back to the full parse and dump.
+
+>> rewrite("pyproject.toml", "tool.poetry.dependencies.astrolib.rev", "v1.2.0")
+"v1.1.0"
+"""
+import json
+import os
+import re
+import tempfile
+from pathlib import Path
+
+import tomlkit
+
+TOML_STRING = re.compile(r""""((?:[^"\\\n]|\\.)*)"|'([^'\n]*)'""")
+JSON_STRING = re.compile(r'"(?:[^"\\]|\\.)*"')
+JSON_TOKEN = re.compile(r'[{}\[\]"]')
+JSON_COLON = re.compile(r"\s*:\s*")
+# characters that would need escaping, values containing them go through the slow path
+UNSAFE = re.compile(r"""["'\\\n]""")
+
+
+def manifest_kind(path):
+    return "json" if str(path).endswith(".json") else "toml"
+
+
+def in_multiline_string(text):
+    """Whether a multi-line string opened in `text` is still open at its end"""
+    return text.count('"""') % 2 == 1 or text.count("'''") % 2 == 1
+
+
+def toml_span(text, key):
+    """Return the (start, end) span of the string stored at dotted `key`, or None
+
+    Handles `key = "value"` right below its table header and `name = {..., key = "value"}`
+    inline tables, e.g. `tool.poetry.version` or `tool.poetry.dependencies.astrolib.rev`.
+    """
+    parts = key.split(".")
+    for split in range(len(parts) - 1, 0, -1):
+        header, rest = parts[:split], parts[split:]
+        if len(rest) > 2:
+            continue
+        dotted = r"\s*\.\s*".join(map(re.escape, header))
+        match = re.search(rf"^\[\s*{dotted}\s*\][ \t]*(#.*)?$", text, re.MULTILINE)
+        if match is None:
+            continue
+        next_table = re.compile(r"^\[", re.MULTILINE).search(text, match.end())
+        body_end = next_table.start() if next_table else len(text)
+        assignment = re.compile(rf"^[ \t]*{re.escape(rest[0])}[ \t]*=[ \t]*", re.MULTILINE)
+        found = assignment.search(text, match.end(), body_end)
+        # skip the lines of multi-line strings that look like the assignment
+        while found and in_multiline_string(text[match.end() : found.start()]):
+            found = assignment.search(text, found.end(), body_end)
+        if found is None:
+            continue
+        if len(rest) == 1:
+            value = TOML_STRING.match(text, found.end())
+        else:
+            inline = re.compile(r"\{[^\n}]*\}").match(text, found.end())
+            if inline is None:
+                continue
+            inner = re.compile(rf"[{{,][ \t]*{re.escape(rest[1])}[ \t]*=[ \t]*")
+            inner_found = inner.search(text, inline.start(), inline.end())
+            value = inner_found and TOML_STRING.match(text, inner_found.end())
+        if value:
+            group = 1 if value.group(1) is not None else 2
+            return value.start(group), value.end(group)
+    return None
+
+
+def json_span(text, key):
+    """Return the (start, end) span of the top level string value `key`, or None"""
+    depth = 0
+    position = 0
+    while True:
+        token = JSON_TOKEN.search(text, position)
+        if token is None:
+            return None
+        char = token.group()
+        if char == '"':
+            string = JSON_STRING.match(text, token.start())
+            position = string.end()
+            if depth == 1 and json.loads(string.group()) == key:
+                colon = JSON_COLON.match(text, position)
+                value = colon and JSON_STRING.match(text, colon.end())
+                if value:
+                    return value.start() + 1, value.end() - 1
+        else:
+            depth += 1 if char in "{[" else -1
+            position = token.end()
+
+
+def parse(text, kind):
+    return json.loads(text) if kind == "json" else tomlkit.parse(text)
+
+
+def lookup(document, key):
+    for part in key.split("."):
+        document = document[part]
+    return document
+
+
+def full_rewrite(text, key, value, kind):
+    """Slow path: parse, set and serialise the whole document"""
+    document = parse(text, kind)
+    *parents, name = key.split(".")
+    parent = lookup(document, ".".join(parents)) if parents else document
+    parent[name] = value
+    if kind == "json":
+        return json.dumps(document, indent=2)
+    return tomlkit.dumps(document)
+
+
+def get_value(text, key, kind="toml"):
+    """Read the string at `key` without parsing the document when possible"""
+    span = json_span(text, key) if kind == "json" else toml_span(text, key)
+    if span is None:
+        return str(lookup(parse(text, kind), key))
+    value = text[span[0] : span[1]]
+    return json.loads(f'"{value}"') if kind == "json" else value
+
+
+def holds(text, key, value, kind):
+    """Whether the document `text` parses and has `value` at `key`"""
+    try:
+        return str(lookup(parse(text, kind), key)) == value
+    except (KeyError, ValueError):
+        return False
+
+
+def set_value(text, key, value, kind="toml"):
+    """Return `text` with the string at `key` replaced and the previous value
+
+    `value` can also be a callable receiving the current value and returning the new one.
+    """
+    span = json_span(text, key) if kind == "json" else toml_span(text, key)
+    new_text = None
+    if span is not None:
+        old_value = text[span[0] : span[1]]
+        new_value = value(old_value) if callable(value) else value
+        if not (UNSAFE.search(old_value) or UNSAFE.search(new_value)):
+            spliced = text[: span[0]] + new_value + text[span[1] :]
+            # the span may not be the value at `key`, e.g. a line of a multi-line string
+            if holds(spliced, key, new_value, kind):
+                new_text = spliced
+    if new_text is None:
+        old_value = str(lookup(parse(text, kind), key))
+        new_value = value(old_value) if callable(value) else value
+        new_text = full_rewrite(text, key, new_value, kind)
+        if not holds(new_text, key, new_value, kind):
+            raise ValueError(f"Could not set {key} to {new_value}")
+    return new_text, old_value
+
+
+def atomic_write(path, text):
+    """Replace `path` with `text` through a temp file created in the same directory
+
+    Like update_astrolib.SafeOpen, but the rename never crosses filesystems and the
+    original file permissions are kept.
+    """
+    path = Path(path)
+    with tempfile.NamedTemporaryFile("w", dir=path.parent, delete=False) as f:
+        f.write(text)
+    try:
+        os.chmod(f.name, path.stat().st_mode)
+        os.replace(f.name, path)
+    except BaseException:
+        os.unlink(f.name)
+        raise
+
+
+def rewrite_many(edits):
+    """Apply many (path, key, value) edits, e.g. every package of a monorepo
+
+    All files are read, edited and verified first and only then written, so a failure in
+    any of them leaves every manifest untouched. Several edits can target the same file.
+    Returns the previous values, in the same order as `edits`.
+    """
+    texts = {}
+    old_values = []
+    for path, key, value in edits:
+        path = Path(path)
+        if path not in texts:
+            texts[path] = path.read_text()
+        texts[path], old_value = set_value(texts[path], key, value, manifest_kind(path))
+        old_values.append(old_value)
+    for path, text in texts.items():
+        atomic_write(path, text)
+    return old_values
+
+
+def rewrite(path, key, value):
+    """Set the string at `key` in the manifest at `path` and return the previous value"""
+    return rewrite_many([(path, key, value)])[0]
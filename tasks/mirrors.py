@@ -0,0 +1,164 @@
+"""Persistent cache of bare mirrors of the photopills repositories
+
+Every job used to start from a fresh clone. With MIRROR_CACHE_PATH pointing to a
+persistent volume, each repository is mirrored there once (`git clone --mirror`) and
+only refreshed with incremental fetches afterwards. Job workspaces are cloned from the
+mirror with `--shared`: the new clone borrows the mirror objects through
+`objects/info/alternates` instead of copying them, so it's ready in milliseconds and
+doesn't touch the network. Its origin still points to GitHub, pushes go there. The
+remotes hold bare URLs, git authenticates through the credential helper of tasks.auth,
+so no token is stored on the volume.
+
+Worktrees of the mirror aren't used: they would share its config, where origin is a
+`mirror = true` remote, and a push from a job could then overwrite every ref on GitHub.
+
+Concurrent jobs share the cache through `flock` locks, one file per mirror: shared
+while a workspace is being cloned, exclusive to create, refresh or delete the mirror.
+`evict` removes the least recently used mirrors until the cache fits MIRROR_CACHE_SIZE
+bytes, skipping the mirrors in use, the ones used in the last `grace` seconds and the
+ones a workspace still borrows objects from: every workspace is registered in the
+`workspaces` file of its mirror, and stays live as long as it exists, however long a
+daemon reuses it.
+"""
+import fcntl
+import os
+import shutil
+import subprocess
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+MIRROR_PATH = os.getenv("MIRROR_CACHE_PATH")
+MAX_SIZE = int(os.getenv("MIRROR_CACHE_SIZE", 10 * 1024**3))
+# refresh a mirror that was fetched more than MAX_AGE seconds ago
+MAX_AGE = int(os.getenv("MIRROR_CACHE_MAX_AGE", 60))
+
+
+def git(*args, cwd=None):
+    return subprocess.run(
+        ["git", *args], cwd=cwd, check=True, capture_output=True, text=True
+    ).stdout
+
+
+def directory_size(path):
+    return sum(item.stat().st_size for item in Path(path).rglob("*") if item.is_file())
+
+
+class MirrorCache:
+    def __init__(self, root=MIRROR_PATH, max_size=MAX_SIZE):
+        self.root = Path(root).resolve()
+        self.max_size = max_size
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def path(self, name):
+        return self.root / f"{name}.git"
+
+    @contextmanager
+    def lock(self, name, shared=False, blocking=True):
+        """flock the mirror of `name`, yield False when not blocking and it's taken"""
+        with open(self.root / f"{name}.lock", "a") as lock_file:
+            operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+            if not blocking:
+                operation |= fcntl.LOCK_NB
+            try:
+                fcntl.flock(lock_file, operation)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def touch(self, name):
+        """Mark the mirror as used now, for the LRU eviction"""
+        (self.path(name) / "last-used").touch()
+
+    def last_used(self, name):
+        marker = self.path(name) / "last-used"
+        return marker.stat().st_mtime if marker.exists() else 0
+
+    def fetched_at(self, name):
+        fetch_head = self.path(name) / "FETCH_HEAD"
+        if fetch_head.exists():
+            return fetch_head.stat().st_mtime
+        return self.path(name).stat().st_mtime
+
+    def update(self, name, url, max_age=0, filter=None):
+        """Create the mirror of `name` or fetch what changed since the last update
+
+        Nothing is fetched when it was updated less than `max_age` seconds ago. With a
+        `filter` ("tree:0") it's a partial mirror, that the later fetches keep partial;
+        workspaces can't be cloned from it.
+        """
+        mirror = self.path(name)
+        with self.lock(name):
+            if not mirror.exists():
+                tmp = mirror.with_suffix(".tmp")
+                shutil.rmtree(tmp, ignore_errors=True)
+                options = [f"--filter={filter}"] if filter else []
+                git("clone", "--mirror", "--quiet", *options, url, str(tmp))
+                # objects borrowed by the workspaces must never be pruned
+                git("config", "gc.auto", "0", cwd=tmp)
+                tmp.rename(mirror)
+            else:
+                if git("remote", "get-url", "origin", cwd=mirror).strip() != url:
+                    git("remote", "set-url", "origin", url, cwd=mirror)
+                if time.time() - self.fetched_at(name) >= max_age:
+                    git("fetch", "--quiet", "--prune", "origin", cwd=mirror)
+            self.touch(name)
+        return mirror
+
+    def workspace(self, name, url, path, branch="master", checkout=True):
+        """Clone a working copy of `name` into `path`, borrowing the mirror objects"""
+        self.update(name, url, max_age=MAX_AGE)
+        options = ["--shared", "--branch", branch]
+        if not checkout:
+            options.append("--no-checkout")
+        with self.lock(name, shared=True):
+            git("clone", "--quiet", *options, str(self.path(name)), str(path))
+            with open(self.path(name) / "workspaces", "a") as registry:
+                registry.write(f"{Path(path).resolve()}\n")
+            self.touch(name)
+        git("remote", "set-url", "origin", url, cwd=path)
+        return Path(path)
+
+    def workspaces(self, name):
+        """Workspaces that still borrow objects from the mirror of `name`"""
+        registry = self.path(name) / "workspaces"
+        if not registry.exists():
+            return []
+        objects = str((self.path(name) / "objects").resolve())
+        live = []
+        for path in dict.fromkeys(registry.read_text().split("\n")):
+            alternates = Path(path) / ".git" / "objects" / "info" / "alternates"
+            if path and alternates.exists():
+                if objects in alternates.read_text().split("\n"):
+                    live.append(path)
+        return live
+
+    def mirrors(self):
+        return sorted(path.name[: -len(".git")] for path in self.root.glob("*.git"))
+
+    def evict(self, max_size=None, grace=3600):
+        """Delete the least recently used mirrors until the cache fits `max_size`
+
+        Returns the names of the deleted mirrors.
+        """
+        max_size = self.max_size if max_size is None else max_size
+        sizes = {name: directory_size(self.path(name)) for name in self.mirrors()}
+        total = sum(sizes.values())
+        evicted = []
+        for name in sorted(sizes, key=self.last_used):
+            if total <= max_size:
+                break
+            if time.time() - self.last_used(name) < grace:
+                continue
+            with self.lock(name, blocking=False) as locked:
+                # deleting a mirror would corrupt the workspaces that borrow from it
+                if not locked or self.workspaces(name):
+                    continue
+                shutil.rmtree(self.path(name))
+            total -= sizes[name]
+            evicted.append(name)
+        return evicted
@@ -0,0 +1,132 @@
+"""Run the stages of a task as a dependency graph on a single event loop
+
+Each stage is a function whose parameters name the stages it depends on; it's called with
+their results as soon as all of them are done, so independent stages (e.g. the release
+lookup over HTTP and the git fetch) overlap and the total time is the critical path of
+the graph instead of the sum of every stage. Blocking stages (GitPython, subprocesses)
+run in a thread pool to keep the loop free.
+
+pipeline = Pipeline(repo="api")
+
+@pipeline.stage(blocking=True)
+def fetch():
+    ...
+
+@pipeline.stage()
+async def release():
+    ...
+
+@pipeline.stage(blocking=True, after=["fetch"])
+def branch(release):
+    ...
+
+results = await pipeline.run()
+"""
+import asyncio
+import contextvars
+import functools
+import inspect
+
+from .tracing import span
+
+
+class Stage:
+    def __init__(self, name, function, requires, after, blocking):
+        self.name = name
+        self.function = function
+        # stages whose result is passed to `function`
+        self.requires = tuple(requires)
+        # every stage that has to finish first, results or not
+        self.depends = tuple(dict.fromkeys([*requires, *after]))
+        self.blocking = blocking
+
+
+class Pipeline:
+    def __init__(self, executor=None, **attributes):
+        self.executor = executor
+        self.attributes = attributes
+        self.stages = {}
+        # results of the last run, the finished stages only when it failed
+        self.results = {}
+
+    def stage(self, name=None, blocking=False, after=()):
+        """Register the decorated function as a stage, named after it by default"""
+
+        def decorator(function):
+            requires = inspect.signature(function).parameters
+            stage_name = name or function.__name__
+            stage = Stage(stage_name, function, requires, after, blocking)
+            self.stages[stage_name] = stage
+            return function
+
+        return decorator
+
+    def check(self, inputs):
+        """Raise ValueError on unknown dependencies and cycles"""
+        known = set(self.stages) | set(inputs)
+        for stage in self.stages.values():
+            missing = set(stage.depends) - known
+            if missing:
+                raise ValueError(f"Stage {stage.name} depends on unknown {missing}")
+
+        visiting, done = set(), set(inputs)
+
+        def visit(name):
+            if name in done:
+                return
+            if name in visiting:
+                raise ValueError(f"Stage {name} is part of a dependency cycle")
+            visiting.add(name)
+            for dependency in self.stages[name].depends:
+                visit(dependency)
+            visiting.discard(name)
+            done.add(name)
+
+        for name in self.stages:
+            visit(name)
+
+    async def call(self, stage, kwargs):
+        if not stage.blocking:
+            return await stage.function(**kwargs)
+        loop = asyncio.get_running_loop()
+        # copy the context, so the stage span is the parent of the spans opened inside it
+        context = contextvars.copy_context()
+        call = functools.partial(context.run, stage.function, **kwargs)
+        future = loop.run_in_executor(self.executor, call)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # a thread can't be interrupted: let it finish before the cancellation goes
+            # on, so nothing else touches the clone while it's still writing to it
+            await asyncio.wait([future])
+            raise
+
+    async def run(self, **inputs):
+        """Run every stage and return all the results by stage name
+
+        `inputs` are results known upfront: a stage with the same name isn't run. When a
+        stage fails the ones still running are cancelled and its exception is raised.
+        """
+        self.check(inputs)
+        results = self.results = dict(inputs)
+        futures = {}
+
+        async def run_stage(stage):
+            for dependency in stage.depends:
+                if dependency in futures:
+                    await futures[dependency]
+            kwargs = {name: results[name] for name in stage.requires}
+            with span(stage.name, **self.attributes):
+                results[stage.name] = await self.call(stage, kwargs)
+
+        for name, stage in self.stages.items():
+            if name not in inputs:
+                futures[name] = asyncio.ensure_future(run_stage(stage))
+        try:
+            await asyncio.gather(*futures.values())
+        except BaseException:
+            for future in futures.values():
+                future.cancel()
+            await asyncio.gather(*futures.values(), return_exceptions=True)
+            raise
+        return results
@@ -0,0 +1,83 @@
+"""Commit engine that never touches the working tree or the index
+
+A version bump only changes a couple of small files, so instead of checking out a branch,
+editing files on disk, staging and committing, we write the new blobs, the trees leading
+to them and the commit object straight into the object database, and push the result.
+
+Because nothing but the object database and the remote refs are touched, it works the
+same on a bare mirror and is safe to run in parallel against one repository.
+"""
+from io import BytesIO
+
+from git.objects import Commit, Tree
+from git.objects.fun import tree_to_stream
+from gitdb import IStream
+
+BLOB_MODE = 0o100644
+
+
+def read_blob(repo, rev, path):
+    """Return the content of `path` at `rev` without checking it out"""
+    return (repo.commit(rev).tree / path).data_stream.read()
+
+
+def store(repo, type_, data):
+    """Write a raw object in the object database and return its binary sha"""
+    return repo.odb.store(IStream(type_, len(data), BytesIO(data))).binsha
+
+
+def write_tree(repo, tree, changes):
+    """Write a copy of `tree` where each path in `changes` holds the given bytes
+
+    Only the trees on the way to a changed file are rewritten, every other entry keeps
+    pointing to the existing object.
+    """
+    entries = {}
+    if tree is not None:
+        for item in tree:
+            entries[item.name] = (item.binsha, item.mode, item.name)
+
+    nested = {}
+    for path, content in changes.items():
+        name, _, rest = path.partition("/")
+        if rest:
+            nested.setdefault(name, {})[rest] = content
+        else:
+            mode = entries[name][1] if name in entries else BLOB_MODE
+            entries[name] = (store(repo, b"blob", content), mode, name)
+
+    for name, sub_changes in nested.items():
+        subtree = tree[name] if tree is not None and name in entries else None
+        entries[name] = (write_tree(repo, subtree, sub_changes), Tree.tree_id << 12, name)
+
+    # git sorts tree entries as if directory names ended with a slash
+    def sort_key(entry):
+        return entry[2] + "/" if entry[1] == Tree.tree_id << 12 else entry[2]
+
+    stream = BytesIO()
+    tree_to_stream(sorted(entries.values(), key=sort_key), stream.write)
+    return store(repo, b"tree", stream.getvalue())
+
+
+def write_commit(repo, parent, changes, message):
+    """Create a commit on top of `parent` with the file contents in `changes`
+
+    `changes` maps repository relative paths to their new content (bytes). Neither HEAD,
+    the index nor the working tree are modified.
+    """
+    parent = repo.commit(parent)
+    tree = Tree(repo, write_tree(repo, parent.tree, changes))
+    return Commit.create_from_tree(repo, tree, message, parent_commits=[parent])
+
+
+def push_atomic(repo, commit, branch, tag=None, remote="origin", force=False):
+    """Push `commit` as `branch` (and `tag`) in one atomic push
+
+    Either every ref is updated on the remote or none is. The remote URL is used instead
+    of its name because `git push` refuses refspecs for remotes of `--mirror` clones.
+    """
+    refspecs = [f"{'+' if force else ''}{commit.hexsha}:refs/heads/{branch}"]
+    if tag is not None:
+        refspecs.append(f"{commit.hexsha}:refs/tags/{tag}")
+    repo.git.push("--atomic", "--porcelain", repo.remotes[remote].url, *refspecs)
+    return commit
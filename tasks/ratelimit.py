@@ -0,0 +1,241 @@
+"""Schedule GitHub API calls around the rate limits
+
+Every request of a `GitHubClient` goes through its `Scheduler`, which:
+
+- keeps a token bucket of the requests left in the current window, seeded from the
+  X-RateLimit-* headers of every response. When it's empty, requests wait for the reset
+  instead of getting 403s halfway through a fan-out.
+- serves waiting requests by priority: pull request creation first, then other writes,
+  then reads. Reads also leave the last `reserve` requests of the window to writes.
+- retries secondary rate limits (403/429 with Retry-After, or "secondary rate limit" in
+  the message) with jittered exponential backoff, pausing every request meanwhile, as
+  GitHub asks.
+- caps the requests in flight per repository.
+- measures the time spent throttled, see `Scheduler.metrics`.
+"""
+import asyncio
+import itertools
+import random
+import re
+import time
+from collections import defaultdict
+
+from .tracing import current_span
+
+# lower values are served first
+PRIORITY_PULL_REQUEST = 0
+PRIORITY_WRITE = 1
+PRIORITY_READ = 2
+
+REPO_URL = re.compile(r"/repos/([^/]+/[^/?]+)")
+SECONDARY_LIMIT = re.compile(rb"secondary rate limit|abuse detection", re.IGNORECASE)
+
+
+def priority(method, url):
+    """Priority class of a request"""
+    if method == "POST" and url.split("?")[0].endswith("/pulls"):
+        return PRIORITY_PULL_REQUEST
+    if method != "GET":
+        return PRIORITY_WRITE
+    return PRIORITY_READ
+
+
+class TokenBucket:
+    """Requests left in the current rate-limit window
+
+    Unknown until the first response arrives; GitHub refills the whole window at once,
+    at the `reset` timestamp.
+    """
+
+    def __init__(self, reserve=0):
+        self.reserve = reserve
+        self.limit = None
+        self.tokens = None
+        self.reset = None
+        self.in_flight = 0
+
+    def update(self, headers):
+        remaining = headers.get("x-ratelimit-remaining")
+        if remaining is None:
+            return
+        self.limit = int(headers.get("x-ratelimit-limit", remaining))
+        self.reset = float(headers.get("x-ratelimit-reset", time.time() + 3600))
+        # the requests still in flight were already counted when they were sent
+        self.tokens = max(int(remaining) - self.in_flight, 0)
+
+    def available(self, priority):
+        if self.tokens is None:
+            # one request at a time until a response tells us the limits
+            return self.in_flight == 0
+        if self.reset is not None and time.time() >= self.reset:
+            self.tokens, self.reset = self.limit, None
+        floor = self.reserve if priority >= PRIORITY_READ else 0
+        return self.tokens > floor
+
+    def wait_time(self):
+        """Seconds until the bucket is refilled"""
+        if self.reset is None:
+            return 1.0
+        return max(self.reset - time.time(), 0)
+
+    def take(self):
+        self.in_flight += 1
+        if self.tokens is not None:
+            self.tokens -= 1
+
+    def release(self):
+        self.in_flight -= 1
+
+
+class Scheduler:
+    def __init__(self, per_repo=4, reserve=50, retries=5, base_delay=1.0, max_delay=60.0):
+        self.bucket = TokenBucket(reserve)
+        self.per_repo = per_repo
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.paused_until = 0.0
+        self.repo_in_flight = defaultdict(int)
+        # [priority, order, repo, future, reason] of the requests waiting for a token
+        self.waiters = []
+        self.order = itertools.count()
+        self.timer = None
+        # seconds spent throttled and throttled requests, by reason
+        self.throttled_time = defaultdict(float)
+        self.throttled_requests = defaultdict(int)
+
+    def blocked(self, priority, repo):
+        """Why a request can't be sent right now, None when it can"""
+        if time.time() < self.paused_until:
+            return "secondary"
+        if not self.bucket.available(priority):
+            return "rate_limit"
+        if repo is not None and self.repo_in_flight[repo] >= self.per_repo:
+            return "repo"
+        return None
+
+    def take(self, repo):
+        self.bucket.take()
+        if repo is not None:
+            self.repo_in_flight[repo] += 1
+
+    def release(self, repo):
+        self.bucket.release()
+        if repo is not None:
+            self.repo_in_flight[repo] -= 1
+
+    def wake(self):
+        """Hand the available tokens to the waiting requests, by priority"""
+        self.waiters = sorted(waiter for waiter in self.waiters if not waiter[3].done())
+        for waiter in list(self.waiters):
+            priority, _, repo, future, _ = waiter
+            reason = self.blocked(priority, repo)
+            if reason is not None:
+                waiter[4] = reason
+                continue
+            self.waiters.remove(waiter)
+            self.take(repo)
+            future.set_result(None)
+        # requests waiting for a repo slot are woken up by `release`, the rest by a timer
+        delays = []
+        reasons = {waiter[4] for waiter in self.waiters}
+        if "secondary" in reasons:
+            delays.append(self.paused_until - time.time())
+        if "rate_limit" in reasons:
+            delays.append(self.bucket.wait_time())
+        if delays and self.timer is None:
+            delay = max(min(delays), 0.05)
+            self.timer = asyncio.get_running_loop().call_later(delay, self.on_timer)
+
+    def on_timer(self):
+        self.timer = None
+        self.wake()
+
+    async def acquire(self, priority, repo):
+        """Wait for a token of the rate-limit window and a slot of `repo`"""
+        start = time.monotonic()
+        reason = self.blocked(priority, repo)
+        if not self.waiters and reason is None:
+            self.take(repo)
+            return
+        future = asyncio.get_running_loop().create_future()
+        waiter = [priority, next(self.order), repo, future, reason]
+        self.waiters.append(waiter)
+        self.wake()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # the token was handed over right before the cancellation
+                self.release(repo)
+                self.wake()
+            raise
+        self.record(waiter[4] or "priority", time.monotonic() - start)
+
+    def record(self, reason, seconds):
+        if seconds < 0.001:
+            return
+        self.throttled_time[reason] += seconds
+        self.throttled_requests[reason] += 1
+        span = current_span()
+        if span is not None:
+            span.set(**{f"throttled.{reason}": round(seconds, 3)})
+
+    def retry_delay(self, status, headers, body, attempt):
+        """Seconds to wait before retrying a rate limited response, None if it isn't"""
+        if status not in (403, 429) or attempt >= self.retries:
+            return None
+        if headers.get("x-ratelimit-remaining") == "0":
+            # primary limit, the bucket is empty now and waits for the reset
+            return 0.0
+        retry_after = headers.get("retry-after")
+        if retry_after is not None:
+            return float(retry_after) + random.uniform(0, 1)
+        if status == 429 or SECONDARY_LIMIT.search(body or b""):
+            # "full jitter" backoff
+            return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+        return None
+
+    async def request(self, method, url, send):
+        """Run `send()`, one HTTP request, as soon as the limits allow it
+
+        Returns its (status, headers, body), retrying rate limited responses.
+        """
+        request_priority = priority(method, url)
+        match = REPO_URL.search(url)
+        repo = match.group(1) if match else None
+        for attempt in itertools.count():
+            await self.acquire(request_priority, repo)
+            headers = {}
+            try:
+                status, headers, body = await send()
+            finally:
+                self.release(repo)
+                self.bucket.update(headers)
+                self.wake()
+            delay = self.retry_delay(status, headers, body, attempt)
+            if delay is None:
+                return status, headers, body
+            if delay:
+                self.paused_until = max(self.paused_until, time.time() + delay)
+                self.record("secondary", delay)
+                await asyncio.sleep(delay)
+
+    def metrics(self):
+        metrics = {
+            "throttled_seconds": round(sum(self.throttled_time.values()), 3),
+            "throttled_requests": sum(self.throttled_requests.values()),
+        }
+        for reason, seconds in self.throttled_time.items():
+            metrics[f"throttled_seconds.{reason}"] = round(seconds, 3)
+        if self.bucket.tokens is not None:
+            metrics["rate_limit_remaining"] = self.bucket.tokens
+        return metrics
+
+    def report(self):
+        reasons = ", ".join(
+            f"{reason} {seconds:.1f}s" for reason, seconds in self.throttled_time.items()
+        )
+        total = sum(self.throttled_time.values())
+        requests = sum(self.throttled_requests.values())
+        return f"GitHub requests throttled {requests} times, {total:.1f}s ({reasons})"
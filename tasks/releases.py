@@ -0,0 +1,171 @@
+"""Incremental per-repo index of GitHub releases
+
+`/releases` is paginated (30 items per page) and returned newest first, so instead of
+re-reading and re-sorting everything on every lookup we keep a small local index of
+(tag, published_at, semver) per repo and only stream the pages that contain releases we
+haven't seen yet. Releases deleted on GitHub are never in those pages, so every
+RELEASE_INDEX_RECONCILE seconds the refresh reads the full list instead and rebuilds the
+index from it. Lookups are then answered from memory:
+
+- latest release: O(1)
+- latest non-prerelease: O(1)
+- latest release matching a version prefix ("2", "2.x", "2.1"): O(log n)
+"""
+import json
+import os
+import re
+import time
+from bisect import bisect_left, insort
+from collections import namedtuple
+from contextlib import aclosing
+from pathlib import Path
+
+import pendulum
+
+INDEX_PATH = Path(
+    os.getenv("RELEASE_INDEX_PATH", Path.home() / ".cache" / "photopills" / "releases")
+)
+
+# seconds between two full reads of the releases, dropping the deleted ones
+RECONCILE_INTERVAL = int(os.getenv("RELEASE_INDEX_RECONCILE", 3600))
+
+SEMVER = re.compile(r"^v?(\d+)\.(\d+)\.(\d+)(?:-([0-9A-Za-z.-]+))?")
+
+Release = namedtuple("Release", "id tag published_at semver prerelease")
+
+
+def parse_semver(tag):
+    """Return a sortable version key for `tag`, or None if it isn't a semver tag
+
+    Prereleases sort before the final release of the same version: 2.0.0-rc1 < 2.0.0
+    """
+    match = SEMVER.match(tag)
+    if match is None:
+        return None
+    major, minor, patch, pre = match.groups()
+    return (int(major), int(minor), int(patch), 0 if pre else 1, pre or "")
+
+
+def parse_prefix(prefix):
+    """Turn "2", "2.x" or "2.1.x" into a version key prefix: (2,), (2,), (2, 1)"""
+    parts = prefix.lstrip("v").split(".")
+    return tuple(int(part) for part in parts if part not in ("x", "*", ""))
+
+
+class ReleaseIndex:
+    def __init__(self, repo, releases=(), path=INDEX_PATH, reconciled_at=0):
+        self.repo = repo
+        self.path = Path(path) / f"{repo}.json"
+        self.reconciled_at = reconciled_at
+        self.clear()
+        for release in releases:
+            self.add(Release(*release))
+
+    @classmethod
+    def load(cls, repo, path=INDEX_PATH):
+        """Load the stored index for `repo`, an empty one if there isn't any yet"""
+        index_file = Path(path) / f"{repo}.json"
+        data = json.loads(index_file.read_text()) if index_file.exists() else {}
+        return cls(
+            repo,
+            data.get("releases", []),
+            path=path,
+            reconciled_at=data.get("reconciled_at", 0),
+        )
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(".tmp")
+        data = {"reconciled_at": self.reconciled_at, "releases": self.by_date}
+        tmp.write_text(json.dumps(data))
+        os.replace(tmp, self.path)
+
+    def clear(self):
+        self.ids = set()
+        self.by_date = []
+        self.by_version = []
+        self.latest_stable = None
+
+    def __len__(self):
+        return len(self.by_date)
+
+    def add(self, release):
+        if release.id in self.ids:
+            return
+        if release.semver is not None:
+            release = release._replace(semver=tuple(release.semver))
+        self.ids.add(release.id)
+        insort(self.by_date, release, key=lambda r: r.published_at)
+        if release.semver is not None:
+            insort(self.by_version, release, key=lambda r: r.semver)
+        if not release.prerelease and (
+            self.latest_stable is None
+            or self.latest_stable.published_at <= release.published_at
+        ):
+            self.latest_stable = release
+
+    def add_from_api(self, data):
+        """Index a release as returned by the GitHub REST API"""
+        published_at = pendulum.parse(data["published_at"]).in_timezone("UTC")
+        self.add(
+            Release(
+                data["id"],
+                data["tag_name"],
+                published_at.to_iso8601_string(),
+                parse_semver(data["tag_name"]),
+                data["prerelease"],
+            )
+        )
+
+    async def refresh(self, gh, max_age=None):
+        """Stream release pages until reaching a release that is already indexed
+
+        Pages are requested lazily, so when nothing (or only a few releases) was
+        published since the last refresh only the first page is fetched, and thanks to
+        the ETag cache that is usually a 304. When the last reconciliation is older than
+        `max_age` seconds (RECONCILE_INTERVAL by default) it reconciles instead.
+        """
+        max_age = RECONCILE_INTERVAL if max_age is None else max_age
+        if time.time() - self.reconciled_at >= max_age:
+            return await self.reconcile(gh)
+        url = f"/repos/photopills/{self.repo}/releases"
+        async with aclosing(gh.getiter(url)) as releases:
+            async for data in releases:
+                if data["id"] in self.ids:
+                    break
+                if data["draft"]:
+                    continue
+                self.add_from_api(data)
+        self.save()
+        return self
+
+    async def reconcile(self, gh):
+        """Rebuild the index from every page, dropping the releases deleted on GitHub"""
+        url = f"/repos/photopills/{self.repo}/releases"
+        self.clear()
+        async for data in gh.getiter(url):
+            if not data["draft"]:
+                self.add_from_api(data)
+        self.reconciled_at = time.time()
+        self.save()
+        return self
+
+    def latest(self, prerelease=True):
+        """Most recently published release"""
+        if not prerelease:
+            return self.latest_stable
+        return self.by_date[-1] if self.by_date else None
+
+    def latest_matching(self, prefix, prerelease=True):
+        """Highest version whose number starts with `prefix`, e.g. "2.x" or "2.1" """
+        key = parse_prefix(prefix)
+        upper = key[:-1] + (key[-1] + 1,) if key else (float("inf"),)
+        position = bisect_left(self.by_version, upper, key=lambda r: r.semver)
+        while position > 0:
+            position -= 1
+            release = self.by_version[position]
+            if release.semver[: len(key)] != key:
+                return None
+            if prerelease or not release.prerelease:
+                return release
+        return None
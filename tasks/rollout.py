@@ -0,0 +1,308 @@
+"""Sync the ArgoCD apps of a release and watch them until they're healthy
+
+After a bump pull request merges, `watch_rollout` triggers the sync of every affected
+app at once and follows all of them through a single watch of their Application
+resources (`kubectl get applications --watch`) instead of polling each app. Watch
+events and sync results go through one queue, so one loop sees everything as it
+happens. It returns once every app is synced and healthy, or as soon as one of them
+degrades or fails to sync, with a report of all of them.
+
+An app is only judged on the sync operation started after its first watch event, so a
+degraded state left from before the release doesn't end the rollout right away. When
+argocd refuses the sync because an operation (an automated sync) is already running, that
+operation is followed instead, and the app is synced again once it ends if it didn't
+sync the revision of the release.
+
+The argocd and kubectl calls sit behind a backend with `apps`, `get`, `sync` and
+`watch`. `ArgoCDCLI` runs the CLIs of the runner:argocd image, which has the tasks too
+(ARGOCD_SERVER and ARGOCD_AUTH_TOKEN configure argocd, the kubeconfig configures
+kubectl), and its commands can be swapped for a fake CLI (see
+benchmarks/fake_argocd.py).
+
+>> invoke -r / watch-rollout --app api --app web --revision 3f2c1e0
+>> invoke watch-rollout --selector photopills.net/library=astrolib
+"""
+import asyncio
+import json
+import os
+import shlex
+from contextlib import aclosing
+
+ARGOCD_NAMESPACE = os.getenv("ARGOCD_NAMESPACE", "argocd")
+# seconds to wait for every app to be healthy
+ROLLOUT_TIMEOUT = float(os.getenv("ROLLOUT_TIMEOUT", 900))
+
+HEALTHY, PENDING, DEGRADED, FAILED = "healthy", "pending", "degraded", "failed"
+# argocd refuses a sync while another operation runs, e.g. an automated sync
+BUSY = "another operation is already in progress"
+
+
+class ArgoCDCLI:
+    """Backend running the argocd and kubectl CLIs"""
+
+    def __init__(self, argocd="argocd", kubectl="kubectl", namespace=ARGOCD_NAMESPACE):
+        self.argocd = shlex.split(argocd)
+        self.kubectl = shlex.split(kubectl)
+        self.namespace = namespace
+        # processes started, to compare with polling
+        self.calls = 0
+
+    async def run(self, *args):
+        self.calls += 1
+        process = await asyncio.create_subprocess_exec(
+            *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+        try:
+            stdout, stderr = await process.communicate()
+        finally:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+        if process.returncode != 0:
+            raise RuntimeError(f"{shlex.join(args[:3])}: {stderr.decode().strip()}")
+        return stdout.decode()
+
+    async def apps(self, selector):
+        """Names of the apps matching the label `selector`"""
+        output = await self.run(*self.argocd, "app", "list", "-l", selector, "-o", "json")
+        return [app["metadata"]["name"] for app in json.loads(output)]
+
+    async def get(self, app):
+        return json.loads(await self.run(*self.argocd, "app", "get", app, "-o", "json"))
+
+    async def sync(self, app, revision=None):
+        args = [*self.argocd, "app", "sync", app, "--async"]
+        if revision:
+            args += ["--revision", revision]
+        await self.run(*args)
+
+    async def watch(self, apps):
+        """Application resources of `apps` as they change, the current ones first
+
+        The watch is started again when the API server closes it.
+        """
+        decoder = json.JSONDecoder()
+        while True:
+            self.calls += 1
+            process = await asyncio.create_subprocess_exec(
+                *self.kubectl,
+                *("get", "applications.argoproj.io", "-n", self.namespace),
+                *("--watch", "-o", "json"),
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            buffer, events = "", 0
+            try:
+                # kubectl prints one indented JSON document per event
+                while chunk := await process.stdout.read(65536):
+                    buffer += chunk.decode()
+                    while buffer.strip():
+                        try:
+                            resource, end = decoder.raw_decode(buffer.lstrip())
+                        except ValueError:
+                            break
+                        buffer = buffer.lstrip()[end:]
+                        events += 1
+                        if resource["metadata"]["name"] in apps:
+                            yield resource
+                await process.wait()
+            finally:
+                if process.returncode is None:
+                    process.kill()
+                    await process.wait()
+            if not events:
+                stderr = (await process.stderr.read()).decode().strip()
+                raise RuntimeError(f"kubectl watch failed: {stderr}")
+
+
+def app_status(resource):
+    """What the rollout looks at of an Application resource"""
+    status = resource.get("status") or {}
+    sync = status.get("sync") or {}
+    health = status.get("health") or {}
+    operation = status.get("operationState") or {}
+    unhealthy = []
+    for item in status.get("resources") or []:
+        item_health = item.get("health") or {}
+        if item_health.get("status") in ("Degraded", "Missing"):
+            reason = item_health.get("message") or item_health["status"]
+            unhealthy.append(f"{item['kind']}/{item['name']}: {reason}")
+    return {
+        "app": resource["metadata"]["name"],
+        "sync": sync.get("status", "Unknown"),
+        "health": health.get("status", "Unknown"),
+        "revision": sync.get("revision") or "",
+        "operation": operation.get("phase"),
+        "started": operation.get("startedAt"),
+        "message": operation.get("message") or health.get("message") or "",
+        "unhealthy": unhealthy,
+    }
+
+
+class Rollout:
+    """State of the apps of one rollout, fed by the watch and the sync results"""
+
+    def __init__(self, apps, revision=None):
+        self.apps = list(apps)
+        self.revision = revision
+        # start of the last operation of every app before ours
+        self.baseline = {}
+        self.statuses = {}
+        self.requested = set()
+        # apps following an operation that was already running when they were synced
+        self.adopted = set()
+        self.errors = {}
+
+    def state(self, app):
+        if app in self.errors:
+            return FAILED
+        status = self.statuses.get(app)
+        if status is None or app not in self.requested:
+            return PENDING
+        if status["started"] == self.baseline[app] and app not in self.adopted:
+            return PENDING
+        if status["operation"] in ("Failed", "Error"):
+            return FAILED
+        if status["health"] == "Degraded":
+            return DEGRADED
+        if (
+            status["operation"] == "Succeeded"
+            and status["sync"] == "Synced"
+            and status["health"] == "Healthy"
+            and self.has_revision(app)
+        ):
+            return HEALTHY
+        return PENDING
+
+    def has_revision(self, app):
+        status = self.statuses[app]
+        return not self.revision or status["revision"].startswith(self.revision)
+
+    def stale(self, app):
+        """Whether the adopted operation of `app` ended without syncing our revision"""
+        status = self.statuses.get(app)
+        return (
+            app in self.adopted
+            and status is not None
+            and status["operation"] not in ("Running", "Terminating")
+            and not self.has_revision(app)
+        )
+
+    def states(self):
+        return {app: self.state(app) for app in self.apps}
+
+    def done(self):
+        states = self.states().values()
+        return any(state in (DEGRADED, FAILED) for state in states) or all(
+            state == HEALTHY for state in states
+        )
+
+    def report(self):
+        """One line per app, with the unhealthy resources of the ones that failed"""
+        lines = [f"{'app':<20}{'state':<10}{'sync':<12}{'health':<13}{'revision':<10}"]
+        for app, state in self.states().items():
+            status = self.statuses.get(app) or {}
+            lines.append(
+                f"{app:<20}{state:<10}{status.get('sync', '-'):<12}"
+                f"{status.get('health', '-'):<13}{status.get('revision', '')[:8]:<10}"
+            )
+            if state in (DEGRADED, FAILED):
+                message = self.errors.get(app) or status.get("message")
+                if message:
+                    lines.append(f"    {message}")
+                lines += [f"    {item}" for item in status.get("unhealthy", [])]
+        return "\n".join(line.rstrip() for line in lines)
+
+
+async def watch_rollout(backend, apps, revision=None, timeout=ROLLOUT_TIMEOUT):
+    """Sync `apps` at `revision` and wait until they're all healthy or one isn't
+
+    Returns the `Rollout`; apps still pending after `timeout` seconds stay pending.
+    """
+    rollout = Rollout(apps, revision)
+    queue = asyncio.Queue()
+
+    async def follow():
+        try:
+            async with aclosing(backend.watch(rollout.apps)) as events:
+                async for resource in events:
+                    await queue.put(("status", resource))
+        except Exception as error:
+            await queue.put(("watch", error))
+
+    async def sync(app):
+        try:
+            await backend.sync(app, revision)
+        except Exception as error:
+            if BUSY in str(error):
+                await queue.put(("busy", app))
+            else:
+                await queue.put(("error", (app, str(error))))
+            return
+        await queue.put(("synced", app))
+
+    watcher = asyncio.create_task(follow())
+    syncs = []
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    try:
+        while not rollout.done():
+            try:
+                kind, value = await asyncio.wait_for(queue.get(), deadline - loop.time())
+            except asyncio.TimeoutError:
+                print(f"Timed out after {timeout}s")
+                break
+            if kind == "watch":
+                raise value
+            if kind == "error":
+                app, message = value
+                rollout.errors[app] = message
+                print(f"[{FAILED}] {app}: {message}")
+            elif kind == "synced":
+                rollout.requested.add(value)
+            elif kind == "busy":
+                # judged on the operation already running, as if it were ours
+                rollout.adopted.add(value)
+                rollout.requested.add(value)
+                print(f"[{PENDING}] {value}: following the operation in progress")
+            else:
+                status = app_status(value)
+                app = status["app"]
+                if app not in rollout.baseline:
+                    # sync once the state before it is known
+                    rollout.baseline[app] = status["started"]
+                    syncs.append(asyncio.create_task(sync(app)))
+                previous = rollout.state(app)
+                rollout.statuses[app] = status
+                if rollout.stale(app):
+                    # it synced another revision, now ours can be synced
+                    rollout.adopted.discard(app)
+                    rollout.requested.discard(app)
+                    rollout.baseline[app] = status["started"]
+                    syncs.append(asyncio.create_task(sync(app)))
+                if rollout.state(app) != previous:
+                    print(f"[{rollout.state(app)}] {app}: {status['health']}")
+    finally:
+        for pending in [watcher, *syncs]:
+            pending.cancel()
+        await asyncio.gather(watcher, *syncs, return_exceptions=True)
+    return rollout
+
+
+async def roll_out(
+    apps=(), selector=None, revision=None, timeout=ROLLOUT_TIMEOUT, backend=None
+):
+    """Watch the rollout of `apps` and the apps matching `selector`, print its report
+
+    Returns whether every app ended healthy.
+    """
+    backend = backend or ArgoCDCLI()
+    apps = list(apps)
+    if selector:
+        apps += [app for app in await backend.apps(selector) if app not in apps]
+    if not apps:
+        raise ValueError("No apps to roll out")
+    print(f"Rolling out {', '.join(apps)}" + (f" at {revision}" if revision else ""))
+    result = await watch_rollout(backend, apps, revision, timeout)
+    print(result.report())
+    return all(state == HEALTHY for state in result.states().values())
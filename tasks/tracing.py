@@ -0,0 +1,234 @@
+"""Per-stage tracing spans for the release and bump pipelines
+
+Spans are kept in memory and exported when the process exits:
+
+- OTEL_EXPORTER_OTLP_ENDPOINT: send them with OTLP/HTTP (JSON) to our Jaeger collector,
+  e.g. http://jaeger-collector:4318
+- TRACE_FILE: append them as JSON lines to a local file, for offline use. Read it back
+  with `invoke trace-summary` to see the slowest stages.
+
+Nothing is recorded when neither is set, so the instrumentation is free by default.
+
+with span("git.push", repo=repo.name, version=new_version):
+    repo.push(branch)
+"""
+import atexit
+import contextvars
+import json
+import os
+import threading
+import time
+import urllib.request
+from collections import defaultdict
+from contextlib import contextmanager
+
+from git import RemoteProgress
+
+OTLP_ENDPOINT = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT")
+TRACE_FILE = os.getenv("TRACE_FILE")
+SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "runner-tasks")
+
+_current = contextvars.ContextVar("span", default=None)
+_finished = []
+_lock = threading.Lock()
+
+
+class Span:
+    def __init__(self, name, attributes, parent=None):
+        self.name = name
+        self.attributes = dict(attributes)
+        self.trace_id = parent.trace_id if parent else os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent else None
+        self.events = []
+        self.error = None
+        self.start = time.time_ns()
+        self.end = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def event(self, name, **attributes):
+        event = {"name": name, "time": time.time_ns(), "attributes": attributes}
+        self.events.append(event)
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": self.start,
+            "end": self.end,
+            "attributes": self.attributes,
+            "events": self.events,
+            "error": self.error,
+        }
+
+
+def enabled():
+    return bool(OTLP_ENDPOINT or TRACE_FILE)
+
+
+def current_span():
+    return _current.get()
+
+
+@contextmanager
+def span(name, **attributes):
+    """Record the enclosed block as a span, child of the span that is currently open
+
+    The current span lives in a context variable, so concurrent asyncio tasks and the
+    threads started with `asyncio.to_thread` each get the right parent.
+    """
+    if not enabled():
+        yield Span(name, attributes)
+        return
+    current = Span(name, attributes, _current.get())
+    token = _current.set(current)
+    try:
+        yield current
+    except BaseException as exc:
+        current.error = repr(exc)
+        raise
+    finally:
+        current.end = time.time_ns()
+        _current.reset(token)
+        with _lock:
+            _finished.append(current.to_dict())
+
+
+class SpanProgress(RemoteProgress):
+    """GitPython progress handler that records throttled events on the current span
+
+    Replaces printing one line per callback (see update_astrolib.MyProgressPrinter): at
+    most one event every `interval` seconds, plus one when each git operation ends.
+    """
+
+    OP_NAMES = {
+        RemoteProgress.COUNTING: "counting",
+        RemoteProgress.COMPRESSING: "compressing",
+        RemoteProgress.WRITING: "writing",
+        RemoteProgress.RECEIVING: "receiving",
+        RemoteProgress.RESOLVING: "resolving",
+        RemoteProgress.FINDING_SOURCES: "finding_sources",
+        RemoteProgress.CHECKING_OUT: "checking_out",
+    }
+
+    def __init__(self, interval=1.0):
+        super().__init__()
+        self.interval = interval
+        self._last = 0.0
+        # callbacks run in the thread reading git's output, so remember the span now
+        self._span = current_span()
+
+    def update(self, op_code, cur_count, max_count=None, message=""):
+        now = time.monotonic()
+        finished = op_code & self.END
+        if self._span is None or (not finished and now - self._last < self.interval):
+            return
+        self._last = now
+        self._span.event(
+            self.OP_NAMES.get(op_code & self.OP_MASK, "progress"),
+            cur_count=cur_count,
+            max_count=max_count or 0,
+            message=message or "",
+            finished=bool(finished),
+        )
+
+
+def otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def otlp_attributes(attributes):
+    return [{"key": key, "value": otlp_value(value)} for key, value in attributes.items()]
+
+
+def to_otlp(spans):
+    """Build an OTLP/JSON ExportTraceServiceRequest"""
+    otlp_spans = []
+    for item in spans:
+        otlp_span = {
+            "traceId": item["trace_id"],
+            "spanId": item["span_id"],
+            "name": item["name"],
+            "kind": 1,
+            "startTimeUnixNano": str(item["start"]),
+            "endTimeUnixNano": str(item["end"]),
+            "attributes": otlp_attributes(item["attributes"]),
+            "events": [
+                {
+                    "name": event["name"],
+                    "timeUnixNano": str(event["time"]),
+                    "attributes": otlp_attributes(event["attributes"]),
+                }
+                for event in item["events"]
+            ],
+            "status": {"code": 2, "message": item["error"]} if item["error"] else {},
+        }
+        if item["parent_id"]:
+            otlp_span["parentSpanId"] = item["parent_id"]
+        otlp_spans.append(otlp_span)
+    resource = {"attributes": otlp_attributes({"service.name": SERVICE_NAME})}
+    scope_spans = [{"scope": {"name": "tasks"}, "spans": otlp_spans}]
+    return {"resourceSpans": [{"resource": resource, "scopeSpans": scope_spans}]}
+
+
+def flush():
+    """Export and forget every finished span"""
+    with _lock:
+        spans = list(_finished)
+        _finished.clear()
+    if not spans:
+        return
+    if TRACE_FILE:
+        with open(TRACE_FILE, "a") as f:
+            for item in spans:
+                f.write(json.dumps(item) + "\n")
+    if OTLP_ENDPOINT:
+        request = urllib.request.Request(
+            f"{OTLP_ENDPOINT.rstrip('/')}/v1/traces",
+            data=json.dumps(to_otlp(spans)).encode(),
+            headers={"Content-Type": "application/json"},
+        )
+        try:
+            urllib.request.urlopen(request, timeout=10).close()
+        except OSError as exc:
+            print(f"Could not export {len(spans)} spans to {OTLP_ENDPOINT}: {exc}")
+
+
+atexit.register(flush)
+
+
+def summarize(path, top=10):
+    """Print the stages that took the longest in the spans stored at `path`"""
+    durations = defaultdict(list)
+    slowest = []
+    with open(path) as f:
+        for line in f:
+            item = json.loads(line)
+            duration = (item["end"] - item["start"]) / 1e9
+            durations[item["name"]].append(duration)
+            slowest.append((duration, item))
+
+    print(f"{'stage':<24}{'count':>7}{'total s':>10}{'mean s':>10}{'max s':>10}")
+    stages = sorted(durations.items(), key=lambda stage: sum(stage[1]), reverse=True)
+    for name, values in stages[:top]:
+        total = sum(values)
+        print(
+            f"{name:<24}{len(values):>7}{total:>10.3f}"
+            f"{total / len(values):>10.3f}{max(values):>10.3f}"
+        )
+
+    print(f"\nSlowest {top} spans")
+    for duration, item in sorted(slowest, key=lambda entry: entry[0], reverse=True)[:top]:
+        attributes = item["attributes"].items()
+        attributes = ", ".join(f"{key}={value}" for key, value in attributes)
+        print(f"{duration:>9.3f}s  {item['name']:<24}{attributes}")
@@ -35,6 +35,8 @@ from pathlib import Path
 from tomlkit import parse, dumps
 from git import RemoteProgress, Repo as _Repo
 
+from .auth import git_credentials
+
 
 class MyProgressPrinter(RemoteProgress):
     def update(self, op_code, cur_count, max_count=None, message=""):
@@ -128,10 +130,11 @@ class Repo:
         return self.master
 
     def authenticated_origin(self):
-        # ensures that we are authenticated
+        # ensures that we are authenticated, with no token in the remote URL
+        # (the git commands get the token from the credential helper of tasks.auth)
+        server = os.getenv("GITHUB_SERVER_URL", "https://github.com")
         origin = self.local.remotes[0]
-        GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
-        origin.set_url(f"https://{GITHUB_TOKEN}@github.com/photopills/{self.name}")
+        origin.set_url(f"{server}/photopills/{self.name}")
         self.origin = origin
         return self.origin
 
@@ -169,7 +172,8 @@ class Repo:
 
     def push(self, branch, force=True):
         """Push branch with updated version to remote repository"""
-        info = self.origin.push(branch, force=force)
+        with git_credentials():
+            info = self.origin.push(branch, force=force)
         summary = info[0].summary
         # TODO: Create regex to match summary SHA format: b18565a..34b8681
         if ".." in summary:
@@ -191,7 +195,8 @@ def main(branch_name, major=False):
     ## main
     repo = Repo()
     # update repo
-    repo.origin.fetch()
+    with git_credentials():
+        repo.origin.fetch()
     branch = repo.checkout_to_branch(branch_name)
     ## start code specific to this repo
     versions = update_version(branch_name)
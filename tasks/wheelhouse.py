@@ -0,0 +1,356 @@
+"""Wheelhouse of the locked dependencies of the consumers, shipped in the python image
+
+Every consumer job used to download (and compile, for sdists) all its Poetry
+dependencies again. `build_wheelhouse` reads the poetry.lock of the consumers and builds
+one wheel per locked package into WHEELHOUSE_PATH/wheels, in parallel, with `pip wheel
+--no-deps` (the lock already is the full resolution). Downloads are checked against the
+hashes of the lock; git dependencies (astrolib) are built at their resolved commit.
+
+Wheels already in the wheelhouse aren't built again, and every set of lockfiles gets a
+manifest named after the hash of its requirements and the target interpreter, so an
+unchanged set is a no-op. The python image copies `wheelhouse/` and is keyed by the
+names of its wheels and manifests (see `tasks.images`), so it's only rebuilt when the
+locked requirements change, even if their wheels are built again (which are made as
+reproducible as they can with SOURCE_DATE_EPOCH anyway).
+
+`install_locked` then installs a consumer's locked packages from the wheelhouse without
+any network access, falling back to the index only for the packages it doesn't have.
+`poetry install` finds them installed and only installs the project itself. Like
+Poetry, it only installs the packages the project needs in the target environment:
+the dependencies of pyproject.toml (with the dev ones, unless `dev` is off) and theirs,
+skipping those whose markers don't match the interpreter (pywin32 on Linux) and the
+optional ones no requested extra pulls in.
+
+>> invoke build-wheelhouse --lock ../api/poetry.lock --repo web
+>> invoke install-locked --python "poetry run python"
+"""
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import re
+import shlex
+import shutil
+import subprocess
+import sys
+import sysconfig
+import tempfile
+from pathlib import Path
+
+import tomlkit
+from gidgethub import BadRequest
+from packaging.markers import Marker, default_environment
+
+from .github import github_session
+
+WHEELHOUSE_PATH = Path(
+    os.getenv("WHEELHOUSE_PATH", Path.home() / ".cache" / "photopills" / "wheelhouse")
+)
+INDEX_URL = os.getenv("PIP_INDEX_URL", "https://pypi.org/simple")
+# marker environment of another interpreter, as `packaging.markers.default_environment`
+ENVIRONMENT_SCRIPT = """
+import json, os, platform, sys
+info = sys.implementation.version
+version = f"{info.major}.{info.minor}.{info.micro}"
+if info.releaselevel != "final":
+    version += info.releaselevel[0] + str(info.serial)
+print(json.dumps({
+    "implementation_name": sys.implementation.name,
+    "implementation_version": version,
+    "os_name": os.name,
+    "platform_machine": platform.machine(),
+    "platform_release": platform.release(),
+    "platform_system": platform.system(),
+    "platform_version": platform.version(),
+    "python_full_version": platform.python_version(),
+    "platform_python_implementation": platform.python_implementation(),
+    "python_version": ".".join(platform.python_version_tuple()[:2]),
+    "sys_platform": sys.platform,
+}))
+"""
+# timestamp of the files in the wheels we build, the earliest one zip files can store
+SOURCE_DATE_EPOCH = "315532800"
+
+
+def normalize(name):
+    return name.lower().replace("_", "-").replace(".", "-")
+
+
+def marker_environment(python=None):
+    """Environment the markers are evaluated in, of the `python` command if any"""
+    if python is None:
+        return default_environment()
+    command = [*shlex.split(python), "-c", ENVIRONMENT_SCRIPT]
+    output = subprocess.run(command, check=True, capture_output=True, text=True)
+    return json.loads(output.stdout)
+
+
+def constraints(spec):
+    """Constraint tables of a dependency, Poetry takes a string, a table or a list"""
+    if isinstance(spec, str):
+        return [{"version": spec}]
+    if isinstance(spec, list):
+        return [dict(item) for item in spec]
+    return [dict(spec)]
+
+
+def root_dependencies(pyproject, dev=True):
+    """(name, spec) of the dependencies of a pyproject.toml"""
+    poetry = pyproject["tool"]["poetry"]
+    tables = [poetry.get("dependencies", {})]
+    if dev:
+        tables.append(poetry.get("dev-dependencies", {}))
+        groups = poetry.get("group", {}).values()
+        tables += [group.get("dependencies", {}) for group in groups]
+    for table in tables:
+        for name, spec in table.items():
+            if name.lower() != "python":
+                yield name, spec
+
+
+def required_packages(lock, pyproject, environment, dev=True):
+    """Normalized names of the locked packages the project needs in `environment`"""
+    packages = {normalize(str(package["name"])): package for package in lock["package"]}
+    # requested extras of every package needed
+    needed, pending = {}, []
+
+    def depend(name, spec, extras=(), optional=()):
+        name = normalize(name)
+        for constraint in constraints(spec):
+            if constraint.get("optional") and name not in optional:
+                continue
+            markers = constraint.get("markers")
+            if markers:
+                marker = Marker(str(markers))
+                if not any(
+                    marker.evaluate(dict(environment, extra=extra))
+                    for extra in extras or [""]
+                ):
+                    continue
+            requested = {str(extra) for extra in constraint.get("extras", [])}
+            if name not in needed or not requested <= needed[name]:
+                needed.setdefault(name, set()).update(requested)
+                pending.append(name)
+
+    for name, spec in root_dependencies(pyproject, dev):
+        depend(name, spec)
+    while pending:
+        name = pending.pop()
+        package = packages.get(name)
+        if package is None:
+            continue
+        extras = sorted(needed[name])
+        # "name (>=1.0)" or "name[extra] (>=1.0)" in the extras of the package
+        optional = {
+            normalize(re.split(r"[\s(\[<>=!~;]", str(dependency))[0])
+            for extra in extras
+            for dependency in package.get("extras", {}).get(extra, [])
+        }
+        for dependency, spec in package.get("dependencies", {}).items():
+            depend(dependency, spec, extras, optional)
+    return set(needed)
+
+
+def locked_requirements(lock_text, pyproject_text=None, environment=None, dev=True):
+    """pip requirement of every package of a poetry.lock, with the hashes of its files
+
+    Returns {requirement: [hash, ...]}; git packages are pinned to their resolved
+    commit and have no hashes. With the `pyproject_text` of the project, only the
+    packages it needs in the marker `environment` (this interpreter's by default) are
+    returned, see `required_packages`.
+    """
+    lock = tomlkit.parse(lock_text)
+    # lock format 1.x lists the files in the metadata, 2.x in each package
+    metadata_files = lock.get("metadata", {}).get("files", {})
+    required = None
+    if pyproject_text is not None:
+        pyproject = tomlkit.parse(pyproject_text)
+        environment = environment or marker_environment()
+        required = required_packages(lock, pyproject, environment, dev)
+    requirements = {}
+    for package in lock.get("package", []):
+        name, version = str(package["name"]), str(package["version"])
+        if required is not None and normalize(name) not in required:
+            continue
+        source = package.get("source", {})
+        if source.get("type") == "git":
+            url, commit = source["url"], source["resolved_reference"]
+            requirements[f"{name} @ git+{url}@{commit}"] = []
+            continue
+        if source.get("type") in ("directory", "file"):
+            continue
+        files = package.get("files") or metadata_files.get(name, [])
+        hashes = sorted(str(item["hash"]) for item in files)
+        requirements[f"{normalize(name)}=={version}"] = hashes
+    return requirements
+
+
+def target():
+    """Interpreter the wheels are built for, part of the wheelhouse key"""
+    version = f"cp{sys.version_info.major}{sys.version_info.minor}"
+    return f"{version}-{sysconfig.get_platform()}"
+
+
+def wheelhouse_key(requirements):
+    lines = [target()]
+    for requirement in sorted(requirements):
+        lines.append(f"{requirement} {' '.join(requirements[requirement])}")
+    return hashlib.sha256("\n".join(lines).encode()).hexdigest()
+
+
+async def fetch_file(gh, repo, path, rev="master"):
+    """`path` of photopills/`repo` at `rev` through the contents API"""
+    data = await gh.getitem(f"/repos/photopills/{repo}/contents/{path}?ref={rev}")
+    return base64.b64decode(data["content"]).decode()
+
+
+async def fetch_project(gh, repo, rev="master"):
+    """poetry.lock and pyproject.toml (None if missing) of photopills/`repo`"""
+    lock = await fetch_file(gh, repo, "poetry.lock", rev)
+    try:
+        pyproject = await fetch_file(gh, repo, "pyproject.toml", rev)
+    except BadRequest:
+        pyproject = None
+    return lock, pyproject
+
+
+def read_project(lock_path):
+    """Text of `lock_path` and of the pyproject.toml next to it (None if missing)"""
+    pyproject = Path(lock_path).parent / "pyproject.toml"
+    text = pyproject.read_text() if pyproject.exists() else None
+    return Path(lock_path).read_text(), text
+
+
+class Wheelhouse:
+    def __init__(self, root=WHEELHOUSE_PATH, index_url=INDEX_URL):
+        self.root = Path(root)
+        self.index_url = index_url
+        self.wheels = self.root / "wheels"
+        self.wheels.mkdir(parents=True, exist_ok=True)
+        # wheel files built for every requirement, across every build
+        self.built_path = self.root / "built.json"
+
+    def built(self):
+        if not self.built_path.exists():
+            return {}
+        built = json.loads(self.built_path.read_text())
+        return {
+            requirement: wheels
+            for requirement, wheels in built.items()
+            if all((self.wheels / wheel).exists() for wheel in wheels)
+        }
+
+    def manifest_path(self, key):
+        return self.root / "manifests" / f"{key}.json"
+
+    async def build_wheel(self, requirement, hashes, semaphore):
+        """Build the wheels of one requirement, returns their file names"""
+        async with semaphore:
+            with tempfile.TemporaryDirectory() as tmp:
+                requirements_file = Path(tmp) / "requirements.txt"
+                options = " ".join(f"--hash={value}" for value in hashes)
+                requirements_file.write_text(f"{requirement} {options}\n")
+                process = await asyncio.create_subprocess_exec(
+                    sys.executable,
+                    *("-m", "pip", "wheel", "--no-deps", "--quiet"),
+                    *("--index-url", self.index_url),
+                    *("--wheel-dir", str(Path(tmp) / "out")),
+                    *("-r", str(requirements_file)),
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.STDOUT,
+                    env={"SOURCE_DATE_EPOCH": SOURCE_DATE_EPOCH, **os.environ},
+                )
+                output, _ = await process.communicate()
+                if process.returncode != 0:
+                    raise RuntimeError(f"{requirement}: {output.decode().strip()}")
+                wheels = []
+                for wheel in (Path(tmp) / "out").glob("*.whl"):
+                    shutil.move(str(wheel), self.wheels / wheel.name)
+                    wheels.append(wheel.name)
+                return wheels
+
+    async def build(self, requirements, jobs=4):
+        """Build the wheels of `requirements` missing from the wheelhouse
+
+        Returns the wheelhouse key of `requirements` and the requirements that failed,
+        which can't be installed from it.
+        """
+        key = wheelhouse_key(requirements)
+        if self.manifest_path(key).exists():
+            print(f"Wheelhouse {key[:12]} is up to date")
+            return key, {}
+        built = self.built()
+        missing = [req for req in requirements if req not in built]
+        print(f"Building {len(missing)} of {len(requirements)} wheels")
+        semaphore = asyncio.Semaphore(jobs)
+        results = await asyncio.gather(
+            *(
+                self.build_wheel(requirement, requirements[requirement], semaphore)
+                for requirement in missing
+            ),
+            return_exceptions=True,
+        )
+        failed = {}
+        for requirement, result in zip(missing, results):
+            if isinstance(result, Exception):
+                # e.g. a package that only installs on another platform
+                failed[requirement] = str(result)
+                print(f"[failed] {result}")
+            else:
+                built[requirement] = result
+        self.built_path.write_text(json.dumps(built, indent=2, sort_keys=True))
+        manifest = {
+            "target": target(),
+            "wheels": {req: built[req] for req in sorted(requirements) if req in built},
+            "failed": failed,
+        }
+        self.manifest_path(key).parent.mkdir(exist_ok=True)
+        self.manifest_path(key).write_text(json.dumps(manifest, indent=2))
+        return key, failed
+
+
+async def build_wheelhouse(
+    locks=(), repos=(), root=WHEELHOUSE_PATH, jobs=4, index_url=INDEX_URL
+):
+    """Build the wheelhouse of the `locks` files and the locks of the `repos`
+
+    The packages the consumers only need on other platforms are left out, the image
+    runs this interpreter.
+    """
+    projects = [read_project(lock) for lock in locks]
+    if repos:
+        async with github_session() as gh:
+            projects += await asyncio.gather(*(fetch_project(gh, repo) for repo in repos))
+    requirements = {}
+    for lock, pyproject in projects:
+        requirements.update(locked_requirements(lock, pyproject))
+    key, failed = await Wheelhouse(root, index_url).build(requirements, jobs)
+    print(f"Wheelhouse {key[:12]}: {len(requirements) - len(failed)} wheels in {root}")
+    return key
+
+
+def install_locked(
+    path=".", python="python", root=WHEELHOUSE_PATH, index_url=INDEX_URL, dev=True
+):
+    """Install the packages of `path`/poetry.lock, from the wheelhouse when it has them
+
+    `python` is the interpreter of the environment to install into, e.g. "poetry run
+    python" for the Poetry virtualenv; only the packages the project needs there are
+    installed, the dev ones too with `dev`. Returns the requirements that came from the
+    index.
+    """
+    lock, pyproject = read_project(Path(path) / "poetry.lock")
+    environment = marker_environment(python) if pyproject is not None else None
+    requirements = locked_requirements(lock, pyproject, environment, dev)
+    built = Wheelhouse(root).built()
+    local = [requirement for requirement in requirements if requirement in built]
+    remote = [requirement for requirement in requirements if requirement not in built]
+    pip = [*shlex.split(python), "-m", "pip", "install", "--no-deps", "--quiet"]
+    if local:
+        wheels = [Path(root) / "wheels" / wheel for req in local for wheel in built[req]]
+        subprocess.run([*pip, "--no-index", *map(str, wheels)], check=True)
+    if remote:
+        subprocess.run([*pip, "--index-url", index_url, *remote], check=True)
+    print(f"{len(local)} packages from the wheelhouse, {len(remote)} from the index")
+    return remote
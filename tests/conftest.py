@@ -0,0 +1,20 @@
+import os
+import tempfile
+
+# the tasks read their cache paths at import time, keep the tests off ~/.cache
+CACHE = tempfile.mkdtemp(prefix="runner-tests-")
+for variable, name in [
+    ("GITHUB_CACHE_PATH", "github"),
+    ("RELEASE_INDEX_PATH", "releases"),
+    ("CHANGELOG_CACHE_PATH", "changelog"),
+    ("JOB_LEDGER_PATH", "jobs.sqlite"),
+    ("WHEELHOUSE_PATH", "wheelhouse"),
+    ("GITHUB_TOKEN_CACHE_PATH", "tokens.json"),
+]:
+    os.environ[variable] = os.path.join(CACHE, name)
+for variable in ("MIRROR_CACHE_PATH", "GITHUB_APP_ID", "TRACE_FILE"):
+    os.environ.pop(variable, None)
+os.environ["GITHUB_TOKEN"] = "test"
+for role in ("AUTHOR", "COMMITTER"):
+    os.environ[f"GIT_{role}_NAME"] = "runner tests"
+    os.environ[f"GIT_{role}_EMAIL"] = "tests@example.com"
@@ -0,0 +1,191 @@
+import asyncio
+import json
+import subprocess
+import time
+
+import jwt
+import pytest
+
+from benchmarks.auth import key_pair
+from tasks.auth import (
+    GitHubApp,
+    credential,
+    credential_helper,
+    git_config_parameters,
+    git_credentials,
+    sq_quote,
+)
+
+SERVER = "https://github.com"
+
+
+@pytest.fixture(scope="module")
+def keys():
+    return key_pair()
+
+
+class FakeGitHub:
+    """`post` of the installation tokens endpoint"""
+
+    def __init__(self, expires_in=3600):
+        self.expires_in = expires_in
+        self.posts = []
+
+    async def post(self, url, data, jwt):
+        self.posts.append((url, jwt))
+        await asyncio.sleep(0.01)
+        expires = time.gmtime(time.time() + self.expires_in)
+        return {
+            "token": f"ghs_{len(self.posts)}",
+            "expires_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", expires),
+        }
+
+
+@pytest.fixture
+def git_config(tmp_path, monkeypatch):
+    """git reads no config file but the one of the tests, outside of any repository"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("GIT_CONFIG_GLOBAL", str(tmp_path / "gitconfig"))
+    monkeypatch.setenv("GIT_CONFIG_NOSYSTEM", "1")
+    monkeypatch.delenv("GIT_CONFIG_PARAMETERS", raising=False)
+
+
+def app(keys, tmp_path, **kwargs):
+    cache_path = tmp_path / "tokens.json"
+    return GitHubApp("1234", keys[0], installation_id=42, cache_path=cache_path, **kwargs)
+
+
+def test_jwt(keys, tmp_path):
+    github_app = app(keys, tmp_path)
+    token = github_app.jwt()
+    claims = jwt.decode(token, keys[1], algorithms=["RS256"])
+    assert claims["iss"] == "1234"
+    assert claims["exp"] - claims["iat"] == 600
+    assert claims["iat"] <= time.time() - 60
+    assert github_app.jwt() == token
+
+    # a minute before it expires it's minted again
+    github_app._jwt_expires = time.time() + 30
+    github_app.jwt()
+    assert github_app._jwt_expires > time.time() + 60
+
+
+def test_one_refresh_for_concurrent_requests(keys, tmp_path):
+    github_app = app(keys, tmp_path)
+    gh = FakeGitHub()
+
+    async def tokens():
+        return await asyncio.gather(*(github_app.token(gh) for _ in range(5)))
+
+    assert asyncio.run(tokens()) == ["ghs_1"] * 5
+    url, token = gh.posts[0]
+    assert url == "/app/installations/42/access_tokens"
+    assert jwt.decode(token, keys[1], algorithms=["RS256"])["iss"] == "1234"
+    assert github_app.minted == 1
+
+
+def test_tokens_are_shared_through_the_disk_cache(keys, tmp_path):
+    gh = FakeGitHub()
+    assert asyncio.run(app(keys, tmp_path).token(gh)) == "ghs_1"
+    cache = json.loads((tmp_path / "tokens.json").read_text())
+    assert cache["1234/photopills"]["token"] == "ghs_1"
+    assert (tmp_path / "tokens.json").stat().st_mode & 0o777 == 0o600
+
+    # another process
+    other = app(keys, tmp_path)
+    assert other.cached() == "ghs_1"
+    assert asyncio.run(other.token(gh)) == "ghs_1"
+    assert len(gh.posts) == 1
+
+
+def test_tokens_about_to_expire_are_refreshed(keys, tmp_path):
+    gh = FakeGitHub(expires_in=200)
+    github_app = app(keys, tmp_path, margin=300)
+    assert asyncio.run(github_app.token(gh)) == "ghs_1"
+    # in memory and on disk, but within the margin
+    assert github_app.cached() is None
+    gh.expires_in = 3600
+    assert asyncio.run(github_app.token(gh)) == "ghs_2"
+    assert app(keys, tmp_path, margin=300).cached() == "ghs_2"
+
+
+def test_forget(keys, tmp_path):
+    github_app = app(keys, tmp_path)
+    asyncio.run(github_app.token(FakeGitHub()))
+    github_app.forget("ghs_another")
+    assert github_app.cached() == "ghs_1"
+    github_app.forget("ghs_1")
+    assert github_app.cached() is None
+    assert app(keys, tmp_path).cached() is None
+
+
+def test_sq_quote():
+    assert sq_quote("a b") == "'a b'"
+    assert sq_quote("it's") == "'it'\\''s'"
+
+
+def config(key):
+    result = subprocess.run(
+        ["git", "config", "--get-all", key], capture_output=True, text=True
+    )
+    return result.stdout.splitlines()
+
+
+def test_git_reads_the_config_parameters(git_config, monkeypatch):
+    key = f"credential.{SERVER}.helper"
+    previous = sq_quote("user.name=O'Brien") + " " + sq_quote(f"{key}=store")
+    parameters = git_config_parameters(SERVER, previous)
+    assert parameters.startswith(previous + " ")
+
+    monkeypatch.setenv("GIT_CONFIG_PARAMETERS", parameters)
+    assert config("user.name") == ["O'Brien"]
+    # the empty value resets the helpers before it
+    assert config(key) == ["store", "", credential_helper()]
+
+
+def test_git_credentials_restores_the_environment(git_config, monkeypatch):
+    with git_credentials(SERVER):
+        assert config(f"credential.{SERVER}.helper")[-1] == credential_helper()
+    assert config(f"credential.{SERVER}.helper") == []
+
+    monkeypatch.setenv("GIT_CONFIG_PARAMETERS", sq_quote("user.name=someone"))
+    with git_credentials(SERVER):
+        assert config("user.name") == ["someone"]
+    assert config(f"credential.{SERVER}.helper") == []
+
+
+def test_credential():
+    request = ["protocol=https", "host=github.com"]
+    assert credential("get", request) == "username=x-access-token\npassword=test\n"
+    assert credential("get", ["protocol=https", "host=gitlab.com"]) == ""
+    assert credential("store", request + ["password=test"]) == ""
+
+
+def fill():
+    result = subprocess.run(
+        ["git", "credential", "fill"],
+        input="protocol=https\nhost=github.com\n\n",
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return dict(line.split("=", 1) for line in result.stdout.splitlines())
+
+
+def test_the_helper_answers_git(keys, tmp_path, git_config, monkeypatch):
+    with git_credentials(SERVER):
+        assert fill()["password"] == "test"
+
+    # the installation token of the app, from the cache of another process
+    asyncio.run(app(keys, tmp_path).token(FakeGitHub()))
+    monkeypatch.setenv("GITHUB_APP_ID", "1234")
+    monkeypatch.setenv("GITHUB_APP_PRIVATE_KEY", keys[0])
+    monkeypatch.setenv("GITHUB_APP_INSTALLATION_ID", "42")
+    monkeypatch.setenv("GITHUB_TOKEN_CACHE_PATH", str(tmp_path / "tokens.json"))
+    with git_credentials(SERVER):
+        assert fill() == {
+            "protocol": "https",
+            "host": "github.com",
+            "username": "x-access-token",
+            "password": "ghs_1",
+        }
@@ -0,0 +1,110 @@
+import asyncio
+import subprocess
+
+import pytest
+
+from benchmarks.e2e import LIBRARY, NEW_TAG, make_consumer, make_library, seed_github
+from benchmarks.fake_github import FakeGitHub
+from tasks import bump
+
+
+@pytest.fixture
+def remotes(tmp_path, monkeypatch):
+    make_library(tmp_path)
+    monkeypatch.setenv("GITHUB_SERVER_URL", f"file://{tmp_path / 'remotes'}")
+    return tmp_path / "remotes"
+
+
+def on_fake_github(remotes, monkeypatch, scenario):
+    """Run `scenario(github)` with the tasks talking to a fake GitHub"""
+
+    async def run():
+        github = FakeGitHub(remotes=remotes)
+        seed_github(github)
+        monkeypatch.setenv("GITHUB_API_URL", await github.start())
+        try:
+            return await scenario(github)
+        finally:
+            await github.stop()
+
+    return asyncio.run(run())
+
+
+def pushed(remotes, name, *args):
+    """Output of `git show` of the pushed bump branch, with `args` appended to the ref"""
+    branch = f"{bump.BUMP_BRANCH_PREFIX}{NEW_TAG}"
+    command = ["git", "show", "--no-patch", "--format=%s", "".join([branch, *args])]
+    return subprocess.run(
+        command, cwd=remotes / "photopills" / name, check=True, capture_output=True
+    ).stdout.decode()
+
+
+def test_resume_reapplies_the_uncommitted_manifest(remotes, monkeypatch, tmp_path):
+    make_consumer(tmp_path, "resumed", 2, 10)
+    update_lock = bump.update_lock
+
+    async def scenario(github):
+        async def broken_lock(*args, **kwargs):
+            raise RuntimeError("lock failed")
+
+        monkeypatch.setattr(bump, "update_lock", broken_lock)
+        workspace = tmp_path / "workspace"
+        (failed,) = await bump.fan_out(LIBRARY, ["resumed"], workspace=workspace)
+        assert not failed["ok"]
+        assert github.pulls["resumed"] == []
+
+        monkeypatch.setattr(bump, "update_lock", update_lock)
+        (resumed,) = await bump.fan_out(LIBRARY, ["resumed"], workspace=workspace)
+        assert resumed["ok"]
+        return github.pulls["resumed"]
+
+    (pull,) = on_fake_github(remotes, monkeypatch, scenario)
+    assert pull["title"].endswith(f"from v1.0.0 to {NEW_TAG}")
+    message = f"Bumps {LIBRARY} from v1.0.0 to {NEW_TAG}"
+    assert pushed(remotes, "resumed").strip() == message
+    assert f'rev = "{NEW_TAG}"' in pushed(remotes, "resumed", ":pyproject.toml")
+    assert f'reference = "{NEW_TAG}"' in pushed(remotes, "resumed", ":poetry.lock")
+
+
+def test_finished_bumps_are_not_pushed_again(remotes, monkeypatch, tmp_path):
+    make_consumer(tmp_path, "finished", 2, 10)
+    pushes = []
+    push = bump.Repo.push
+
+    def counting_push(self, *args, **kwargs):
+        pushes.append(self.name)
+        return push(self, *args, **kwargs)
+
+    monkeypatch.setattr(bump.Repo, "push", counting_push)
+
+    async def scenario(github):
+        workspace = tmp_path / "workspace"
+        for _ in range(2):
+            (result,) = await bump.fan_out(LIBRARY, ["finished"], workspace=workspace)
+            assert result["ok"]
+        return github.pulls["finished"]
+
+    assert len(on_fake_github(remotes, monkeypatch, scenario)) == 1
+    assert pushes == ["finished"]
+
+
+def test_one_github_client_per_bump(remotes, monkeypatch, tmp_path):
+    from tasks import github as tasks_github
+
+    make_consumer(tmp_path, "shared", 2, 10)
+    clients = []
+    enter = tasks_github.GitHubClient.__aenter__
+
+    async def counting_enter(self):
+        clients.append(self)
+        return await enter(self)
+
+    monkeypatch.setattr(tasks_github.GitHubClient, "__aenter__", counting_enter)
+
+    async def scenario(github):
+        path = tmp_path / "workspace" / "shared"
+        return await bump.bump_consumer(str(path), LIBRARY, name="shared")
+
+    pull = on_fake_github(remotes, monkeypatch, scenario)
+    assert pull["html_url"]
+    assert len(clients) == 1
@@ -0,0 +1,56 @@
+from tasks import changelog
+from tasks.changelog import Changelog, has_commit_graph, parse_commit
+from tasks.mirrors import git
+
+IDENTITY = ("-c", "user.name=test", "-c", "user.email=test@example.com")
+
+
+def make_library(path, subjects):
+    git("init", "--quiet", "--initial-branch", "master", str(path))
+    for number, subject in enumerate(subjects):
+        (path / "CHANGES").write_text(f"{number}\n")
+        git("add", "CHANGES", cwd=path)
+        git(*IDENTITY, "commit", "--quiet", "-m", subject, cwd=path)
+        git("tag", f"v1.0.{number}", cwd=path)
+    return path
+
+
+def test_parse_commit():
+    assert parse_commit("a", "feat(api): add it")["type"] == "feat"
+    assert parse_commit("a", "fix!: drop it")["type"] == "breaking"
+    assert parse_commit("a", "fix: it", "BREAKING CHANGE: gone")["type"] == "breaking"
+    assert parse_commit("a", "chore: tidy")["type"] == "other"
+    assert parse_commit("a", "Tidy up")["scope"] is None
+
+
+def test_notes_of_a_checkout(tmp_path):
+    subjects = ["feat: first", "fix(api): second", "feat!: third", "Bumps version from x"]
+    library = make_library(tmp_path / "library", subjects)
+    notes = Changelog(library, cache_path=tmp_path / "cache").notes("v1.0.0", "v1.0.3")
+
+    assert "### Breaking changes\n\n- third" in notes
+    assert "### Bug fixes\n\n- **api:** second" in notes
+    assert "first" not in notes and "Bumps version" not in notes
+    # the checkout of the user is left as it was
+    assert not has_commit_graph(library)
+
+
+def test_ranges_are_cached(tmp_path):
+    library = make_library(tmp_path / "library", [f"feat: {n}" for n in range(6)])
+    cache = tmp_path / "cache"
+    Changelog(library, cache_path=cache).notes("v1.0.0", "v1.0.4")
+    again = Changelog(library, cache_path=cache)
+    assert len(again.commits("v1.0.0", "v1.0.5")) == 5
+    assert again.walked == 1
+
+
+def test_library_history_mirrors_get_a_commit_graph(tmp_path, monkeypatch):
+    library = make_library(tmp_path / "library", ["feat: first", "fix: second"])
+    monkeypatch.setattr(changelog, "MIRROR_PATH", None)
+    monkeypatch.setattr(changelog, "CACHE_PATH", tmp_path / "cache")
+
+    mirror = changelog.library_history("library", f"file://{library}")
+    assert has_commit_graph(mirror)
+    assert not has_commit_graph(library)
+    notes = changelog.release_notes("library", f"file://{library}", "v1.0.0", "v1.0.1")
+    assert "- second" in notes
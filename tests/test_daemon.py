@@ -0,0 +1,259 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import time
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+from benchmarks.e2e import (
+    LIBRARY,
+    LIBRARY_PYPROJECT,
+    NEW_TAG,
+    git,
+    make_consumer,
+    make_library,
+    seed_github,
+)
+from benchmarks.fake_github import FakeGitHub
+from tasks import bump, daemon as tasks_daemon
+from tasks.daemon import BumpDaemon, is_newer, verify_signature
+from tasks.ledger import CANCELLED, Ledger
+
+SECRET = "s3cret"
+TAGS = ["v1.2.0", "v1.3.0"]
+
+
+@pytest.fixture
+def remotes(tmp_path, monkeypatch):
+    make_library(tmp_path)
+    remotes = tmp_path / "remotes"
+    for tag in TAGS:
+        git("tag", tag, cwd=remotes / "photopills" / LIBRARY)
+    monkeypatch.setenv("GITHUB_SERVER_URL", f"file://{remotes}")
+    return remotes
+
+
+def signature(body, secret=SECRET):
+    digest = hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+    return f"sha256={digest}"
+
+
+async def deliver(client, event, payload, secret=SECRET):
+    body = json.dumps(payload).encode()
+    headers = {
+        "X-GitHub-Event": event,
+        "X-GitHub-Delivery": f"delivery-{time.monotonic()}",
+        "X-Hub-Signature-256": signature(body, secret),
+    }
+    response = await client.post("/webhook", data=body, headers=headers)
+    return response.status, await response.json()
+
+
+def release(tag, library=LIBRARY, action="published"):
+    return {
+        "action": action,
+        "repository": {"name": library},
+        "release": {"tag_name": tag},
+    }
+
+
+async def settle(daemon, timeout=60):
+    """Wait until the daemon has no debounced, queued or running jobs"""
+    deadline = time.monotonic() + timeout
+    while daemon.timers or daemon.queue.qsize() or daemon.running:
+        assert time.monotonic() < deadline, "the daemon didn't settle"
+        await asyncio.sleep(0.02)
+
+
+def on_daemon(monkeypatch, tmp_path, scenario, consumers=("api",), **kwargs):
+    """Run `scenario(client, daemon, github)` with a daemon serving a fake GitHub"""
+
+    async def run():
+        github = FakeGitHub(remotes=tmp_path / "remotes")
+        seed_github(github)
+        for tag in TAGS:
+            pyproject = LIBRARY_PYPROJECT.format(version=tag[1:])
+            github.files[(LIBRARY, tag, "pyproject.toml")] = pyproject
+        monkeypatch.setenv("GITHUB_API_URL", await github.start())
+        daemon = BumpDaemon(
+            [LIBRARY], consumers, tmp_path / "workspace", secret=SECRET, **kwargs
+        )
+        client = TestClient(TestServer(daemon.app()))
+        await client.start_server()
+        try:
+            return await scenario(client, daemon, github)
+        finally:
+            await client.close()
+            await github.stop()
+
+    return asyncio.run(run())
+
+
+def test_verify_signature():
+    body = b'{"action": "published"}'
+    assert verify_signature(SECRET, body, signature(body))
+    assert not verify_signature(SECRET, body, signature(body, "another"))
+    assert not verify_signature(SECRET, body, None)
+    assert not verify_signature("", body, signature(body, ""))
+
+
+def test_is_newer():
+    assert is_newer("v1.1.0", None)
+    assert is_newer("v1.10.0", "v1.9.0")
+    assert not is_newer("v1.1.0", "v1.1.1")
+    assert is_newer("nightly", "v1.0.0")
+
+
+def test_webhooks_must_be_signed(monkeypatch, tmp_path):
+    async def scenario(client, daemon, github):
+        body = json.dumps(release(NEW_TAG)).encode()
+        headers = {"X-GitHub-Event": "release"}
+        unsigned = await client.post("/webhook", data=body, headers=headers)
+        forged = await deliver(client, "release", release(NEW_TAG), secret="guessed")
+        ping = await deliver(client, "ping", {"zen": "Keep it logically awesome."})
+        return unsigned.status, forged, ping, dict(daemon.latest)
+
+    unsigned, forged, ping, latest = on_daemon(monkeypatch, tmp_path, scenario)
+    assert unsigned == 401
+    assert forged == (401, {"message": "Invalid signature"})
+    assert ping == (200, {"message": "pong"})
+    assert latest == {}
+
+
+def test_only_published_releases_of_the_libraries_are_bumped(monkeypatch, tmp_path):
+    async def scenario(client, daemon, github):
+        responses = [
+            await deliver(client, "push", {"ref": "refs/heads/master"}),
+            await deliver(client, "release", release(NEW_TAG, action="created")),
+            await deliver(client, "release", release(NEW_TAG, library="other")),
+            await deliver(client, "release", release(NEW_TAG)),
+        ]
+        health = await (await client.get("/health")).json()
+        return responses, health
+
+    responses, health = on_daemon(monkeypatch, tmp_path, scenario, debounce=10)
+    assert responses[0] == (200, {"message": "Ignored push event"})
+    assert responses[1] == (200, {"message": "Ignored release event"})
+    assert responses[2] == (200, {"message": "other has no consumers"})
+    assert responses[3] == (202, {"version": NEW_TAG, "debounce": 10})
+    assert health["debouncing"] == {LIBRARY: NEW_TAG}
+    assert health["queue_depth"] == 0
+
+
+def test_health_reports_the_queue(monkeypatch, tmp_path):
+    done = asyncio.Event()
+    started = []
+
+    async def fake_bump(path, library, version, **kwargs):
+        started.append(kwargs["name"])
+        await done.wait()
+        return {"html_url": f"https://github.com/photopills/{kwargs['name']}/pull/1"}
+
+    monkeypatch.setattr(tasks_daemon, "bump_consumer", fake_bump)
+
+    async def scenario(client, daemon, github):
+        await deliver(client, "release", release(NEW_TAG))
+        while not started:
+            await asyncio.sleep(0.01)
+        busy = await (await client.get("/health")).json()
+        done.set()
+        await settle(daemon)
+        idle = await (await client.get("/health")).json()
+        return busy, idle
+
+    consumers = ("first", "second", "third")
+    busy, idle = on_daemon(
+        monkeypatch, tmp_path, scenario, consumers, workers=1, debounce=0
+    )
+    assert busy["status"] == "ok"
+    assert (busy["busy_workers"], busy["queue_depth"]) == (1, 2)
+    assert (idle["busy_workers"], idle["queue_depth"]) == (0, 0)
+    assert (idle["processed"], idle["failed"]) == (3, 0)
+
+
+def test_a_worker_bumps_the_consumers(remotes, monkeypatch, tmp_path):
+    make_consumer(tmp_path, "served", 2, 10)
+
+    async def scenario(client, daemon, github):
+        status, _ = await deliver(client, "release", release(NEW_TAG))
+        await settle(daemon)
+        health = await (await client.get("/health")).json()
+        return status, health, github.pulls["served"]
+
+    status, health, pulls = on_daemon(
+        monkeypatch, tmp_path, scenario, ["served"], debounce=0
+    )
+    assert status == 202
+    assert (health["processed"], health["failed"]) == (1, 0), health["last_error"]
+    (pull,) = pulls
+    assert pull["title"].endswith(f"from v1.0.0 to {NEW_TAG}")
+
+
+def test_quick_releases_are_bumped_once(remotes, monkeypatch, tmp_path):
+    make_consumer(tmp_path, "debounced", 2, 10)
+    versions = []
+    bump_consumer = tasks_daemon.bump_consumer
+
+    async def counting_bump(path, library, version, **kwargs):
+        versions.append(version)
+        return await bump_consumer(path, library, version, **kwargs)
+
+    monkeypatch.setattr(tasks_daemon, "bump_consumer", counting_bump)
+
+    async def scenario(client, daemon, github):
+        first = await deliver(client, "release", release(NEW_TAG))
+        second = await deliver(client, "release", release("v1.2.0"))
+        late = await deliver(client, "release", release(NEW_TAG))
+        await settle(daemon)
+        return (first, second, late), github.pulls["debounced"]
+
+    responses, pulls = on_daemon(
+        monkeypatch, tmp_path, scenario, ["debounced"], debounce=0.2
+    )
+    assert [status for status, _ in responses] == [202, 202, 200]
+    assert responses[2][1] == {"message": f"{NEW_TAG} superseded by v1.2.0"}
+    assert versions == ["v1.2.0"]
+    (pull,) = pulls
+    assert pull["title"].endswith("from v1.0.0 to v1.2.0")
+
+
+def test_superseded_bumps_are_cancelled(remotes, monkeypatch, tmp_path):
+    make_consumer(tmp_path, "superseded", 2, 10)
+    locking = asyncio.Event()
+    update_lock = bump.update_lock
+
+    async def slow_lock(path, versions, gh=None):
+        if versions["new_version"] == "v1.2.0":
+            locking.set()
+            await asyncio.sleep(60)
+        return await update_lock(path, versions, gh=gh)
+
+    monkeypatch.setattr(bump, "update_lock", slow_lock)
+
+    async def scenario(client, daemon, github):
+        await deliver(client, "release", release(NEW_TAG))
+        await settle(daemon)
+        opened = dict(github.pulls["superseded"][0])
+
+        await deliver(client, "release", release("v1.2.0"))
+        await asyncio.wait_for(locking.wait(), 30)
+        await deliver(client, "release", release("v1.3.0"))
+        await settle(daemon)
+        health = await (await client.get("/health")).json()
+        return opened, github.pulls["superseded"], health
+
+    opened, pulls, health = on_daemon(
+        monkeypatch, tmp_path, scenario, ["superseded"], debounce=0
+    )
+    assert (health["processed"], health["superseded"]) == (2, 1), health["last_error"]
+    # the pull request of v1.1.0 now bumps to v1.3.0
+    (pull,) = pulls
+    assert pull["number"] == opened["number"]
+    assert opened["title"].endswith(f"to {NEW_TAG}")
+    assert pull["title"].endswith("from v1.0.0 to v1.3.0")
+    (cancelled,) = [
+        job for job in Ledger().jobs(CANCELLED) if job["repo"] == "superseded"
+    ]
+    assert (cancelled["version"], cancelled["error"]) == ("v1.2.0", "superseded")
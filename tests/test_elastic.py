@@ -0,0 +1,121 @@
+import asyncio
+
+import pytest
+
+from benchmarks.fake_elasticsearch import GB, FakeElasticsearch, seed
+from tasks.elastic import (
+    DAY,
+    DELETE,
+    FORCEMERGE,
+    ROLLOVER,
+    SNAPSHOT,
+    lifecycle,
+    parse_size,
+    plan,
+)
+
+NOW = 100 * DAY
+
+
+def index(name, days_old, size=GB, segments=1, shards=1):
+    created = NOW - days_old * DAY
+    return {
+        "index": name,
+        "shards": shards,
+        "size": size,
+        "created": created,
+        "segments": segments,
+    }
+
+
+def daily(days, **kwargs):
+    """jaeger-span indices of the last `days` days, oldest first"""
+    return [index(f"jaeger-span-2024-01-{31 - age:02d}", age, **kwargs) for age in days]
+
+
+def test_parse_size():
+    assert parse_size("500gb") == 500 * GB
+    assert parse_size("1.5TB") == int(1.5 * 1024 * GB)
+    assert parse_size("1024") == 1024
+    assert parse_size(None) is None
+    with pytest.raises(ValueError):
+        parse_size("lots")
+
+
+def test_newest_and_written_indices_are_left_alone():
+    indices = daily([5, 4, 0], segments=10)
+    indices.append(index("jaeger-service-000002", 3, segments=10))
+    aliases = {"jaeger-service-write": "jaeger-service-000002"}
+    steps = plan(indices, aliases, set(), now=NOW, rollover_age="1d", delete_after=2)
+    assert steps == [
+        (ROLLOVER, "jaeger-service-write"),
+        (FORCEMERGE, "jaeger-span-2024-01-26"),
+        (FORCEMERGE, "jaeger-span-2024-01-27"),
+        (SNAPSHOT, ["jaeger-span-2024-01-26", "jaeger-span-2024-01-27"]),
+        (DELETE, ["jaeger-span-2024-01-26", "jaeger-span-2024-01-27"]),
+    ]
+
+
+def test_snapshots_are_batched_and_merged_indices_skipped():
+    indices = daily(range(10, 0, -1))
+    steps = plan(indices, snapshotted={indices[0]["index"]}, now=NOW, batch=4)
+    snapshots = [target for action, target in steps if action == SNAPSHOT]
+    # the newest index is still written to
+    assert [len(batch) for batch in snapshots] == [4, 4]
+    assert indices[0]["index"] not in sum(snapshots, [])
+    assert not [step for step in steps if step[0] == FORCEMERGE]
+
+
+def test_deletes_the_oldest_until_it_fits():
+    indices = daily([6, 5, 4, 3, 2, 1])
+    steps = plan(indices, now=NOW, max_size=3 * GB)
+    assert steps == [(DELETE, [index["index"] for index in indices[:3]])]
+
+
+def test_keeps_what_is_not_snapshotted():
+    indices = daily([6, 5, 1])
+    snapshotted = {indices[0]["index"]}
+    # too young for a snapshot, too old to keep
+    steps = plan(
+        indices, snapshotted=snapshotted, now=NOW, snapshot_after=10, delete_after=2
+    )
+    assert steps == [(DELETE, [indices[0]["index"]])]
+
+
+def test_lifecycle_against_a_cluster():
+    elasticsearch = FakeElasticsearch(
+        merge_time=0.01, snapshot_overhead=0.05, snapshot_time=0.01, reject_every=15
+    )
+    seed(elasticsearch, days=6, size=GB)
+    before = set(elasticsearch.indices)
+
+    async def run():
+        url = await elasticsearch.start()
+        try:
+            return await lifecycle(
+                url,
+                "s3",
+                max_snapshots=elasticsearch.max_snapshots,
+                poll=0.02,
+                rollover_age="1d",
+                delete_after=3,
+                batch=4,
+            )
+        finally:
+            await elasticsearch.stop()
+
+    steps, requests = asyncio.run(run())
+    deleted = before - set(elasticsearch.indices)
+    snapshotted = {
+        name
+        for snapshot in elasticsearch.snapshots
+        if elasticsearch.snapshot_status(snapshot)["state"] == "SUCCESS"
+        for name in elasticsearch.snapshots[snapshot]["indices"]
+    }
+    assert deleted and deleted <= snapshotted
+    merged = [target for action, target in steps if action == FORCEMERGE]
+    assert merged
+    for name in set(merged) - deleted:
+        assert elasticsearch.indices[name]["segments"] == 1
+    # the rejected requests were retried
+    assert requests == elasticsearch.requests > 15
@@ -0,0 +1,116 @@
+import asyncio
+
+from aiohttp import web
+
+from tasks import github
+from tasks.github import GitHubClient, ResponseCache, github_session
+
+ETAG = '"v1.1.0"'
+RELEASE = {"tag_name": "v1.1.0"}
+
+
+def on_server(scenario):
+    """Run `scenario(base_url)` with a GitHub API answering 304 to its own ETag
+
+    Return what `scenario` returns and the (status, client port) of every request.
+    """
+    seen = []
+
+    async def latest_release(request):
+        status = 304 if request.headers.get("If-None-Match") == ETAG else 200
+        seen.append((status, request.transport.get_extra_info("peername")[1]))
+        if status == 304:
+            return web.Response(status=304, headers={"ETag": ETAG})
+        return web.json_response(RELEASE, headers={"ETag": ETAG})
+
+    async def branch(request):
+        seen.append((200, request.transport.get_extra_info("peername")[1]))
+        return web.json_response({"name": request.match_info["branch"]})
+
+    async def run():
+        app = web.Application()
+        app.router.add_get("/repos/photopills/api/releases/latest", latest_release)
+        app.router.add_get("/repos/photopills/api/branches/{branch}", branch)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = runner.addresses[0][1]
+        try:
+            return await scenario(f"http://127.0.0.1:{port}")
+        finally:
+            await runner.cleanup()
+
+    return asyncio.run(run()), seen
+
+
+def test_response_cache(tmp_path):
+    cache = ResponseCache(tmp_path / "cache" / "github")
+    cache["/a"] = [ETAG, None, RELEASE, None]
+    cache["/b"] = [None, "Tue, 01 Feb 2022", [], "/b?page=2"]
+    assert cache["/a"] == [ETAG, None, RELEASE, None]
+    assert sorted(cache) == ["/a", "/b"]
+    del cache["/b"]
+    assert len(cache) == 1
+    cache.close()
+
+    # the responses outlive the connection
+    assert ResponseCache(tmp_path / "cache" / "github")["/a"][2] == RELEASE
+
+
+def test_not_modified_responses_are_served_from_the_cache(tmp_path):
+    url = "/repos/photopills/api/releases/latest"
+
+    async def scenario(base_url):
+        releases = []
+        # as two separate jobs would
+        for _ in range(2):
+            async with GitHubClient(base_url=base_url, cache_path=tmp_path / "gh") as gh:
+                releases.append(await gh.getitem(url))
+        return releases
+
+    releases, seen = on_server(scenario)
+    assert releases == [RELEASE, RELEASE]
+    assert [status for status, _ in seen] == [200, 304]
+
+
+def test_a_broken_cache_is_a_miss(tmp_path):
+    broken = tmp_path / "github"
+    broken.write_text("not a database")
+
+    async def scenario(base_url):
+        async with GitHubClient(base_url=base_url, cache_path=broken) as gh:
+            return gh._cache, await gh.getitem("/repos/photopills/api/releases/latest")
+
+    (cache, release), _ = on_server(scenario)
+    assert cache is None
+    assert release == RELEASE
+
+
+def test_one_session_per_github_session(monkeypatch):
+    opened = []
+    aenter = GitHubClient.__aenter__
+
+    async def counting_aenter(self):
+        opened.append(self)
+        return await aenter(self)
+
+    monkeypatch.setattr(GitHubClient, "__aenter__", counting_aenter)
+
+    async def scenario(base_url):
+        monkeypatch.setenv("GITHUB_API_URL", base_url)
+        async with github_session() as gh:
+            session = gh._session
+            await github.wait_for_branch("api", "first", gh=gh)
+            async with github_session(gh) as inner:
+                assert (inner, inner._session) == (gh, session)
+                await github.wait_for_branch("api", "second", gh=inner)
+            await gh.getitem("/repos/photopills/api/releases/latest")
+        return session.closed
+
+    closed, seen = on_server(scenario)
+    assert len(opened) == 1
+    assert closed
+    # every request went through the same keep-alive connection
+    assert len(seen) == 3
+    assert len({port for _, port in seen}) == 1
@@ -0,0 +1,155 @@
+import asyncio
+
+import pytest
+
+from benchmarks.fake_github import FakeGitHub
+from tasks import graphql
+from tasks.github import GitHubClient
+from tasks.graphql import Batcher, create_pull_requests, latest_releases
+
+
+class MissingRepos(FakeGitHub):
+    """Fake GitHub without the repositories named "gone*" """
+
+    def resolve(self, field, arguments):
+        if field == "repository" and arguments["name"].startswith("gone"):
+            raise LookupError(f"Could not resolve to a Repository {arguments['name']}")
+        return super().resolve(field, arguments)
+
+
+def on_fake_github(scenario, github=None):
+    """Run `scenario(github, gh)` with a GraphQL client of a fake GitHub"""
+    github = github or MissingRepos()
+
+    async def run():
+        base_url = await github.start()
+        try:
+            async with GitHubClient(base_url=base_url, cache_path=None) as gh:
+                return await scenario(github, gh)
+        finally:
+            await github.stop()
+
+    return asyncio.run(run())
+
+
+def test_latest_releases_in_chunks(monkeypatch):
+    monkeypatch.setattr(graphql, "REPOS_PER_QUERY", 2)
+    lookups = [("api", True), ("api", False), ("web", True)]
+    lookups += [("gone", True), ("new", True)]
+
+    async def scenario(github, gh):
+        github.add_release("api", "v1.0.0")
+        github.add_release("api", "v1.1.0-rc1", prerelease=True)
+        github.add_release("web", "v2.0.0")
+        return await latest_releases(gh, lookups), github.requests
+
+    results, requests = on_fake_github(scenario)
+    assert results[:3] == ["v1.1.0-rc1", "v1.0.0", "v2.0.0"]
+    assert isinstance(results[3], LookupError)
+    assert "Could not resolve to a Repository gone" in str(results[3])
+    assert isinstance(results[4], LookupError)
+    assert "There isn't any release of new" in str(results[4])
+    assert requests == 3
+
+
+def test_latest_stable_release_behind_prereleases_and_drafts():
+    async def scenario(github, gh):
+        github.add_release("api", "v1.0.0")
+        for number in range(graphql.RELEASES_PER_REPO):
+            github.add_release("api", f"v1.1.0-rc{number}", prerelease=True)
+        github.add_release("web", "v2.0.0")
+        for number in range(graphql.RELEASES_PER_REPO):
+            github.add_release("web", f"v2.1.0-draft{number}", draft=True)
+        lookups = [("api", False), ("api", True), ("web", True)]
+        return await latest_releases(gh, lookups)
+
+    assert on_fake_github(scenario) == ["v1.0.0", "v1.1.0-rc9", "v2.0.0"]
+
+
+def test_create_pull_requests(monkeypatch):
+    monkeypatch.setattr(graphql, "MUTATIONS_PER_REQUEST", 2)
+    pulls = [
+        {
+            "repo": repo,
+            "head": "bumps_to_v1.1.0",
+            "base": "master",
+            "title": f"Bumps astrolib.py in {repo}",
+            "body": "notes",
+            "labels": ["dependencies", "unknown"],
+            "reviewers": reviewers,
+        }
+        for repo, reviewers in [("api", ["ana"]), ("web", ["ana", "bo"]), ("gone", [])]
+    ]
+
+    async def scenario(github, gh):
+        results = await create_pull_requests(gh, pulls)
+        return results, github.pulls, github.requests
+
+    results, created, requests = on_fake_github(scenario)
+    assert results[0]["number"] == 1
+    assert results[0]["node_id"] == "PR_api_1"
+    assert results[1]["html_url"].endswith("/pull/1")
+    assert isinstance(results[2], LookupError)
+    assert created["api"][0]["labels"] == ["dependencies"]
+    assert created["api"][0]["reviewers"] == ["ana"]
+    assert created["web"][0]["reviewers"] == ["ana", "bo"]
+    # node ids, the pull requests, their labels and their reviews
+    assert requests == 4
+
+
+def batcher(**kwargs):
+    sent = []
+
+    async def send(items):
+        sent.append(list(items))
+        await asyncio.sleep(0.01)
+        return [ValueError(item) if item == "bad" else item.upper() for item in items]
+
+    return Batcher(send, **kwargs), sent
+
+
+def test_batcher_sends_full_batches_at_once():
+    async def run():
+        batch, sent = batcher(size=3, wait=10)
+        results = await asyncio.wait_for(
+            asyncio.gather(*(batch.submit(item) for item in "abc")), 1
+        )
+        return results, sent, batch.tasks
+
+    results, sent, tasks = asyncio.run(run())
+    assert results == ["A", "B", "C"]
+    assert sent == [["a", "b", "c"]]
+    assert not tasks
+
+
+def test_batcher_sends_after_the_wait():
+    async def run():
+        batch, sent = batcher(size=50, wait=0.05)
+        first = asyncio.ensure_future(batch.submit("a"))
+        await asyncio.sleep(0.01)
+        results = await asyncio.gather(
+            first, batch.submit("b"), batch.submit("bad"), return_exceptions=True
+        )
+        return results, sent
+
+    (a, b, bad), sent = asyncio.run(run())
+    assert (a, b) == ("A", "B")
+    assert isinstance(bad, ValueError)
+    assert sent == [["a", "b", "bad"]]
+
+
+@pytest.mark.parametrize("results", [RuntimeError("down"), ["one result"]])
+def test_batcher_fails_every_submitter(results):
+    async def send(items):
+        if isinstance(results, Exception):
+            raise results
+        return results
+
+    async def run():
+        batch = Batcher(send, size=2)
+        submitted = asyncio.gather(
+            batch.submit("a"), batch.submit("b"), return_exceptions=True
+        )
+        return await asyncio.wait_for(submitted, 1)
+
+    assert all(isinstance(result, RuntimeError) for result in asyncio.run(run()))
@@ -0,0 +1,141 @@
+import asyncio
+
+import pytest
+
+from tasks.images import (
+    BUILD,
+    IMAGES,
+    TAG,
+    Image,
+    StubBuilder,
+    build,
+    dependencies,
+    input_keys,
+    parse,
+    plan,
+)
+
+BASE = """\
+FROM alpine:3.15
+# the tasks and their requirements
+COPY tasks/requirements.txt /tmp/
+COPY --chown=root:root tasks /tasks
+ADD https://example.com/tool.tar.gz /opt/
+RUN apk add git \\
+    # comments between continuation lines
+    make
+"""
+CHILD = """\
+FROM photopills/runner:base
+COPY --from=builder /bin/tool /bin/tool
+RUN echo child
+"""
+WHEELS = """\
+FROM debian:bullseye
+COPY ["wheelhouse", "/wheelhouse"]
+"""
+
+
+@pytest.fixture
+def root(tmp_path):
+    (tmp_path / "Dockerfile.base").write_text(BASE)
+    (tmp_path / "Dockerfile.child").write_text(CHILD)
+    (tmp_path / "Dockerfile.wheels").write_text(WHEELS)
+    (tmp_path / "tasks" / "__pycache__").mkdir(parents=True)
+    (tmp_path / "tasks" / "__init__.py").write_text("print('tasks')\n")
+    (tmp_path / "tasks" / "__pycache__" / "__init__.pyc").write_bytes(b"\0")
+    (tmp_path / "tasks" / "requirements.txt").write_text("invoke\n")
+    (tmp_path / "wheelhouse").mkdir()
+    (tmp_path / "wheelhouse" / "invoke-1.7.0-py3-none-any.whl").write_bytes(b"wheel")
+    return tmp_path
+
+
+IMAGES_OF_ROOT = [
+    Image("child", "Dockerfile.child"),
+    Image("base", "Dockerfile.base"),
+    Image("wheels", "Dockerfile.wheels"),
+]
+
+
+def test_parse(root):
+    bases, sources = parse(root / "Dockerfile.base")
+    assert bases == ["alpine:3.15"]
+    assert sources == ["tasks/requirements.txt", "tasks"]
+    assert parse(root / "Dockerfile.child") == (["photopills/runner:base"], [])
+    assert parse(root / "Dockerfile.wheels")[1] == ["wheelhouse"]
+
+
+def test_dependencies_of_the_runner_images():
+    assert dependencies(IMAGES) == {
+        "alpine": [],
+        "debug": ["alpine"],
+        "python": [],
+        "argocd": ["python"],
+    }
+
+
+def test_keys_follow_the_inputs(root):
+    keys = input_keys(IMAGES_OF_ROOT, root)
+
+    # bytecode isn't an input
+    (root / "tasks" / "__pycache__" / "__init__.pyc").write_bytes(b"\1")
+    assert input_keys(IMAGES_OF_ROOT, root) == keys
+
+    # a base image change reaches the images built FROM it
+    (root / "tasks" / "__init__.py").write_text("print('changed')\n")
+    changed = input_keys(IMAGES_OF_ROOT, root)
+    assert changed["base"] != keys["base"]
+    assert changed["child"] != keys["child"]
+    assert changed["wheels"] == keys["wheels"]
+
+
+def test_wheels_are_keyed_by_name(root):
+    keys = input_keys(IMAGES_OF_ROOT, root)
+    wheel = root / "wheelhouse" / "invoke-1.7.0-py3-none-any.whl"
+    wheel.write_bytes(b"rebuilt, another timestamp")
+    assert input_keys(IMAGES_OF_ROOT, root) == keys
+
+    wheel.rename(root / "wheelhouse" / "invoke-1.7.1-py3-none-any.whl")
+    assert input_keys(IMAGES_OF_ROOT, root)["wheels"] != keys["wheels"]
+
+
+def test_plan_builds_then_tags(root):
+    builder = StubBuilder(root / "registry.json")
+    steps = plan(IMAGES_OF_ROOT, builder, root=root)
+    assert [step["image"].name for step in steps] == ["base", "wheels", "child"]
+    assert {step["action"] for step in steps} == {BUILD}
+    assert steps[-1]["depends"] == ["base"]
+
+    asyncio.run(build(steps, builder))
+    builder.save()
+    assert [name for _, name, _ in builder.calls].index("child") == 2
+
+    # the next run finds every content tag in the "registry"
+    builder = StubBuilder(root / "registry.json")
+    assert {step["action"] for step in plan(IMAGES_OF_ROOT, builder, root=root)} == {TAG}
+    forced = plan(IMAGES_OF_ROOT, builder, force=True, root=root)
+    assert {step["action"] for step in forced} == {BUILD}
+
+    (root / "tasks" / "__init__.py").write_text("print('changed')\n")
+    actions = {
+        step["image"].name: step["action"]
+        for step in plan(IMAGES_OF_ROOT, builder, root=root)
+    }
+    assert actions == {"base": BUILD, "wheels": TAG, "child": BUILD}
+
+
+def test_plan_selects_the_bases_of_the_images_asked_for(root):
+    steps = plan(IMAGES_OF_ROOT, StubBuilder(), names=["child"], root=root)
+    assert [step["image"].name for step in steps] == ["base", "child"]
+    with pytest.raises(ValueError, match="Unknown image"):
+        plan(IMAGES_OF_ROOT, StubBuilder(), names=["nope"], root=root)
+
+
+def test_build_waits_for_the_base_images(root):
+    builder = StubBuilder(delay=0.1)
+    steps = plan(IMAGES_OF_ROOT, builder, root=root)
+    asyncio.run(build(steps, builder, jobs=3))
+    started = {name: at for _, name, at in builder.calls}
+    assert started["child"] - started["base"] >= 0.1
+    # independent images are built at the same time
+    assert abs(started["wheels"] - started["base"]) < 0.05
@@ -0,0 +1,158 @@
+import asyncio
+import base64
+
+from tasks.lockfile import content_hash, package_span, patch_lock
+
+PYPROJECT = """\
+[tool.poetry]
+name = "api"
+version = "1.0.0"
+
+[tool.poetry.dependencies]
+python = "^3.10"
+astrolib = {{ git = "https://github.com/photopills/astrolib.py", rev = "{rev}" }}
+
+[tool.poetry.dev-dependencies]
+pytest = "^7.0"
+"""
+
+LOCK = """\
+[[package]]
+name = "astrolib"
+version = "1.0.0"
+description = ""
+category = "main"
+optional = false
+python-versions = "^3.10"
+develop = false
+
+[package.dependencies]
+numpy = "^1.22"
+
+[package.source]
+type = "git"
+url = "https://github.com/photopills/astrolib.py"
+reference = "v1.0.0"
+resolved_reference = "{old_sha}"
+
+[[package]]
+name = "numpy"
+version = "1.22.0"
+description = "NumPy"
+category = "main"
+optional = false
+python-versions = ">=3.8"
+
+[metadata]
+lock-version = "1.1"
+python-versions = "^3.10"
+content-hash = "{content_hash}"
+
+[metadata.files]
+numpy = []
+"""
+OLD_SHA, NEW_SHA = "a" * 40, "b" * 40
+
+
+def library_pyproject(version, dependencies):
+    lines = ["[tool.poetry]", f'version = "{version}"', "[tool.poetry.dependencies]"]
+    lines += [f'{name} = "{spec}"' for name, spec in dependencies.items()]
+    return "\n".join(lines) + "\n"
+
+
+class FakeGitHub:
+    """`getitem` of the contents and commits APIs of astrolib.py"""
+
+    def __init__(self, pyprojects, commits):
+        self.pyprojects = pyprojects
+        self.commits = commits
+
+    async def getitem(self, url):
+        repo = "/repos/photopills/astrolib.py"
+        if url.startswith(f"{repo}/contents/pyproject.toml?ref="):
+            text = self.pyprojects[url.rsplit("=", 1)[-1]]
+            return {"content": base64.b64encode(text.encode()).decode()}
+        return {"sha": self.commits[url[len(f"{repo}/commits/") :]]}
+
+
+def consumer(tmp_path, rev="v1.1.0"):
+    (tmp_path / "pyproject.toml").write_text(PYPROJECT.format(rev=rev))
+    old_hash = content_hash(PYPROJECT.format(rev="v1.0.0"))
+    lock = LOCK.format(old_sha=OLD_SHA, content_hash=old_hash)
+    (tmp_path / "poetry.lock").write_text(lock)
+    return lock
+
+
+GROUPS = """\
+[tool.poetry.group.test.dependencies]
+pytest = "^7.0"
+
+[tool.poetry.group.lint]
+optional = true
+
+[tool.poetry.group.lint.dependencies]
+flake8 = "^4.0"
+"""
+
+
+def test_content_hash_is_the_one_of_poetry():
+    # computed by Poetry 1.8.5, Locker(...)._get_content_hash()
+    pyproject = PYPROJECT.format(rev="v2")
+    expected = "bb5cff755a816eac26f5bf55a4b81e80aff97eba0faf427dec669838f98db1c9"
+    assert content_hash(pyproject) == expected
+
+    dev = '[tool.poetry.dev-dependencies]\npytest = "^7.0"\n'
+    with_groups = pyproject.replace(dev, GROUPS)
+    expected = "929d9109a1f135b677e518c89ed19ec3ba7525499a6881da3006476733a1e919"
+    assert content_hash(with_groups) == expected
+
+
+def test_package_span():
+    lock = LOCK.format(old_sha=OLD_SHA, content_hash="")
+    start, end = package_span(lock, "numpy")
+    assert lock[start:end].startswith('[[package]]\nname = "numpy"')
+    assert lock[end:].startswith("[metadata]")
+    assert package_span(lock, "scipy") is None
+
+
+def test_patch_lock(tmp_path):
+    lock = consumer(tmp_path)
+    gh = FakeGitHub(
+        {
+            "v1.0.0": library_pyproject("1.0.0", {"numpy": "^1.22"}),
+            "v1.1.0": library_pyproject("1.1.0", {"numpy": "^1.22"}),
+        },
+        {"v1.1.0": NEW_SHA},
+    )
+    assert asyncio.run(patch_lock(tmp_path, "astrolib", "v1.0.0", "v1.1.0", gh=gh))
+
+    patched = (tmp_path / "poetry.lock").read_text()
+    new_hash = content_hash(PYPROJECT.format(rev="v1.1.0"))
+    expected = (
+        lock.replace('version = "1.0.0"', 'version = "1.1.0"', 1)
+        .replace('reference = "v1.0.0"', 'reference = "v1.1.0"')
+        .replace(OLD_SHA, NEW_SHA)
+        .replace(content_hash(PYPROJECT.format(rev="v1.0.0")), new_hash)
+    )
+    assert patched == expected
+
+
+def test_changed_dependencies_need_the_resolver(tmp_path):
+    lock = consumer(tmp_path)
+    gh = FakeGitHub(
+        {
+            "v1.0.0": library_pyproject("1.0.0", {"numpy": "^1.22"}),
+            "v1.1.0": library_pyproject("1.1.0", {"numpy": "^1.22", "scipy": "^1.8"}),
+        },
+        {"v1.1.0": NEW_SHA},
+    )
+    assert not asyncio.run(patch_lock(tmp_path, "astrolib", "v1.0.0", "v1.1.0", gh=gh))
+    assert (tmp_path / "poetry.lock").read_text() == lock
+
+
+def test_packages_not_pinned_to_git_need_the_resolver(tmp_path):
+    lock = consumer(tmp_path)
+    gh = FakeGitHub({}, {})
+    assert not asyncio.run(patch_lock(tmp_path, "numpy", "1.22.0", "1.23.0", gh=gh))
+    assert not asyncio.run(patch_lock(tmp_path, "scipy", "1.8.0", "1.9.0", gh=gh))
+    assert (tmp_path / "poetry.lock").read_text() == lock
@@ -0,0 +1,88 @@
+import json
+
+import pytest
+import tomlkit
+
+from tasks.manifest import get_value, rewrite, rewrite_many, set_value
+
+PYPROJECT = """\
+[tool.poetry]
+name = "api"  # the consumer
+version = "1.0.0"
+
+[tool.poetry.dependencies]
+python = "^3.10"
+astrolib = { git = "https://github.com/photopills/astrolib.py", rev = "v1.0.0" }
+"""
+
+PACKAGE = """\
+{
+    "name": "web",
+    "scripts": {"version": "echo"},
+    "version": "2.0.0",
+    "dependencies": {"astrolib3": "^1.0.0"}
+}
+"""
+
+
+def test_splices_only_the_value():
+    text, old = set_value(PYPROJECT, "tool.poetry.dependencies.astrolib.rev", "v1.1.0")
+    assert old == "v1.0.0"
+    assert text == PYPROJECT.replace('rev = "v1.0.0"', 'rev = "v1.1.0"')
+
+    text, old = set_value(PYPROJECT, "tool.poetry.version", lambda v: v + ".post1")
+    assert old == "1.0.0"
+    assert text == PYPROJECT.replace('"1.0.0"', '"1.0.0.post1"')
+
+
+def test_json_keeps_the_formatting():
+    text, old = set_value(PACKAGE, "version", "2.1.0", kind="json")
+    assert old == "2.0.0"
+    # the nested "version" of scripts is left alone
+    assert text == PACKAGE.replace('"2.0.0"', '"2.1.0"')
+    assert get_value(text, "version", kind="json") == "2.1.0"
+
+
+def test_falls_back_on_layouts_it_cannot_locate():
+    dotted = '[tool]\npoetry.version = "1.0.0"\n'
+    text, old = set_value(dotted, "tool.poetry.version", "1.1.0")
+    assert old == "1.0.0"
+    assert get_value(text, "tool.poetry.version") == "1.1.0"
+
+
+def test_skips_lines_of_multiline_strings():
+    text = '[tool.poetry]\ndescription = """\nversion = "9.9.9"\n"""\nversion = "1.0.0"\n'
+    assert get_value(text, "tool.poetry.version") == "1.0.0"
+    new_text, old = set_value(text, "tool.poetry.version", "1.1.0")
+    assert old == "1.0.0"
+    assert new_text == text.replace('"1.0.0"', '"1.1.0"')
+
+
+def test_falls_back_when_the_span_is_not_the_value(monkeypatch):
+    text = '[tool.poetry]\ndescription = """\nversion = "9.9.9"\n"""\nversion = "1.0.0"\n'
+    # as a layout the span lookup gets wrong would
+    monkeypatch.setattr("tasks.manifest.in_multiline_string", lambda text: False)
+    new_text, old = set_value(text, "tool.poetry.version", "1.1.0")
+    assert old == "1.0.0"
+    poetry = tomlkit.parse(new_text)["tool"]["poetry"]
+    assert poetry["version"] == "1.1.0"
+    assert poetry["description"] == 'version = "9.9.9"\n'
+
+
+def test_falls_back_on_values_that_need_escaping():
+    text, old = set_value(PYPROJECT, "tool.poetry.version", 'say "hi"')
+    assert old == "1.0.0"
+    assert tomlkit.parse(text)["tool"]["poetry"]["version"] == 'say "hi"'
+
+
+def test_rewrite_many_is_all_or_nothing(tmp_path):
+    pyproject, package = tmp_path / "pyproject.toml", tmp_path / "package.json"
+    pyproject.write_text(PYPROJECT)
+    package.write_text(PACKAGE)
+
+    with pytest.raises(KeyError):
+        rewrite_many([(pyproject, "tool.poetry.version", "1.1.0"), (package, "x", "y")])
+    assert pyproject.read_text() == PYPROJECT
+
+    assert rewrite(package, "version", "2.1.0") == "2.0.0"
+    assert json.loads(package.read_text())["version"] == "2.1.0"
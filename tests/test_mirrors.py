@@ -0,0 +1,65 @@
+import os
+import shutil
+import time
+
+from tasks.mirrors import MirrorCache, git
+
+
+def make_origin(path):
+    git("init", "--quiet", "--bare", "--initial-branch", "master", str(path))
+    work = path.with_suffix(".work")
+    git("clone", "--quiet", str(path), str(work))
+    (work / "README.md").write_text("mirror me\n")
+    git("add", "README.md", cwd=work)
+    identity = ("-c", "user.name=test", "-c", "user.email=test@example.com")
+    git(*identity, "commit", "--quiet", "-m", "first", cwd=work)
+    git("push", "--quiet", "origin", "master", cwd=work)
+    return f"file://{path}"
+
+
+def age(cache, name, seconds):
+    marker = cache.path(name) / "last-used"
+    past = time.time() - seconds
+    os.utime(marker, (past, past))
+
+
+def test_workspaces_are_registered(tmp_path):
+    url = make_origin(tmp_path / "api.git")
+    cache = MirrorCache(tmp_path / "cache")
+    workspace = cache.workspace("api", url, tmp_path / "workspace")
+    assert (workspace / "README.md").read_text() == "mirror me\n"
+    assert cache.workspaces("api") == [str(workspace.resolve())]
+    assert git("remote", "get-url", "origin", cwd=workspace).strip() == url
+
+
+def test_evict_keeps_mirrors_of_live_workspaces(tmp_path):
+    url = make_origin(tmp_path / "api.git")
+    cache = MirrorCache(tmp_path / "cache")
+    workspace = cache.workspace("api", url, tmp_path / "workspace")
+    age(cache, "api", 7200)
+
+    assert cache.evict(max_size=0, grace=3600) == []
+    git("log", "--oneline", cwd=workspace)
+
+    shutil.rmtree(workspace)
+    assert cache.workspaces("api") == []
+    assert cache.evict(max_size=0, grace=3600) == ["api"]
+    assert not cache.path("api").exists()
+
+
+def test_evict_respects_the_grace_period(tmp_path):
+    url = make_origin(tmp_path / "api.git")
+    cache = MirrorCache(tmp_path / "cache")
+    cache.update("api", url)
+    assert cache.evict(max_size=0, grace=3600) == []
+    age(cache, "api", 7200)
+    assert cache.evict(max_size=0, grace=3600) == ["api"]
+
+
+def test_update_stores_the_url_it_is_given(tmp_path):
+    url = make_origin(tmp_path / "api.git")
+    cache = MirrorCache(tmp_path / "cache")
+    mirror = cache.update("api", url)
+    git("remote", "set-url", "origin", f"file://token@{tmp_path}/api.git", cwd=mirror)
+    cache.update("api", url, max_age=3600)
+    assert git("remote", "get-url", "origin", cwd=mirror).strip() == url
@@ -0,0 +1,117 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from tasks.pipeline import Pipeline
+
+
+def test_results_flow_along_the_graph():
+    pipeline = Pipeline()
+    order = []
+
+    @pipeline.stage(blocking=True)
+    def fetch():
+        order.append("fetch")
+        return threading.current_thread() is threading.main_thread()
+
+    @pipeline.stage()
+    async def release():
+        order.append("release")
+        return "v1.1.0"
+
+    @pipeline.stage(after=["fetch"])
+    async def branch(release):
+        order.append("branch")
+        return f"bumps_to_{release}"
+
+    results = asyncio.run(pipeline.run())
+    assert results == {"fetch": False, "release": "v1.1.0", "branch": "bumps_to_v1.1.0"}
+    assert order.index("branch") > max(order.index("fetch"), order.index("release"))
+
+
+def test_independent_stages_overlap():
+    pipeline = Pipeline()
+
+    @pipeline.stage(blocking=True)
+    def fetch():
+        time.sleep(0.2)
+
+    @pipeline.stage()
+    async def release():
+        await asyncio.sleep(0.2)
+
+    @pipeline.stage()
+    async def both(fetch, release):
+        return "done"
+
+    start = time.monotonic()
+    assert asyncio.run(pipeline.run())["both"] == "done"
+    assert time.monotonic() - start < 0.35
+
+
+def test_inputs_replace_their_stages():
+    pipeline = Pipeline()
+    called = []
+
+    @pipeline.stage()
+    async def release():
+        called.append("release")
+        return "v9"
+
+    @pipeline.stage()
+    async def branch(release):
+        return release
+
+    results = asyncio.run(pipeline.run(release="v1"))
+    assert results["branch"] == "v1"
+    assert called == []
+
+
+def test_unknown_dependencies_and_cycles_are_rejected():
+    pipeline = Pipeline()
+
+    @pipeline.stage()
+    async def branch(release):
+        pass
+
+    with pytest.raises(ValueError, match="unknown"):
+        asyncio.run(pipeline.run())
+
+    @pipeline.stage(after=["branch"])
+    async def release():
+        pass
+
+    with pytest.raises(ValueError, match="cycle"):
+        asyncio.run(pipeline.run())
+
+
+def test_a_failure_cancels_the_running_stages():
+    pipeline = Pipeline()
+    cancelled = []
+
+    @pipeline.stage()
+    async def slow():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append("slow")
+            raise
+
+    @pipeline.stage()
+    async def done():
+        return "ok"
+
+    @pipeline.stage(after=["done"])
+    async def broken():
+        raise RuntimeError("push rejected")
+
+    @pipeline.stage()
+    async def after_broken(broken):
+        pass
+
+    with pytest.raises(RuntimeError, match="push rejected"):
+        asyncio.run(pipeline.run())
+    assert cancelled == ["slow"]
+    assert pipeline.results == {"done": "ok"}
@@ -0,0 +1,101 @@
+import os
+
+import pytest
+from git import GitCommandError, Repo
+
+from benchmarks.e2e import git
+from tasks.plumbing import push_atomic, read_blob, write_commit
+
+FILES = {
+    "pyproject.toml": "[tool.poetry]\nversion = '1.0.0'\n",
+    "README.md": "# api\n",
+    "deploy/run.sh": "#!/bin/sh\n",
+    "deploy/k8s/app.yaml": "image: api:v1.0.0\n",
+}
+
+
+@pytest.fixture
+def repo(tmp_path):
+    """A clone of the bare repo tmp_path/remote.git with FILES committed on master"""
+    remote = tmp_path / "remote.git"
+    git("init", "--bare", "-b", "master", str(remote))
+    work = tmp_path / "work"
+    git("clone", str(remote), str(work))
+    for path, content in FILES.items():
+        (work / path).parent.mkdir(parents=True, exist_ok=True)
+        (work / path).write_text(content)
+    os.chmod(work / "deploy" / "run.sh", 0o755)
+    git("checkout", "-b", "master", cwd=work)
+    git("add", ".", cwd=work)
+    git("commit", "-m", "Initial commit", cwd=work)
+    git("push", "origin", "master", cwd=work)
+    return Repo(work)
+
+
+def remote_refs(repo):
+    output = repo.git.ls_remote(repo.remotes.origin.url)
+    return {ref: sha for sha, ref in (line.split("\t") for line in output.splitlines())}
+
+
+def test_write_commit_only_changes_the_given_blobs(repo):
+    parent = repo.head.commit
+    changes = {
+        "pyproject.toml": b"[tool.poetry]\nversion = '1.1.0'\n",
+        "deploy/k8s/app.yaml": b"image: api:v1.1.0\n",
+        "docs/CHANGELOG.md": b"# v1.1.0\n",
+    }
+    commit = write_commit(repo, "master", changes, "Bumps to v1.1.0")
+
+    assert list(commit.parents) == [parent]
+    assert commit.message == "Bumps to v1.1.0"
+    changed = {diff.b_path: diff.change_type for diff in parent.diff(commit)}
+    assert changed == {
+        "pyproject.toml": "M",
+        "deploy/k8s/app.yaml": "M",
+        "docs/CHANGELOG.md": "A",
+    }
+    for path, content in changes.items():
+        assert read_blob(repo, commit.hexsha, path) == content
+    # untouched entries point to the same objects, with their modes
+    tree = repo.commit(commit.hexsha).tree
+    assert tree["README.md"] == parent.tree["README.md"]
+    assert (tree / "deploy/run.sh").mode == 0o100755
+    assert (tree / "deploy/run.sh") == (parent.tree / "deploy/run.sh")
+
+
+def test_write_commit_leaves_the_checkout_alone(repo):
+    head = repo.head.commit
+    index = repo.index.entries.copy()
+    write_commit(repo, "master", {"pyproject.toml": b"version = '1.1.0'\n"}, "Bump")
+
+    assert repo.head.commit == head
+    assert repo.head.ref.name == "master"
+    assert Repo(repo.working_dir).index.entries == index
+    assert not repo.is_dirty(untracked_files=True)
+    working = os.path.join(repo.working_dir, "pyproject.toml")
+    with open(working) as file:
+        assert file.read() == FILES["pyproject.toml"]
+
+
+def test_push_atomic_pushes_the_branch_and_the_tag(repo):
+    commit = write_commit(repo, "master", {"README.md": b"# api v1.1.0\n"}, "Bump")
+    push_atomic(repo, commit, "bumps_to_v1.1.0", tag="v1.1.0")
+
+    refs = remote_refs(repo)
+    assert refs["refs/heads/bumps_to_v1.1.0"] == commit.hexsha
+    assert refs["refs/tags/v1.1.0"] == commit.hexsha
+    assert refs["refs/heads/master"] == repo.head.commit.hexsha
+
+
+def test_a_rejected_ref_rejects_the_whole_push(repo):
+    # the tag already exists on the remote, pointing to another commit
+    git("tag", "v1.1.0", cwd=repo.working_dir)
+    git("push", "origin", "v1.1.0", cwd=repo.working_dir)
+    before = remote_refs(repo)
+
+    commit = write_commit(repo, "master", {"README.md": b"# api v1.1.0\n"}, "Bump")
+    with pytest.raises(GitCommandError):
+        push_atomic(repo, commit, "bumps_to_v1.1.0", tag="v1.1.0")
+
+    assert remote_refs(repo) == before
+    assert "refs/heads/bumps_to_v1.1.0" not in before
@@ -0,0 +1,157 @@
+import asyncio
+import time
+
+from tasks.ratelimit import (
+    PRIORITY_PULL_REQUEST,
+    PRIORITY_READ,
+    PRIORITY_WRITE,
+    Scheduler,
+    TokenBucket,
+    priority,
+)
+
+
+def limits(remaining, reset_in=3600, limit=5000):
+    return {
+        "x-ratelimit-remaining": str(remaining),
+        "x-ratelimit-limit": str(limit),
+        "x-ratelimit-reset": str(time.time() + reset_in),
+    }
+
+
+def test_priority():
+    assert priority("POST", "/repos/photopills/api/pulls") == PRIORITY_PULL_REQUEST
+    assert priority("PATCH", "/repos/photopills/api/pulls/1") == PRIORITY_WRITE
+    assert priority("GET", "/repos/photopills/api/pulls") == PRIORITY_READ
+
+
+def test_bucket_before_the_first_response():
+    bucket = TokenBucket()
+    assert bucket.available(PRIORITY_READ)
+    bucket.take()
+    assert not bucket.available(PRIORITY_READ)
+    bucket.release()
+    assert bucket.available(PRIORITY_READ)
+
+
+def test_bucket_counts_the_requests_in_flight_and_the_reserve():
+    bucket = TokenBucket(reserve=2)
+    bucket.take()
+    bucket.update(limits(4))
+    # 4 left when the response was sent, minus the one still in flight
+    assert bucket.tokens == 3
+    bucket.release()
+    assert bucket.available(PRIORITY_READ)
+    bucket.take()
+    assert not bucket.available(PRIORITY_READ)
+    assert bucket.available(PRIORITY_WRITE)
+
+
+def test_bucket_is_refilled_at_the_reset():
+    bucket = TokenBucket()
+    bucket.update(limits(0, reset_in=-1, limit=60))
+    assert bucket.available(PRIORITY_READ)
+    assert bucket.tokens == 60
+
+
+class FakeAPI:
+    """`send` of the requests a scheduler runs, with the rate limit headers of GitHub"""
+
+    def __init__(self, remaining, reset_in=0.2, latency=0.01, responses=()):
+        self.remaining = remaining
+        self.reset = time.time() + reset_in
+        self.latency = latency
+        self.responses = list(responses)
+        self.sent = []
+        self.in_flight = self.max_in_flight = 0
+
+    def send(self, name):
+        async def send():
+            self.sent.append(name)
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            await asyncio.sleep(self.latency)
+            self.in_flight -= 1
+            if time.time() >= self.reset:
+                self.remaining, self.reset = 100, time.time() + 3600
+            self.remaining = max(self.remaining - 1, 0)
+            headers = {
+                "x-ratelimit-remaining": str(self.remaining),
+                "x-ratelimit-limit": "100",
+                "x-ratelimit-reset": str(self.reset),
+            }
+            if self.responses:
+                status, body = self.responses.pop(0)
+                return status, headers, body
+            return 200, headers, b"{}"
+
+        return send
+
+
+async def requests(scheduler, api, calls):
+    return await asyncio.gather(
+        *(scheduler.request(method, url, api.send(name)) for name, method, url in calls)
+    )
+
+
+def test_waits_for_the_reset_and_serves_by_priority():
+    api = FakeAPI(remaining=1)
+    scheduler = Scheduler(reserve=0)
+
+    async def run():
+        # the first response empties the bucket until the reset
+        await scheduler.request("GET", "/repos/photopills/api", api.send("first"))
+        calls = [
+            ("read", "GET", "/repos/photopills/api/releases"),
+            ("write", "PATCH", "/repos/photopills/web/pulls/1"),
+            ("pull", "POST", "/repos/photopills/lib/pulls"),
+        ]
+        start = time.monotonic()
+        await requests(scheduler, api, calls)
+        return time.monotonic() - start
+
+    elapsed = asyncio.run(run())
+    assert api.sent == ["first", "pull", "write", "read"]
+    assert elapsed >= 0.15
+    assert scheduler.metrics()["throttled_requests"] == 3
+    assert scheduler.throttled_time["rate_limit"] > 0
+
+
+def test_caps_the_requests_in_flight_per_repo():
+    api = FakeAPI(remaining=100, reset_in=3600)
+    scheduler = Scheduler(per_repo=2)
+
+    async def run():
+        await scheduler.request("GET", "/repos/photopills/api", api.send("first"))
+        calls = [(n, "GET", f"/repos/photopills/api/pulls/{n}") for n in range(8)]
+        await requests(scheduler, api, calls)
+
+    asyncio.run(run())
+    assert len(api.sent) == 9
+    assert api.max_in_flight == 2
+
+
+def test_retries_secondary_rate_limits():
+    body = b'{"message": "You have exceeded a secondary rate limit"}'
+    api = FakeAPI(remaining=100, reset_in=3600, responses=[(403, body), (429, b"")])
+    scheduler = Scheduler(base_delay=0.01, max_delay=0.05)
+
+    async def run():
+        return await scheduler.request("GET", "/repos/photopills/api", api.send("call"))
+
+    status, _, _ = asyncio.run(run())
+    assert status == 200
+    assert api.sent == ["call"] * 3
+
+
+def test_gives_up_after_the_retries():
+    responses = [(429, b"")] * 3
+    api = FakeAPI(remaining=100, reset_in=3600, responses=responses)
+    scheduler = Scheduler(retries=2, base_delay=0.01)
+
+    async def run():
+        return await scheduler.request("GET", "/repos/photopills/api", api.send("call"))
+
+    status, _, _ = asyncio.run(run())
+    assert status == 429
+    assert len(api.sent) == 3
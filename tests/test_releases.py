@@ -0,0 +1,87 @@
+import asyncio
+import time
+
+from tasks.releases import ReleaseIndex, parse_prefix, parse_semver
+
+
+class Releases:
+    """`getiter` of the releases of a repo, newest first, counting the items read"""
+
+    def __init__(self):
+        self.releases = []
+        self.read = 0
+
+    def publish(self, tag, prerelease=False, draft=False):
+        release = {
+            "id": len(self.releases) + 1,
+            "tag_name": tag,
+            "published_at": f"2024-01-01T00:{len(self.releases):02d}:00Z",
+            "prerelease": prerelease,
+            "draft": draft,
+        }
+        self.releases.insert(0, release)
+        return release
+
+    def delete(self, tag):
+        self.releases = [r for r in self.releases if r["tag_name"] != tag]
+
+    async def getiter(self, url):
+        for release in list(self.releases):
+            self.read += 1
+            yield release
+
+
+def refresh(index, gh, **kwargs):
+    return asyncio.run(index.refresh(gh, **kwargs))
+
+
+def test_semver_keys():
+    assert parse_semver("v2.0.0-rc1") < parse_semver("v2.0.0") < parse_semver("2.0.1")
+    assert parse_semver("latest") is None
+    assert parse_prefix("2.x") == (2,)
+    assert parse_prefix("v2.1") == (2, 1)
+
+
+def test_lookups(tmp_path):
+    gh = Releases()
+    for tag in ("v1.0.0", "v2.0.0", "v1.1.0"):
+        gh.publish(tag)
+    gh.publish("v3.0.0-rc1", prerelease=True)
+    gh.publish("v4.0.0", draft=True)
+    index = refresh(ReleaseIndex("astrolib", path=tmp_path), gh)
+
+    assert index.latest().tag == "v3.0.0-rc1"
+    assert index.latest(prerelease=False).tag == "v1.1.0"
+    assert index.latest_matching("1.x").tag == "v1.1.0"
+    assert index.latest_matching("3", prerelease=False) is None
+    assert index.latest_matching("").tag == "v3.0.0-rc1"
+
+
+def test_refresh_stops_at_known_releases(tmp_path):
+    gh = Releases()
+    for number in range(5):
+        gh.publish(f"v1.0.{number}")
+    refresh(ReleaseIndex("astrolib", path=tmp_path), gh)
+    gh.publish("v1.0.5")
+    gh.read = 0
+
+    index = refresh(ReleaseIndex.load("astrolib", path=tmp_path), gh)
+    assert gh.read == 2
+    assert index.latest().tag == "v1.0.5"
+    assert len(index) == 6
+
+
+def test_reconcile_drops_deleted_releases(tmp_path):
+    gh = Releases()
+    for tag in ("v1.0.0", "v1.1.0"):
+        gh.publish(tag)
+    refresh(ReleaseIndex("astrolib", path=tmp_path), gh)
+    gh.delete("v1.1.0")
+
+    index = refresh(ReleaseIndex.load("astrolib", path=tmp_path), gh, max_age=3600)
+    assert index.latest().tag == "v1.1.0"
+
+    index = refresh(ReleaseIndex.load("astrolib", path=tmp_path), gh, max_age=0)
+    assert index.latest().tag == "v1.0.0"
+    assert index.latest_matching("1.1") is None
+    assert ReleaseIndex.load("astrolib", path=tmp_path).reconciled_at <= time.time()
@@ -0,0 +1,123 @@
+import asyncio
+import json
+
+from benchmarks.fake_argocd import State, application
+from benchmarks.rollout import backend
+from tasks.rollout import (
+    DEGRADED,
+    FAILED,
+    HEALTHY,
+    PENDING,
+    Rollout,
+    app_status,
+    watch_rollout,
+)
+
+SPEC = {"sync_time": 1, "ready_time": 2}
+
+
+def status(spec, sync, elapsed, name="api"):
+    sync = sync and dict(sync, at=0)
+    return app_status(application(name, spec, sync, elapsed))
+
+
+def started(revision="abc123"):
+    """Rollout of api whose sync was requested, with the status before it as baseline"""
+    rollout = Rollout(["api"], revision)
+    rollout.baseline["api"] = status(SPEC, None, 0)["started"]
+    rollout.requested.add("api")
+    return rollout
+
+
+def test_pending_until_the_sync_is_requested():
+    rollout = Rollout(["api"], "abc123")
+    rollout.baseline["api"] = status(SPEC, None, 0)["started"]
+    rollout.statuses["api"] = status(SPEC, None, 0)
+    assert rollout.state("api") == PENDING
+    assert not rollout.done()
+
+
+def test_previous_operation_is_not_judged():
+    rollout = started()
+    degraded = dict(SPEC, fail="degraded")
+    previous = status(degraded, {"revision": "old"}, 10)
+    rollout.baseline["api"] = previous["started"]
+    rollout.statuses["api"] = previous
+    assert rollout.state("api") == PENDING
+
+
+def test_healthy_once_synced_to_the_revision():
+    rollout = started()
+    sync = {"revision": "abc123"}
+    rollout.statuses["api"] = status(SPEC, sync, 0.5)
+    assert rollout.state("api") == PENDING
+    rollout.statuses["api"] = status(SPEC, sync, 1.5)
+    assert rollout.state("api") == PENDING
+    rollout.statuses["api"] = status(SPEC, sync, 3)
+    assert rollout.state("api") == HEALTHY
+    assert rollout.done()
+
+
+def test_another_revision_is_not_healthy():
+    rollout = started()
+    rollout.statuses["api"] = status(SPEC, {"revision": "fff000"}, 3)
+    assert rollout.state("api") == PENDING
+
+
+def test_degraded_and_failed_end_the_rollout():
+    rollout = started()
+    sync = {"revision": "abc123"}
+    rollout.statuses["api"] = status(dict(SPEC, fail="degraded"), sync, 3)
+    assert rollout.state("api") == DEGRADED
+    assert rollout.done()
+    rollout = started()
+    rollout.statuses["api"] = status(dict(SPEC, fail="sync"), sync, 3)
+    assert rollout.state("api") == FAILED
+    assert "failed to apply" in rollout.report()
+
+
+def test_adopted_operation_is_judged():
+    rollout = started()
+    running = status(SPEC, {"revision": "abc123"}, 3)
+    rollout.baseline["api"] = running["started"]
+    rollout.statuses["api"] = running
+    assert rollout.state("api") == PENDING
+    rollout.adopted.add("api")
+    assert rollout.state("api") == HEALTHY
+
+
+def scenario(root, apps, latency=0.05):
+    (root / "scenario.json").write_text(json.dumps({"latency": latency, "apps": apps}))
+
+
+def test_watch_rollout(tmp_path):
+    scenario(tmp_path, {"api": SPEC, "web": dict(SPEC, ready_time=1.5)})
+    client = backend(tmp_path)
+    rollout = asyncio.run(watch_rollout(client, ["api", "web"], "abc123", timeout=30))
+    assert rollout.states() == {"api": HEALTHY, "web": HEALTHY}
+
+
+def test_watch_rollout_stops_on_degraded(tmp_path):
+    scenario(tmp_path, {"api": dict(SPEC, fail="degraded"), "web": SPEC})
+    client = backend(tmp_path)
+    rollout = asyncio.run(watch_rollout(client, ["api", "web"], "abc123", timeout=30))
+    assert rollout.states()["api"] == DEGRADED
+
+
+def test_automated_sync_in_progress_is_followed(tmp_path):
+    scenario(tmp_path, {"api": SPEC})
+    # the automated sync of the release started just before ours
+    State(tmp_path).record_sync("api", "abc123")
+    client = backend(tmp_path)
+    rollout = asyncio.run(watch_rollout(client, ["api"], "abc123", timeout=30))
+    assert rollout.states() == {"api": HEALTHY}
+    assert rollout.adopted == {"api"}
+
+
+def test_automated_sync_of_another_revision_is_synced_again(tmp_path):
+    scenario(tmp_path, {"api": SPEC})
+    State(tmp_path).record_sync("api", "fff000")
+    client = backend(tmp_path)
+    rollout = asyncio.run(watch_rollout(client, ["api"], "abc123", timeout=30))
+    assert rollout.states() == {"api": HEALTHY}
+    assert State(tmp_path).sync("api")["revision"] == "abc123"
@@ -0,0 +1,48 @@
+import json
+import subprocess
+import sys
+
+from benchmarks.startup import TASKS_DIR, measure, task_imports
+
+ROOT = TASKS_DIR.parent
+# imported by the tasks that need them, never by `invoke --list`
+HEAVY = ["git", "aiohttp", "gidgethub", "tomlkit", "pendulum"]
+LOADED = f"""
+import json, sys
+{{imports}}
+print(json.dumps([name for name in {HEAVY!r} if name in sys.modules]))
+"""
+
+
+def loaded(*imports):
+    code = LOADED.format(imports="\n".join(imports))
+    output = subprocess.run(
+        [sys.executable, "-c", code], cwd=ROOT, check=True, capture_output=True
+    ).stdout
+    return json.loads(output)
+
+
+def test_importing_the_tasks_is_light():
+    assert loaded("import tasks") == []
+    # what `invoke --list` does
+    listed = [
+        "from invoke import Collection",
+        "import tasks",
+        "Collection.from_module(tasks)",
+    ]
+    assert loaded(*listed) == []
+
+
+def test_the_tasks_import_their_dependencies():
+    imports = task_imports(TASKS_DIR)
+    assert imports["update-dependencies"]
+    every = sorted(
+        {statement for statements in imports.values() for statement in statements}
+    )
+    assert set(loaded("import tasks", *every)) >= {"git", "gidgethub"}
+
+
+def test_invoke_list_within_budget():
+    (_, _), (warm, _) = measure(["-m", "invoke", "--list"], ROOT)
+    # generous, the budget of the image check is 500ms
+    assert warm < 3
@@ -0,0 +1,149 @@
+import asyncio
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+from tasks import tracing
+from tasks.tracing import span
+
+
+@pytest.fixture
+def trace_file(tmp_path, monkeypatch):
+    path = tmp_path / "spans.jsonl"
+    monkeypatch.setattr(tracing, "TRACE_FILE", str(path))
+    return path
+
+
+def record():
+    """A bump-like trace: nested spans, in concurrent tasks and a worker thread"""
+
+    async def stage(name):
+        with span(name, repo="api"):
+            await asyncio.to_thread(blocking)
+
+    def blocking():
+        with span("git.push") as current:
+            current.event("writing", cur_count=1, finished=True)
+
+    async def run():
+        with span("bump", repo="api", version="v1.1.0"):
+            await asyncio.gather(stage("manifest"), stage("lock"))
+            try:
+                with span("pull_request"):
+                    raise RuntimeError("rejected")
+            except RuntimeError:
+                pass
+
+    asyncio.run(run())
+
+
+def test_nothing_is_recorded_by_default():
+    with span("bump") as current:
+        current.set(repo="api")
+    assert tracing._finished == []
+
+
+def test_spans_are_nested(trace_file):
+    record()
+    tracing.flush()
+    spans = {}
+    for line in trace_file.read_text().splitlines():
+        item = json.loads(line)
+        spans.setdefault(item["name"], []).append(item)
+
+    (root,) = spans["bump"]
+    assert root["parent_id"] is None
+    assert root["attributes"] == {"repo": "api", "version": "v1.1.0"}
+    stages = spans["manifest"] + spans["lock"] + spans["pull_request"]
+    assert {stage["parent_id"] for stage in stages} == {root["span_id"]}
+    # each thread is a child of the stage that started it
+    pushes = {push["parent_id"] for push in spans["git.push"]}
+    assert pushes == {spans["manifest"][0]["span_id"], spans["lock"][0]["span_id"]}
+    everything = [item for items in spans.values() for item in items]
+    assert {item["trace_id"] for item in everything} == {root["trace_id"]}
+    assert all(item["start"] <= item["end"] for item in everything)
+    assert spans["pull_request"][0]["error"] == "RuntimeError('rejected')"
+    assert tracing._finished == []
+
+
+def test_to_otlp(trace_file):
+    record()
+    spans = list(tracing._finished)
+    tracing._finished.clear()
+    (resource,) = tracing.to_otlp(spans)["resourceSpans"]
+    assert resource["resource"]["attributes"] == [
+        {"key": "service.name", "value": {"stringValue": tracing.SERVICE_NAME}}
+    ]
+    (scope,) = resource["scopeSpans"]
+    otlp = {item["name"]: item for item in scope["spans"]}
+    assert len(scope["spans"]) == len(spans)
+
+    root, push = otlp["bump"], otlp["git.push"]
+    assert "parentSpanId" not in root
+    assert otlp["lock"]["parentSpanId"] == root["spanId"]
+    assert push["traceId"] == root["traceId"]
+    assert int(root["startTimeUnixNano"]) <= int(root["endTimeUnixNano"])
+    assert {"key": "repo", "value": {"stringValue": "api"}} in root["attributes"]
+    (event,) = push["events"]
+    assert event["attributes"] == [
+        {"key": "cur_count", "value": {"intValue": "1"}},
+        {"key": "finished", "value": {"boolValue": True}},
+    ]
+    assert otlp["pull_request"]["status"] == {
+        "code": 2,
+        "message": "RuntimeError('rejected')",
+    }
+    assert root["status"] == {}
+
+
+def test_flush_exports_to_the_collector(monkeypatch):
+    received = []
+
+    class Collector(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            received.append((self.path, self.headers["Content-Type"], json.loads(body)))
+            self.send_response(200)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), Collector)
+    thread = threading.Thread(target=server.handle_request)
+    thread.start()
+    monkeypatch.setattr(
+        tracing, "OTLP_ENDPOINT", f"http://127.0.0.1:{server.server_port}/"
+    )
+    try:
+        record()
+        tracing.flush()
+    finally:
+        thread.join(10)
+        server.server_close()
+
+    ((path, content_type, payload),) = received
+    assert (path, content_type) == ("/v1/traces", "application/json")
+    spans = payload["resourceSpans"][0]["scopeSpans"][0]["spans"]
+    assert sorted(item["name"] for item in spans) == [
+        "bump",
+        "git.push",
+        "git.push",
+        "lock",
+        "manifest",
+        "pull_request",
+    ]
+
+
+def test_summarize(trace_file, capsys):
+    record()
+    tracing.flush()
+    tracing.summarize(trace_file, top=3)
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0].split() == ["stage", "count", "total", "s", "mean", "s", "max", "s"]
+    # the whole bump took the longest
+    assert lines[1].split()[:2] == ["bump", "1"]
+    assert lines.index("Slowest 3 spans") == 5
+    assert "bump" in lines[6] and "version=v1.1.0" in lines[6]
@@ -0,0 +1,163 @@
+import tomlkit
+from packaging.markers import default_environment
+
+from tasks.wheelhouse import locked_requirements, required_packages
+
+PYPROJECT = """\
+[tool.poetry]
+name = "api"
+version = "1.0.0"
+
+[tool.poetry.dependencies]
+python = "^3.10"
+Portalocker = "^2.4"
+uvicorn = {version = "^0.17", extras = ["standard"]}
+psycopg2 = {version = "^2.9", optional = true}
+astrolib = {git = "https://github.com/photopills/astrolib.py", rev = "v1.1.0"}
+
+[tool.poetry.dev-dependencies]
+pytest = "^7.0"
+
+[tool.poetry.group.lint.dependencies]
+flake8 = "^4.0"
+"""
+
+WINDOWS_ONLY = 'markers = "platform_system == \\"Windows\\""'
+PACKAGES = [
+    ("portalocker", "2.4.0", f'pywin32 = {{version = ">=226", {WINDOWS_ONLY}}}'),
+    ("pywin32", "304", ""),
+    (
+        "uvicorn",
+        "0.17.6",
+        'httptools = {version = ">=0.4", optional = true}\n'
+        'click = ">=7.0"\n\n'
+        '[package.extras]\nstandard = ["httptools (>=0.4)"]',
+    ),
+    ("httptools", "0.4.0", ""),
+    ("click", "8.1.3", f'colorama = {{version = "*", {WINDOWS_ONLY}}}'),
+    ("colorama", "0.4.5", ""),
+    ("psycopg2", "2.9.3", ""),
+    ("pytest", "7.1.2", 'iniconfig = "*"'),
+    ("iniconfig", "1.1.1", ""),
+    ("flake8", "4.0.1", ""),
+]
+GIT = """\
+[[package]]
+name = "astrolib"
+version = "1.1.0"
+description = ""
+optional = false
+python-versions = "^3.10"
+develop = false
+
+[package.source]
+type = "git"
+url = "https://github.com/photopills/astrolib.py"
+reference = "v1.1.0"
+resolved_reference = "0123456789abcdef0123456789abcdef01234567"
+"""
+
+LINUX = dict(default_environment(), platform_system="Linux", sys_platform="linux")
+WINDOWS = dict(default_environment(), platform_system="Windows", sys_platform="win32")
+
+
+def file_hash(name):
+    return f"sha256:{name:0<64}"
+
+
+def wheel(name):
+    return f'{{file = "{name}.whl", hash = "{file_hash(name)}"}}'
+
+
+def lock(version):
+    """poetry.lock of PYPROJECT in the lock format `version`"""
+    parts = []
+    for name, release, dependencies in PACKAGES:
+        package = [
+            "[[package]]",
+            f'name = "{name}"',
+            f'version = "{release}"',
+            'description = ""',
+            'python-versions = "*"',
+        ]
+        if version == "2.0":
+            package.append(f"files = [{wheel(name)}]")
+        if dependencies:
+            package += ["", "[package.dependencies]", dependencies]
+        parts.append("\n".join(package) + "\n")
+    parts.append(GIT)
+    metadata = [f'[metadata]\nlock-version = "{version}"\ncontent-hash = ""\n']
+    if version == "1.1":
+        metadata.append("[metadata.files]")
+        metadata += [f"{name} = [{wheel(name)}]" for name, _, _ in PACKAGES]
+    return "\n".join(parts + metadata) + "\n"
+
+
+def required(environment, dev=True):
+    return required_packages(
+        tomlkit.parse(lock("2.0")), tomlkit.parse(PYPROJECT), environment, dev
+    )
+
+
+def test_required_packages():
+    assert required(LINUX) == {
+        "portalocker",
+        "uvicorn",
+        "httptools",
+        "click",
+        "astrolib",
+        "pytest",
+        "iniconfig",
+        "flake8",
+    }
+
+
+def test_markers_are_evaluated_in_the_environment():
+    windows = required(WINDOWS)
+    assert {"pywin32", "colorama"} <= windows
+    assert "pywin32" not in required(LINUX)
+
+
+def test_optional_dependencies_need_an_extra():
+    # psycopg2 is only installed with an extra of the project, httptools is pulled in
+    # by the "standard" extra of uvicorn
+    assert "psycopg2" not in required(LINUX)
+    assert "httptools" in required(LINUX)
+
+    pyproject = PYPROJECT.replace('extras = ["standard"]', "extras = []")
+    packages = required_packages(
+        tomlkit.parse(lock("2.0")), tomlkit.parse(pyproject), LINUX
+    )
+    assert "httptools" not in packages
+    assert "click" in packages
+
+
+def test_dev_dependencies_and_groups():
+    assert required(LINUX, dev=False) == {
+        "portalocker",
+        "uvicorn",
+        "httptools",
+        "click",
+        "astrolib",
+    }
+
+
+def test_locked_requirements_of_both_lock_formats():
+    old = locked_requirements(lock("1.1"), PYPROJECT, LINUX, dev=False)
+    new = locked_requirements(lock("2.0"), PYPROJECT, LINUX, dev=False)
+    assert old == new
+    assert new == {
+        "portalocker==2.4.0": [file_hash("portalocker")],
+        "uvicorn==0.17.6": [file_hash("uvicorn")],
+        "httptools==0.4.0": [file_hash("httptools")],
+        "click==8.1.3": [file_hash("click")],
+        # git packages are pinned to their resolved commit, without hashes
+        "astrolib @ git+https://github.com/photopills/astrolib.py"
+        "@0123456789abcdef0123456789abcdef01234567": [],
+    }
+
+
+def test_every_locked_package_without_the_pyproject():
+    requirements = locked_requirements(lock("1.1"))
+    assert len(requirements) == len(PACKAGES) + 1
+    assert requirements["pywin32==304"] == [file_hash("pywin32")]